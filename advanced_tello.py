@@ -1,13 +1,90 @@
 import logging
 import socket
+import struct
 import threading
 from datetime import datetime
 
-from dev_utils import calc_crc8, calc_crc16
-from utils import RepeatedTimer
+import flight_data
+from capture import CaptureWriter, CHANNEL_BINARY
+from crc import crc8, crc16
+from metrics import MetricsRegistry
+from packet_tracker import PacketTracker
+from scheduler import ScheduledEmitter, get_scheduler
+from utils import PeriodicEmitter, validate_bounds
+from video import VideoReceiver
+
+
+_HEADER = struct.Struct('<BHBBH')  # prefix, size << 3, crc8, pac_type, cmd_id
+_SEQ = struct.Struct('<H')
+_CRC16 = struct.Struct('<H')
+_PACKET_HEADER = struct.Struct('<BHBBHH')  # prefix, size << 3, crc8, pac_type, cmd_id, seq_num
+_JOYSTICK_DATA = struct.Struct('<IHBBBH')  # stick data (48 bits), hour, minute, second, microsecond & 0xffff
+_TIME_DATA = struct.Struct('<BHHHHHHH')  # 0, year, month, day, hour, minute, second, microsecond & 0xffff
+
+
+class PacketBuffer:
+    """
+    Preallocated buffer for one packet layout (cmd_id, pac_type, data size). The constant part of the header (prefix,
+    size, CRC8, pac_type, cmd_id) and its CRC16 state are computed once, encoding only writes seq_num, data and CRC16.
+
+    The returned memoryview is overwritten by the next encode call, it must be sent (or copied) before that.
+    """
+    __slots__ = ('raw', 'view', '_data_end', '_crc16_prefix')
+
+    def __init__(self, cmd_id, pac_type, data_size=0):
+        size = 11 + data_size
+        self.raw = bytearray(size)
+        _HEADER.pack_into(self.raw, 0, 204, size << 3, 0, pac_type, cmd_id)
+        self.raw[3] = crc8(self.raw, 0, 3)
+        self._crc16_prefix = crc16(self.raw, 0, 7)
+        self._data_end = size - 2
+        self.view = memoryview(self.raw)
+
+    def encode(self, seq, data=None):
+        _SEQ.pack_into(self.raw, 7, seq & 0xffff)
+        if data:
+            self.raw[9:self._data_end] = data
+        return self._finish()
+
+    def encode_fields(self, seq, fmt, *values):
+        """Packs values with the given struct directly into the data section"""
+        _SEQ.pack_into(self.raw, 7, seq & 0xffff)
+        fmt.pack_into(self.raw, 9, *values)
+        return self._finish()
+
+    def _finish(self):
+        end = self._data_end
+        _CRC16.pack_into(self.raw, end, crc16(self.view, 7, end - 7, self._crc16_prefix))
+        return self.view
+
+
+class PacketEncoder:
+    """
+    Keeps one :class:`PacketBuffer` per packet layout. Not thread-safe, the buffers are shared between calls (see
+    :meth:`AdvancedTello._send_packet` for usage with a lock).
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def layout(self, cmd_id, pac_type, data_size=0):
+        key = (cmd_id, pac_type, data_size)
+        buf = self._buffers.get(key)
+        if buf is None:
+            buf = self._buffers[key] = PacketBuffer(cmd_id, pac_type, data_size)
+        return buf
+
+    def encode(self, packet, seq=None, data=None):
+        if seq is None:
+            seq = packet.seq_num
+        if data is None:
+            data = packet.data
+        return self.layout(packet.cmd_id, packet.pac_type, len(data) if data else 0).encode(seq, data)
 
 
 class SocketPacket:
+    __slots__ = ('cmd_id', 'data', 'pac_type', 'seq_num')
+
     def __init__(self, cmd_id, pac_type, seq_num=0, data=None):
         self.cmd_id = cmd_id
         self.data = data
@@ -15,48 +92,21 @@ class SocketPacket:
         self.seq_num = seq_num
 
     def to_raw_bytes(self, seq=None, data=None):
-        if seq is not None:
-            self.seq_num = seq
-        if data is not None:
-            self.data = data
-        cap = 11 + (0 if self.data is None else len(self.data))
-
-        bb = bytearray(cap)
-        bb[0] = 204
-        bb[1:3] = (cap << 3).to_bytes(2, byteorder='little')
-        bb[3] = calc_crc8(bb, 3)
-        bb[4] = self.pac_type
-        bb[5:7] = self.cmd_id.to_bytes(2, byteorder='little')
-        bb[7:9] = self.seq_num.to_bytes(2, byteorder='little')
-        if self.data:
-            bb[9:-2] = self.data
-        bb[-2:] = (calc_crc16(bb, cap - 2)).to_bytes(2, byteorder='little')
-        return bb
+        """Encodes the packet into a new bytearray. seq and data override the packet's values without modifying it"""
+        if seq is None:
+            seq = self.seq_num
+        if data is None:
+            data = self.data
+        return bytearray(PacketBuffer(self.cmd_id, self.pac_type, len(data) if data else 0).encode(seq, data))
 
     @classmethod
     def from_raw_bytes(cls, tello, raw):
+        """Decodes a single datagram. Packets failing the size or CRC checks are dropped (cmd_id -1)"""
         prefix = raw[0]
         if prefix == 204:
-            size = int.from_bytes(raw[1:3], byteorder='little') >> 3
-
-            # Check CRC8 Values
-            crc8_check = raw[3]
-            crc8_actual = calc_crc8(raw, 3)
-            if crc8_actual != crc8_check:
-                logging.error(f"Mismatched CRC8 Values: (Expected - Actual) -> ({crc8_check} - {crc8_actual})")
-
-            # Check CRC16 Values
-            crc16_check = int.from_bytes(raw[-2:], byteorder='little')
-            crc16_actual = calc_crc16(raw, size - 2)
-            if crc16_actual != crc16_check:
-                logging.error(f"Mismatched CRC16 Values: (Expected - Actual) -> ({crc16_check} - {crc16_actual})")
-
-            pac_type = raw[4]
-            cmd_id = int.from_bytes(raw[5:7], byteorder='little')
-            seq_num = int.from_bytes(raw[7:9], byteorder='little')
-            data = raw[9:-2]
-
-            return cls(cmd_id, pac_type, seq_num, data)
+            packet = tello.decoder.decode(raw)
+            if packet is not None:
+                return packet
 
         elif prefix == 99:
             if raw == bytearray(b'conn_ack:' + tello.PORT_TELLO_VIDEO.to_bytes(2, byteorder='little')):
@@ -66,7 +116,222 @@ class SocketPacket:
         return SocketPacket(-1, -1, -1, None)
 
 
+class PacketDecoder:
+    """
+    Decodes binary packets without copying, the data of decoded packets is a memoryview into the given buffer.
+
+    Packets with a wrong size field or mismatched CRC8 / CRC16 are dropped and counted. Not thread-safe, each receiver
+    should use its own decoder.
+    """
+    MIN_SIZE = 11
+
+    def __init__(self, verify_crc16=True):
+        self.verify_crc16 = verify_crc16
+        self.packets = 0
+        self.crc8_failures = 0
+        self.crc16_failures = 0
+        self.size_mismatches = 0
+        self.skipped_bytes = 0
+        self._remainder = b''
+        # The CRC8 only covers the prefix and the size field, so there are only a few distinct values
+        self._crc8_by_size = {}
+
+    def _expected_crc8(self, view, pos, size_field):
+        expected = self._crc8_by_size.get(size_field)
+        if expected is None:
+            expected = self._crc8_by_size[size_field] = crc8(view, pos, 3)
+        return expected
+
+    def decode(self, raw):
+        """Decodes a single datagram, returns None if the packet is invalid"""
+        view = memoryview(raw)
+        n = len(view)
+        if n < self.MIN_SIZE or view[0] != 204:
+            self.size_mismatches += 1
+            return None
+        prefix, size_field, crc8_check, pac_type, cmd_id, seq_num = _PACKET_HEADER.unpack_from(view)
+        if crc8_check != self._expected_crc8(view, 0, size_field):
+            self.crc8_failures += 1
+            logging.debug(f'Dropping packet with mismatched CRC8 ({crc8_check})')
+            return None
+        size = size_field >> 3
+        if size != n:
+            self.size_mismatches += 1
+            logging.debug(f'Dropping packet with mismatched size (Expected - Actual) -> ({size} - {n})')
+            return None
+        if self.verify_crc16 and crc16(view, 0, n - 2) != view[n - 2] | (view[n - 1] << 8):
+            self.crc16_failures += 1
+            logging.debug(f'Dropping packet {cmd_id} with mismatched CRC16')
+            return None
+        self.packets += 1
+        return SocketPacket(cmd_id, pac_type, seq_num, view[9:n - 2])
+
+    def feed(self, chunk):
+        """
+        Splits a stream of concatenated packets (e.g. read from a capture file). Incomplete packets at the end of the
+        chunk are kept and completed by the next call. Invalid data is skipped until the next prefix byte.
+
+        :return: list of decoded packets, their data are views into the (joined) chunk
+        """
+        if self._remainder:
+            chunk = self._remainder + chunk
+        elif not isinstance(chunk, (bytes, bytearray)):
+            chunk = bytes(chunk)
+        view = memoryview(chunk)
+        n = len(chunk)
+        unpack = _PACKET_HEADER.unpack_from
+        verify_crc16 = self.verify_crc16
+        crc8_by_size = self._crc8_by_size
+        packets = []
+        pos = 0
+
+        while n - pos >= self.MIN_SIZE:
+            if chunk[pos] != 204:
+                nxt = chunk.find(b'\xcc', pos + 1)
+                if nxt == -1:
+                    nxt = n
+                self.skipped_bytes += nxt - pos
+                pos = nxt
+                continue
+
+            prefix, size_field, crc8_check, pac_type, cmd_id, seq_num = unpack(view, pos)
+            expected = crc8_by_size.get(size_field)
+            if expected is None:
+                expected = self._expected_crc8(view, pos, size_field)
+            size = size_field >> 3
+            if crc8_check != expected or size < self.MIN_SIZE:
+                # Header can not be trusted, search for the next prefix
+                self.crc8_failures += 1
+                self.skipped_bytes += 1
+                pos += 1
+                continue
+            end = pos + size
+            if end > n:
+                break
+            if verify_crc16 and crc16(chunk, pos, size - 2) != chunk[end - 2] | (chunk[end - 1] << 8):
+                self.crc16_failures += 1
+                self.skipped_bytes += size
+            else:
+                packets.append(SocketPacket(cmd_id, pac_type, seq_num, view[pos + 9:end - 2]))
+            pos = end
+
+        self.packets += len(packets)
+        self._remainder = bytes(view[pos:])
+        return packets
+
+    def iter_file(self, path, chunk_size=1 << 20):
+        """Generator over all packets in a file of concatenated raw packets"""
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield from self.feed(chunk)
+        if self._remainder:
+            self.skipped_bytes += len(self._remainder)
+            self._remainder = b''
+
+    def stats(self):
+        return {
+            'packets': self.packets,
+            'crc8_failures': self.crc8_failures,
+            'crc16_failures': self.crc16_failures,
+            'size_mismatches': self.size_mismatches,
+            'skipped_bytes': self.skipped_bytes,
+        }
+
+
+class _Route:
+    __slots__ = ('decoder', 'handler', 'subscribers', 'count')
+
+    def __init__(self, decoder=None, handler=None):
+        self.decoder = decoder
+        self.handler = handler
+        self.subscribers = ()
+        self.count = 0
+
+
+class PacketDispatcher:
+    """
+    Table of cmd_id -> decoder, handler and subscribers for received packets (one dict lookup per packet).
+
+    The decoder turns the packet data into a record (see :mod:`flight_data`), without decoder subscribers get the raw
+    data. The handler (internal replies etc.) is called with (packet, record), subscribers with (record). All of them
+    run on the receiver thread and must not block. The latest record per cmd_id is kept in ``latest``.
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self.latest = {}
+        self.unhandled = 0
+        self.decode_errors = 0
+
+    def _route(self, cmd_id):
+        route = self._routes.get(cmd_id)
+        if route is None:
+            route = self._routes[cmd_id] = _Route()
+        return route
+
+    def register(self, cmd_id, decoder=None, handler=None):
+        route = self._route(cmd_id)
+        route.decoder = decoder
+        route.handler = handler
+
+    def subscribe(self, cmd_id, callback):
+        route = self._route(cmd_id)
+        # Replaced on change, so dispatch can iterate without a lock
+        route.subscribers += (callback,)
+        return callback
+
+    def unsubscribe(self, cmd_id, callback):
+        route = self._routes.get(cmd_id)
+        if route is not None:
+            route.subscribers = tuple(c for c in route.subscribers if c != callback)
+
+    def dispatch(self, packet):
+        """:return: the decoded record, None if the packet was not handled"""
+        route = self._routes.get(packet.cmd_id)
+        if route is None:
+            self.unhandled += 1
+            return None
+        route.count += 1
+        data = packet.data if packet.data is not None else b''
+        if route.decoder is None:
+            record = bytes(data)
+        else:
+            try:
+                record = route.decoder(data)
+            except (struct.error, ValueError, IndexError):
+                record = None
+            if record is None:
+                self.decode_errors += 1
+                logging.debug(f'Dropping undecodable packet {packet.cmd_id}')
+                return None
+        self.latest[packet.cmd_id] = record
+        if route.handler is not None:
+            # A failing handler must neither end the receiver thread nor hide the record from the subscribers
+            try:
+                route.handler(packet, record)
+            except Exception:
+                logging.exception(f'Packet handler for {packet.cmd_id} failed')
+        for callback in route.subscribers:
+            try:
+                callback(record)
+            except Exception:
+                logging.exception(f'Packet callback {callback} failed')
+        return record
+
+    def stats(self):
+        return {
+            'received': {cmd_id: route.count for cmd_id, route in self._routes.items() if route.count},
+            'unhandled': self.unhandled,
+            'decode_errors': self.decode_errors,
+        }
+
+
 class AdvancedTello:
+    capture = None
+    _closed = False
     CMD_ID_CONN_REQ = 1
     CMD_ID_CONN_ACK = 2
     CMD_ID_VIDEO_STUFF = 37  # TODO Figure out what this is
@@ -76,11 +341,21 @@ class AdvancedTello:
     CMD_ID_LAND = 85
     CMD_ID_FLIP = 92
     CMD_ID_ALT_LIMIT = 4182
+    CMD_ID_WIFI = flight_data.CMD_ID_WIFI
+    CMD_ID_LIGHT = flight_data.CMD_ID_LIGHT
+    CMD_ID_FLIGHT_DATA = flight_data.CMD_ID_FLIGHT_DATA
+    CMD_ID_LOG_HEADER = flight_data.CMD_ID_LOG_HEADER
+    CMD_ID_LOG_DATA = flight_data.CMD_ID_LOG_DATA
 
     PORT_TELLO_CMD = 8889
     PORT_TELLO_VIDEO = 6037
 
-    def __init__(self, tello_ip='192.168.10.1', tello_port=None):
+    def __init__(self, tello_ip='192.168.10.1', tello_port=None, joystick_rate=50, scheduler=None):
+        """
+        :param scheduler: :class:`scheduler.Scheduler` (e.g. :func:`scheduler.get_scheduler`) shared by many drones for
+                          the joystick stream and replies. By default, the joystick stream uses its own thread and
+                          retransmissions the process wide scheduler.
+        """
         if tello_port is None:
             tello_port = self.PORT_TELLO_CMD
         self.tello_address = tello_ip, tello_port
@@ -89,34 +364,142 @@ class AdvancedTello:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        self.thread_cmd_receiver = threading.Thread(target=self._receive_cmds)
-        self.thread_cmd_receiver.daemon = True
-        self.thread_cmd_receiver.start()
+        # Guards seq_num and the shared buffers of the encoder
+        self._send_lock = threading.Lock()
+        self._encoder = PacketEncoder()
+        self.decoder = PacketDecoder()
+        self.dispatcher = PacketDispatcher()
+        for cmd_id, decoder in flight_data.DECODERS.items():
+            self.dispatcher.register(cmd_id, decoder)
+        self.dispatcher.register(self.CMD_ID_CONN_ACK, handler=self._on_conn_ack)
+        self.dispatcher.register(self.CMD_ID_TIME_REQ, handler=self._on_time_req)
+        self.dispatcher.register(self.CMD_ID_LOG_HEADER, flight_data.decode_log_header, self._on_log_header)
+        # Acknowledged commands, see take_off, land and flip
+        self.packets = PacketTracker(self._retransmit, scheduler or get_scheduler())
+        for cmd_id in (self.CMD_ID_TAKE_OFF, self.CMD_ID_LAND, self.CMD_ID_FLIP):
+            self.dispatcher.register(cmd_id, handler=self._on_ack)
+        self._init_metrics()
+        self._joystick_buffer = self._encoder.layout(self.CMD_ID_JOYSTICK, 96, _JOYSTICK_DATA.size)
+        self._conn_req = b'conn_req:' + self.PORT_TELLO_VIDEO.to_bytes(2, byteorder='little')
 
         self.seq_num = 0
         self.joystick_data = 0
-        self.joystick_emitter = RepeatedTimer(0.02, self._emit_joystick_data)
+        self.video = None
+        self.scheduler = scheduler
+        interval = 1 / validate_bounds(joystick_rate, 20, 100)
+        if scheduler is None:
+            self.joystick_emitter = PeriodicEmitter(interval, self._emit_joystick_data)
+        else:
+            self.joystick_emitter = ScheduledEmitter(scheduler, interval, self._emit_joystick_data, name='joystick')
+
+        self.thread_cmd_receiver = threading.Thread(target=self._receive_cmds)
+        self.thread_cmd_receiver.daemon = True
+        self.thread_cmd_receiver.start()
 
     def __del__(self):
         self.socket.close()
         self.joystick_emitter.stop()
 
+    def close(self):
+        """Stops the joystick stream, retransmissions, video receiver, capture and receiver thread, closes the socket"""
+        if self._closed:
+            return
+        self._closed = True
+        self.joystick_emitter.stop()
+        self.packets.cancel_all()
+        self.stop_video()
+        self.stop_capture()
+        try:
+            # Wakes up the receiver blocked in recv (on Linux also for unconnected UDP sockets)
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.thread_cmd_receiver.join(1.0)
+        self.socket.close()
+
+    def _init_metrics(self):
+        """
+        Creates :attr:`metrics` (see :mod:`metrics`). Only the datagram counters are incremented on the hot path, the
+        decoder and dispatcher counters are read when the metrics are collected.
+        """
+        ip, port = self.tello_address
+        self.metrics = metrics = MetricsRegistry(drone=f'{ip}:{port}')
+        self._packets_sent = metrics.counter('tello_packets_sent_total', 'Datagrams sent', socket='binary')
+        self._bytes_sent = metrics.counter('tello_bytes_sent_total', 'Bytes sent', socket='binary')
+        self._packets_received = metrics.counter('tello_packets_received_total', 'Datagrams received', socket='binary')
+        self._bytes_received = metrics.counter('tello_bytes_received_total', 'Bytes received', socket='binary')
+
+        decoder, dispatcher = self.decoder, self.dispatcher
+        for name, description in (('crc8_failures', 'Packets with a wrong header CRC8'),
+                                  ('crc16_failures', 'Packets with a wrong CRC16'),
+                                  ('size_mismatches', 'Packets whose size field does not match the datagram')):
+            metrics.gauge(f'tello_packet_{name}_total', lambda name=name: getattr(decoder, name), description,
+                          type='counter')
+        metrics.gauge('tello_packets_unhandled_total', lambda: dispatcher.unhandled, 'Packets of unknown cmd_id',
+                      type='counter')
+        metrics.gauge('tello_packet_decode_errors_total', lambda: dispatcher.decode_errors,
+                      'Packets whose data could not be decoded', type='counter')
+        metrics.collector('tello_packets_dispatched_total',
+                          lambda: {(('cmd_id', cmd_id),): count
+                                   for cmd_id, count in dispatcher.stats()['received'].items()},
+                          'Packets dispatched per cmd_id')
+        packets = self.packets
+        for name, description in (('sent', 'Acknowledged commands sent (without retransmissions)'),
+                                  ('retransmissions', 'Retransmissions of unacknowledged commands'),
+                                  ('acked', 'Acknowledged commands'),
+                                  ('failed', 'Commands not acknowledged after all retransmissions')):
+            metrics.collector(f'tello_packet_delivery_{name}_total',
+                              lambda name=name: {(('cmd_id', cmd_id),): stats[name]
+                                                 for cmd_id, stats in packets.stats()['commands'].items()},
+                              description)
+        metrics.gauge('tello_packet_rto_seconds', lambda: packets.rto, 'Current retransmission timeout')
+        metrics.gauge('tello_packet_srtt_seconds', lambda: packets.srtt, 'Smoothed round trip time of acknowledgements')
+        metrics.gauge('tello_joystick_missed_total', lambda: self.joystick_emitter.stats().get('missed'),
+                      'Joystick packets not sent in time', type='counter')
+
     def connect(self):
         self._send_packet(SocketPacket(self.CMD_ID_CONN_REQ, 0))
 
-    def take_off(self):
-        self._send_packet(SocketPacket(self.CMD_ID_TAKE_OFF, 104))
+    def start_video(self, local_ip='', **kwargs):
+        """
+        Receives the video stream (port announced in conn_req, so call before :meth:`connect`) into a
+        :class:`video.VideoReceiver` (``self.video``), kwargs are passed to the receiver
+        """
+        if self.video is None:
+            self.video = VideoReceiver(local_ip, self.PORT_TELLO_VIDEO, framing='app', **kwargs)
+            self.video.start()
+        return self.video
+
+    def stop_video(self):
+        if self.video is not None:
+            self.video.stop()
+            self.video = None
+
+    # take_off, land and flip are acknowledged by the drone and retransmitted until they are (see packet_tracker).
+    # They return a Future of True (acknowledged) or False (given up)
 
-    def land(self):
-        self._send_packet(SocketPacket(self.CMD_ID_LAND, 104, data=bytearray(b'\x00')))
+    def take_off(self, max_retries=None):
+        return self._send_packet(SocketPacket(self.CMD_ID_TAKE_OFF, 104), True, max_retries)
 
-    def flip(self, direction=0):
+    def land(self, max_retries=None):
+        return self._send_packet(SocketPacket(self.CMD_ID_LAND, 104, data=bytearray(b'\x00')), True, max_retries)
+
+    def flip(self, direction=0, max_retries=None):
+        """If only the acknowledgement is lost, the retransmission may flip again, pass max_retries=0 to avoid it"""
         assert direction in range(8)
-        self._send_packet(SocketPacket(self.CMD_ID_FLIP, 112, data=bytearray([direction])))
+        return self._send_packet(SocketPacket(self.CMD_ID_FLIP, 112, data=bytearray([direction])), True, max_retries)
+
+    def delivery_stats(self):
+        """Per cmd_id delivery statistics of the acknowledged commands and the RTT / RTO estimates"""
+        return self.packets.stats()
 
     def start_joystick(self):
         self.joystick_emitter.start()
 
+    def set_joystick_rate(self, rate):
+        """Rate of joystick packets in Hz (20 - 100), applied on the next start_joystick"""
+        self.joystick_emitter.interval = 1 / validate_bounds(rate, 20, 100)
+
     def stop_joystick(self):
         self.joystick_emitter.stop()
         self.update_joystick(1024, 1024, 1024, 1024, 0)
@@ -135,69 +518,135 @@ class AdvancedTello:
                              | ((2047 & yaw) << 33) | (speed_mode << 44)
 
     def _receive_cmds(self):
-        while True:
+        while not self._closed:
             try:
                 data, _ = self.socket.recvfrom(1024)
-                packet = SocketPacket.from_raw_bytes(self, data)
-                self._handle_received_packet(packet)
+                self._packets_received.inc()
+                self._bytes_received.inc(len(data))
+                capture = self.capture
+                if capture is not None:
+                    capture.record(CHANNEL_BINARY, False, data)
+                self._on_datagram(data)
             except socket.error:
+                if self._closed:
+                    break
                 logging.error("Command Socket Failed")
 
-    def _emit_joystick_data(self):
-        self._send_packet(SocketPacket(self.CMD_ID_JOYSTICK, 96))
+    def _on_datagram(self, data):
+        if data:
+            packet = SocketPacket.from_raw_bytes(self, data)
+            if packet.cmd_id != -1:
+                self.dispatcher.dispatch(packet)
 
-    def _handle_received_packet(self, packet):
-        if packet.cmd_id == self.CMD_ID_CONN_ACK:
-            logging.debug("Successfully connected to Tello")
-        elif packet.cmd_id == self.CMD_ID_TIME_REQ:
-            self._send_packet(SocketPacket(self.CMD_ID_TIME_REQ, 80))
-        # logging.debug(f"Received Command {packet.cmd_id}")
+    def _transmit(self, raw):
+        """Sends raw bytes, the caller holds _send_lock"""
+        self.socket.sendto(raw, self.tello_address)
+        self._packets_sent.inc()
+        self._bytes_sent.inc(len(raw))
+        capture = self.capture
+        if capture is not None:
+            capture.record(CHANNEL_BINARY, True, raw)
 
-    # Mostly found in com.ryzerobotics.tello.gcs.core.cmd.d (ZOCmdStore)
-    def _send_packet(self, packet: SocketPacket):
-        """Sends packets, intercepts Commands that need special treatment (CMD_ID_CONN_REQ) etc."""
-        raw = None
-        data = None
-        seq = 0
-
-        if packet.cmd_id == self.CMD_ID_CONN_REQ:
-            raw = bytearray(b'conn_req:' + self.PORT_TELLO_VIDEO.to_bytes(2, byteorder='little'))
-            self.seq_num += 1
-
-        elif packet.cmd_id == self.CMD_ID_TIME_REQ:
-            dt = datetime.now()
-            # First Byte empty (0)
-            data = bytearray(b'\x00' +
-                             dt.year.to_bytes(2, byteorder='little') +
-                             dt.month.to_bytes(2, byteorder='little') +
-                             dt.day.to_bytes(2, byteorder='little') +
-                             dt.hour.to_bytes(2, byteorder='little') +
-                             dt.minute.to_bytes(2, byteorder='little') +
-                             dt.second.to_bytes(2, byteorder='little') +
-                             (dt.microsecond & 0xffff).to_bytes(2, byteorder='little'))
+    def start_capture(self, path, **kwargs):
+        """
+        Records all datagrams sent and received on the command socket to a file, see :mod:`capture`. kwargs are
+        passed to :class:`capture.CaptureWriter`
+        """
+        self.stop_capture()
+        self.capture = CaptureWriter(path, **kwargs)
+        return self.capture
 
-            seq = self.seq_num
-            self.seq_num += 1
-
-        elif packet.cmd_id == self.CMD_ID_JOYSTICK:
-            dt = datetime.now()
-            data = bytearray(11)
-            data[:6] = self.joystick_data.to_bytes(6, byteorder='little')
-            data[6] = dt.hour
-            data[7] = dt.minute
-            data[8] = dt.second
-            data[9:11] = (dt.microsecond & 0xffff).to_bytes(2, byteorder='little')
-
-        elif packet.cmd_id == self.CMD_ID_VIDEO_STUFF:
-            # seq should be 0 for this packet
-            seq = 0
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+
+    def replay_handlers(self):
+        """Receive handlers per capture channel, for :meth:`capture.CaptureReplay.run`"""
+        return {CHANNEL_BINARY: self._on_datagram}
+
+    def _emit_joystick_data(self):
+        dt = datetime.now()
+        stick = self.joystick_data
+        with self._send_lock:
+            raw = self._joystick_buffer.encode_fields(0, _JOYSTICK_DATA, stick & 0xffffffff, stick >> 32,
+                                                      dt.hour, dt.minute, dt.second, dt.microsecond & 0xffff)
+            self._transmit(raw)
+
+    def subscribe(self, cmd_id, callback):
+        """
+        Calls callback with the record (see :mod:`flight_data`, raw bytes for cmd_ids without decoder) of every
+        received packet with the given cmd_id, e.g. ``drone.subscribe(drone.CMD_ID_FLIGHT_DATA, print)``
+        """
+        return self.dispatcher.subscribe(cmd_id, callback)
+
+    def unsubscribe(self, cmd_id, callback):
+        self.dispatcher.unsubscribe(cmd_id, callback)
+
+    def _reply(self, packet, name):
+        if self.scheduler is None:
+            self._send_packet(packet)
         else:
-            seq = self.seq_num
-            self.seq_num += 1
+            self.scheduler.call_soon(self._send_packet, packet, name=name)
 
-        if raw is None:
-            raw = packet.to_raw_bytes(seq, data)
-        self.socket.sendto(raw, self.tello_address)
+    def _on_ack(self, packet, record):
+        self.packets.acknowledge(packet.cmd_id, packet.seq_num, record)
+
+    def _retransmit(self, raw):
+        with self._send_lock:
+            self._transmit(raw)
+
+    def _on_conn_ack(self, packet, record):
+        logging.debug("Successfully connected to Tello")
+
+    def _on_time_req(self, packet, record):
+        self._reply(SocketPacket(self.CMD_ID_TIME_REQ, 80), 'time reply')
+
+    def _on_log_header(self, packet, record):
+        # The drone repeats the log header until it is acknowledged
+        self._reply(SocketPacket(self.CMD_ID_LOG_HEADER, 80, data=bytearray(
+            (0, record.log_id & 0xff, record.log_id >> 8))), 'log header ack')
+
+    # Mostly found in com.ryzerobotics.tello.gcs.core.cmd.d (ZOCmdStore)
+    def _send_packet(self, packet: SocketPacket, acknowledged=False, max_retries=None):
+        """
+        Sends packets, intercepts Commands that need special treatment (CMD_ID_CONN_REQ) etc.
+
+        :param acknowledged: Track the packet until the drone acknowledges it (see :attr:`packets`)
+        :return: Future of the delivery if acknowledged, None otherwise
+        """
+        if acknowledged and packet.cmd_id in (self.CMD_ID_JOYSTICK, self.CMD_ID_CONN_REQ, self.CMD_ID_TIME_REQ,
+                                              self.CMD_ID_VIDEO_STUFF):
+            raise ValueError(f'Packets of cmd_id {packet.cmd_id} are not acknowledged by the drone')
+        if packet.cmd_id == self.CMD_ID_JOYSTICK:
+            self._emit_joystick_data()
+            return None
+
+        dt = datetime.now() if packet.cmd_id == self.CMD_ID_TIME_REQ else None
+        future = None
+        with self._send_lock:
+            if packet.cmd_id == self.CMD_ID_CONN_REQ:
+                raw = self._conn_req
+                self.seq_num += 1
+
+            elif packet.cmd_id == self.CMD_ID_TIME_REQ:
+                # First Byte empty (0)
+                raw = self._encoder.layout(packet.cmd_id, packet.pac_type, _TIME_DATA.size).encode_fields(
+                    self.seq_num, _TIME_DATA, 0, dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second,
+                    dt.microsecond & 0xffff)
+                self.seq_num += 1
+
+            elif packet.cmd_id == self.CMD_ID_VIDEO_STUFF:
+                # seq should be 0 for this packet
+                raw = self._encoder.encode(packet, 0)
+            else:
+                raw = self._encoder.encode(packet, self.seq_num)
+                if acknowledged:
+                    future = self.packets.track(packet.cmd_id, self.seq_num, raw, max_retries)
+                self.seq_num += 1
+
+            self._transmit(raw)
+        return future
 
 
 if __name__ == '__main__':
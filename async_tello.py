@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+
+from command_tracker import CommandTracker
+from telemetry import StateParser, StatePublisher
+from tello import Drone1_3, Drone2_0, DroneInterface
+
+
+class _CommandProtocol(asyncio.DatagramProtocol):
+    def __init__(self, drone):
+        self.drone = drone
+
+    def datagram_received(self, data, addr):
+        self.drone._on_response(data)
+
+    def error_received(self, exc):
+        logging.error(f'Ack Socket Failed ({exc})')
+
+
+class _StateProtocol(asyncio.DatagramProtocol):
+    def __init__(self, drone):
+        self.drone = drone
+
+    def datagram_received(self, data, addr):
+        self.drone._on_state(data)
+
+    def error_received(self, exc):
+        logging.error(f'State Socket Failed ({exc})')
+
+
+class AsyncDroneMixin:
+    """
+    Replaces the socket threads of :class:`tello.DroneInterface` with asyncio datagram endpoints. The command methods
+    of :class:`tello.Drone1_3` / :class:`tello.Drone2_0` are reused as is, but return coroutines:
+
+        async with AsyncDrone(local_port=9000, local_state_port=9001) as drone:
+            await drone.enter_sdk_mode()
+            await drone.take_off()
+
+    Any number of drones can share one event loop. Commands can be cancelled (or time out) at any time, the response
+    that arrives later for such a command is discarded instead of being matched to the next command.
+    """
+
+    # Getters return coroutines, telemetry is not answered from the state stream
+    state_max_age = None
+
+    def __init__(self, local_ip='', local_port=8889, local_state_port=DroneInterface.TELLO_STATE_PORT,
+                 command_timeout=3.0, move_timeout=15.0, tello_ip='192.168.10.1',
+                 tello_port=DroneInterface.TELLO_COMMAND_PORT):
+        self.command_timeout = command_timeout
+        self.move_timeout = move_timeout
+        self._latest = (None, None)
+        self.state_updates = StatePublisher()
+        self._state_parser = StateParser()
+
+        self.tello_address = (tello_ip, tello_port)
+        self.local_address = (local_ip, local_port)
+        self.local_state_address = (local_ip, local_state_port)
+
+        self.transport = None
+        self.transport_state = None
+        # Matches responses by position and type, timed out commands discard their late response for a bounded
+        # time. Commands never block on the event loop, there is no limit of commands in flight
+        self.commands = CommandTracker(max_in_flight=float('inf'))
+        self._pending = {}  # InFlightCommand -> Future of the response
+        self._state_waiters = []
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: _CommandProtocol(self),
+                                                                local_addr=self.local_address)
+        self.transport_state, _ = await loop.create_datagram_endpoint(lambda: _StateProtocol(self),
+                                                                      local_addr=self.local_state_address)
+        return self
+
+    def close(self):
+        for transport in (self.transport, self.transport_state):
+            if transport is not None and not transport.is_closing():
+                transport.close()
+        self.reset_queue()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except RuntimeError:  # Event loop already closed
+            pass
+
+    def _on_response(self, data):
+        try:
+            entry = self.commands.match(data.decode(encoding='utf-8').rstrip('\r\n'))
+        except UnicodeDecodeError:
+            logging.error('Illegal Answer?')
+            return
+        if entry is not None:
+            future = self._pending.pop(entry, None)
+            if future is not None and not future.done():
+                future.set_result(entry.response)
+
+    def _on_state(self, data):
+        state = self._state_parser.parse(data)
+        if state is None:
+            return
+        self._on_state_received(state, time.monotonic())
+        waiters, self._state_waiters = self._state_waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(state)
+
+    def send_command(self, command, command_timeout=None, none_response=False, result_conversion=None):
+        """Same as :meth:`tello.DroneInterface.send_command`, but returns a coroutine"""
+        return self._send_command(command, command_timeout, none_response, result_conversion)
+
+    async def _send_command(self, command, command_timeout, none_response, result_conversion):
+        if command_timeout is None:
+            command_timeout = self.command_timeout
+        logging.debug(f'>> Send Command: {command}')
+
+        if none_response:
+            self.transport.sendto(command.encode(encoding='utf-8'), self.tello_address)
+            logging.debug(f'Not awaiting response for command {command}')
+            return 'ok'
+
+        entry = self.commands.register(command, timeout=0)
+        future = self._pending[entry] = asyncio.get_running_loop().create_future()
+        self.transport.sendto(command.encode(encoding='utf-8'), self.tello_address)
+        try:
+            command_response = await asyncio.wait_for(future, command_timeout)
+        except asyncio.TimeoutError:
+            logging.error(f'No Response for Command {command}')
+            command_response = 'none_response'
+        finally:
+            # Timed out or cancelled: the tracker discards the late response, if it arrives in time
+            if self._pending.pop(entry, None) is not None:
+                self.commands.expire(entry)
+
+        logging.debug(command_response)
+        if result_conversion:
+            command_response = result_conversion(command_response)
+        return command_response
+
+    async def wait_for_state(self, predicate=None, timeout=None):
+        """
+        Waits for the next state datagram (for which predicate(state) is true, if given)
+
+        :return: :class:`telemetry.TelloState`
+        """
+
+        async def _wait():
+            while True:
+                future = asyncio.get_running_loop().create_future()
+                self._state_waiters.append(future)
+                state = await future
+                if predicate is None or predicate(state):
+                    return state
+
+        return await asyncio.wait_for(_wait(), timeout)
+
+    def reset_queue(self):
+        self.commands.reset()
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.cancel()
+
+
+class AsyncDrone1_3(AsyncDroneMixin, Drone1_3):
+    pass
+
+
+class AsyncDrone2_0(AsyncDroneMixin, Drone2_0):
+    pass
+
+
+AsyncDrone = AsyncDrone2_0
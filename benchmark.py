@@ -0,0 +1,305 @@
+"""
+Benchmarks of the command, telemetry and packet paths against the local :mod:`simulator`.
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json
+    python benchmark.py compare before.json after.json --threshold 0.1
+
+``compare`` prints the change of every metric and exits with 1 if any metric got worse by more than the threshold.
+Numbers depend on the machine, only compare runs made on the same one.
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import socket
+import sys
+import time
+import types
+
+from advanced_tello import AdvancedTello, PacketDecoder, SocketPacket
+from dev_utils import calc_crc8, calc_crc16
+from simulator import Simulator
+from swarm import Swarm
+from telemetry import StateParser
+from tello import Drone2_0
+
+STATE_SAMPLE = (b'mid:-1;x:0;y:0;z:0;mpry:0,0,0;pitch:0;roll:-1;yaw:12;vgx:0;vgy:0;vgz:0;templ:62;temph:65;tof:10;'
+                b'h:0;bat:87;baro:-51.36;time:0;agx:-2.00;agy:10.00;agz:-999.00;\r\n')
+JOYSTICK_PACKET = SocketPacket(AdvancedTello.CMD_ID_JOYSTICK, 96, 0, bytearray(11))
+
+
+def _metric(value, unit, better):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _rate(function, duration, repeats=5):
+    """
+    Calls function (doing ``n`` operations per call, returned by the function) for duration s, returns ops/s of the
+    best of ``repeats`` windows (the least disturbed by other processes)
+    """
+    best = 0.0
+    for _ in range(repeats):
+        count = 0
+        start = time.perf_counter()
+        while True:
+            count += function()
+            elapsed = time.perf_counter() - start
+            if elapsed >= duration / repeats:
+                break
+        best = max(best, count / elapsed)
+    return best
+
+
+@contextlib.contextmanager
+def _client(simulator):
+    """Drone2_0 in SDK mode connected to a new simulated drone"""
+    state_port = _free_port()
+    drone = simulator.add(port=0, state_port=state_port)
+    client = Drone2_0(local_ip='127.0.0.1', local_port=0, local_state_port=state_port, tello_ip='127.0.0.1',
+                      tello_port=drone.port, state_max_age=None)
+    try:
+        client.enter_sdk_mode()
+        yield client
+    finally:
+        client.close()
+
+
+def bench_commands(scale):
+    with Simulator(time_scale=0) as simulator, _client(simulator) as client:
+        for _ in range(20):
+            client.get_battery()
+        rtts = []
+        for _ in range(int(1000 * scale)):
+            start = time.perf_counter()
+            client.get_battery()
+            rtts.append(time.perf_counter() - start)
+
+        batch = ['battery?'] * client.commands.max_in_flight
+        pipelined = _rate(lambda: len(client.send_queries(*batch)), 1.0 * scale)
+    return {
+        'rtt_p50': _metric(_percentile(rtts, 0.5) * 1000, 'ms', 'lower'),
+        'rtt_p99': _metric(_percentile(rtts, 0.99) * 1000, 'ms', 'lower'),
+        'sequential': _metric(len(rtts) / sum(rtts), 'commands/s', 'higher'),
+        'pipelined': _metric(pipelined, 'commands/s', 'higher'),
+    }
+
+
+def bench_state(scale):
+    parser = StateParser()
+
+    def parse():
+        for _ in range(1000):
+            parser.parse(STATE_SAMPLE)
+        return 1000
+
+    with Simulator() as simulator, _client(simulator) as client:
+        # Full receive path without the socket: parse, store and publish
+        def receive():
+            for _ in range(1000):
+                client._on_state_datagram(STATE_SAMPLE)
+            return 1000
+
+        # Telemetry getter answered from the state stream
+        client.state_max_age = 60.0
+
+        def getter():
+            for _ in range(1000):
+                client.get_battery()
+            return 1000
+
+        return {
+            'parse': _metric(_rate(parse, 1.0 * scale), 'datagrams/s', 'higher'),
+            'receive': _metric(_rate(receive, 1.0 * scale), 'datagrams/s', 'higher'),
+            'cached_getter': _metric(_rate(getter, 1.0 * scale), 'calls/s', 'higher'),
+        }
+
+
+def bench_packets(scale):
+    tello = types.SimpleNamespace(decoder=PacketDecoder(), PORT_TELLO_VIDEO=AdvancedTello.PORT_TELLO_VIDEO,
+                                  CMD_ID_CONN_ACK=AdvancedTello.CMD_ID_CONN_ACK)
+    raw = bytes(JOYSTICK_PACKET.to_raw_bytes())
+
+    def encode():
+        for _ in range(1000):
+            JOYSTICK_PACKET.to_raw_bytes()
+        return 1000
+
+    def decode():
+        for _ in range(1000):
+            SocketPacket.from_raw_bytes(tello, raw)
+        return 1000
+
+    stream = raw * 1000
+
+    def decode_stream():
+        return len(PacketDecoder().feed(stream))
+
+    return {
+        'to_raw_bytes': _metric(_rate(encode, 1.0 * scale), 'packets/s', 'higher'),
+        'from_raw_bytes': _metric(_rate(decode, 1.0 * scale), 'packets/s', 'higher'),
+        'decoder_feed': _metric(_rate(decode_stream, 1.0 * scale), 'packets/s', 'higher'),
+    }
+
+
+def bench_crc(scale):
+    buffers = [os.urandom(n) for n in (16, 64, 256, 1024)] * 16
+    size = sum(len(b) for b in buffers)
+
+    def crc8():
+        for b in buffers:
+            calc_crc8(b, len(b))
+        return size
+
+    def crc16():
+        for b in buffers:
+            calc_crc16(b, len(b))
+        return size
+
+    return {
+        'crc8': _metric(_rate(crc8, 1.0 * scale) / 1e6, 'MB/s', 'higher'),
+        'crc16': _metric(_rate(crc16, 1.0 * scale) / 1e6, 'MB/s', 'higher'),
+    }
+
+
+def bench_joystick(scale):
+    with Simulator() as simulator:
+        drone = simulator.add(port=0)
+        tello = AdvancedTello('127.0.0.1', drone.port)
+        try:
+            tello.start_joystick()
+            time.sleep(3.0 * scale)
+            tello.joystick_emitter.stop()
+            stats = tello.joystick_emitter.stats()
+        finally:
+            tello.close()
+    return {
+        'lateness_p50': _metric(stats['lateness_p50'] * 1000, 'ms', 'lower'),
+        'lateness_p99': _metric(stats['lateness_p99'] * 1000, 'ms', 'lower'),
+        'missed': _metric(stats['missed'], 'ticks', 'lower'),
+    }
+
+
+def bench_swarm(scale, sizes=(1, 10, 50)):
+    results = {}
+    for n in sizes:
+        with Simulator(time_scale=0) as simulator, Swarm('127.0.0.1') as swarm:
+            for i in range(n):
+                state_port = _free_port()
+                drone = simulator.add(port=0, state_port=state_port)
+                swarm.add(f'd{i}', '127.0.0.1', drone.port, local_state_port=state_port)
+            swarm.broadcast('enter_sdk_mode')
+            rtts = []
+            rounds = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < 1.0 * scale:
+                rtts += [r.rtt for r in swarm.broadcast('get_battery').values() if r.rtt is not None]
+                rounds += 1
+            elapsed = time.perf_counter() - start
+        results[f'{n}_drones_throughput'] = _metric(rounds * n / elapsed, 'commands/s', 'higher')
+        results[f'{n}_drones_rtt_p99'] = _metric(_percentile(rtts, 0.99) * 1000, 'ms', 'lower')
+    return results
+
+
+BENCHMARKS = {
+    'commands': bench_commands,
+    'state': bench_state,
+    'packets': bench_packets,
+    'crc': bench_crc,
+    'joystick': bench_joystick,
+    'swarm': bench_swarm,
+}
+
+
+def run(names=None, scale=1.0):
+    results = {}
+    for name in names or BENCHMARKS:
+        # The client prints every command, keep the output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = BENCHMARKS[name](scale)
+        for metric, m in results[name].items():
+            print(f'{name:10s} {metric:24s} {m["value"]:14.3f} {m["unit"]}')
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scale': scale,
+        },
+        'results': results,
+    }
+
+
+def compare(old, new, threshold=0.1):
+    """
+    :return: list of (benchmark, metric, old value, new value, relative change, regression), the relative change is
+             positive if the metric improved
+    """
+    rows = []
+    for name, metrics in new['results'].items():
+        for metric, m in metrics.items():
+            before = old['results'].get(name, {}).get(metric)
+            if before is None:
+                continue
+            if before['value'] == 0:
+                change = 0.0 if m['value'] == 0 else float('inf')
+                change = -change if m['better'] == 'lower' else change
+            else:
+                change = (m['value'] - before['value']) / abs(before['value'])
+                if m['better'] == 'lower':
+                    change = -change
+            rows.append((name, metric, before['value'], m['value'], change, change < -threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest='mode')
+    run_parser = sub.add_parser('run', help='Run the benchmarks (default)')
+    for p in (parser, run_parser):
+        p.add_argument('--output', help='JSON file for the results')
+        p.add_argument('--only', nargs='+', choices=list(BENCHMARKS))
+        p.add_argument('--scale', type=float, default=1.0, help='Duration factor, e.g. 0.2 for a quick run')
+    compare_parser = sub.add_parser('compare', help='Compare two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Tolerated relative regression')
+    args = parser.parse_args(argv)
+
+    if args.mode == 'compare':
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        rows = compare(old, new, args.threshold)
+        for name, metric, before, after, change, regression in rows:
+            print(f'{name:10s} {metric:24s} {before:14.3f} -> {after:14.3f} {change * 100:+8.1f} %'
+                  + ('  REGRESSION' if regression else ''))
+        regressions = sum(row[-1] for row in rows)
+        print(f'{regressions} regression(s) beyond {args.threshold * 100:.0f} %')
+        return 1 if regressions else 0
+
+    results = run(args.only, args.scale)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    sys.exit(main())
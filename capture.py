@@ -0,0 +1,193 @@
+"""
+Capture of the UDP traffic of a drone into a compact binary file, and replay of captures into the receive handlers.
+
+File format: ``TCAP`` magic, version (uint8) and the offset of time.time() to time.monotonic() (float64) at the start
+of the capture, followed by records of monotonic timestamp (float64), channel | 0x80 if sent (uint8), length (uint16)
+and the datagram.
+
+    drone.start_capture('flight.tcap')
+    ...
+    drone.stop_capture()
+
+    CaptureReplay('flight.tcap').run(drone.replay_handlers(), speed=10)
+"""
+import logging
+import mmap
+import struct
+import threading
+import time
+
+from utils import PeriodicEmitter
+
+CHANNEL_COMMAND = 0
+CHANNEL_STATE = 1
+CHANNEL_BINARY = 2
+CHANNEL_NAMES = {CHANNEL_COMMAND: 'command', CHANNEL_STATE: 'state', CHANNEL_BINARY: 'binary'}
+
+MAGIC = b'TCAP'
+VERSION = 1
+_FILE_HEADER = struct.Struct('<4sBd')
+_RECORD = struct.Struct('<dBH')
+_SENT = 0x80
+
+
+class CaptureWriter:
+    """
+    Appends records to an in-memory buffer (a lock and a memcpy on the calling thread), a background thread writes
+    the buffer every ``flush_interval`` seconds. If the disk cannot keep up, records beyond ``max_buffer`` bytes are
+    dropped (counted in ``dropped``) instead of growing without bounds or blocking the receivers.
+    """
+
+    def __init__(self, path, flush_interval=0.5, max_buffer=16 * 1024 * 1024):
+        self.path = path
+        self.max_buffer = max_buffer
+        self.records = 0
+        self.bytes = 0
+        self.dropped = 0
+
+        self._file = open(path, 'wb')
+        self._file.write(_FILE_HEADER.pack(MAGIC, VERSION, time.time() - time.monotonic()))
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        # Keeps the order of the writes if flush is called from several threads
+        self._write_lock = threading.Lock()
+        self._flusher = PeriodicEmitter(flush_interval, self.flush)
+        self._flusher.start()
+
+    def record(self, channel, sent, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        header = _RECORD.pack(timestamp, channel | _SENT if sent else channel, len(data))
+        with self._lock:
+            if len(self._buffer) > self.max_buffer:
+                self.dropped += 1
+                return
+            self._buffer += header
+            self._buffer += data
+            self.records += 1
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                buffer, self._buffer = self._buffer, bytearray()
+            if buffer and not self._file.closed:
+                self._file.write(buffer)
+                self._file.flush()
+                self.bytes += len(buffer)
+
+    def close(self):
+        self._flusher.stop()
+        self.flush()
+        with self._write_lock:
+            self._file.close()
+
+    def stats(self):
+        return {'records': self.records, 'bytes': self.bytes, 'dropped': self.dropped}
+
+
+class CaptureReader:
+    """Memory maps a capture, records are (timestamp, channel, sent, data), data is a memoryview into the mapping"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _FILE_HEADER.size:
+            raise ValueError(f'{path} is not a capture file')
+        magic, version, self.wall_offset = _FILE_HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a capture file (version {VERSION})')
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # Records handed out are still referenced, the mapping is closed once they are garbage collected
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        view = memoryview(self._map)
+        n = len(view)
+        pos = _FILE_HEADER.size
+        unpack = _RECORD.unpack_from
+        while n - pos >= _RECORD.size:
+            timestamp, channel, length = unpack(view, pos)
+            start = pos + _RECORD.size
+            if start + length > n:
+                # Truncated by a crash
+                logging.warning(f'Capture {self.path} ends with an incomplete record')
+                break
+            yield timestamp, channel & ~_SENT, bool(channel & _SENT), view[start:start + length]
+            pos = start + length
+
+    def stats(self):
+        """Number of records and bytes per (channel name, 'sent' / 'received'), and the duration in seconds"""
+        counts = {}
+        first = last = None
+        for timestamp, channel, sent, data in self:
+            key = (CHANNEL_NAMES.get(channel, channel), 'sent' if sent else 'received')
+            records, size = counts.get(key, (0, 0))
+            counts[key] = (records + 1, size + len(data))
+            if first is None:
+                first = timestamp
+            last = timestamp
+        return {'records': counts, 'duration': 0.0 if first is None else last - first}
+
+
+class CaptureReplay:
+    """
+    Feeds the received datagrams of a capture into handlers, with the original timing scaled by speed (None for as
+    fast as possible). Handlers map channel -> callable(data), see e.g. :meth:`tello.DroneInterface.replay_handlers`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.replayed = 0
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, handlers, speed=1.0, include_sent=False):
+        """
+        Replays on the calling thread until the end of the capture or :meth:`stop`
+
+        :return: number of datagrams passed to handlers
+        """
+        assert speed is None or speed > 0
+        self._stop.clear()
+        self.replayed = 0
+        start = first = None
+        with CaptureReader(self.path) as reader:
+            for timestamp, channel, sent, data in reader:
+                handler = handlers.get(channel)
+                if handler is None or (sent and not include_sent):
+                    continue
+                if speed is not None:
+                    if first is None:
+                        start, first = time.monotonic(), timestamp
+                    delay = start + (timestamp - first) / speed - time.monotonic()
+                    if delay > 0 and self._stop.wait(delay):
+                        break
+                elif self._stop.is_set():
+                    break
+                try:
+                    handler(bytes(data))
+                except Exception:
+                    logging.exception(f'Replay handler for channel {channel} failed')
+                self.replayed += 1
+            data = None
+        return self.replayed
+
+    def start(self, handlers, speed=1.0, include_sent=False):
+        """Replays on a background thread, see :meth:`run`"""
+        thread = threading.Thread(target=self.run, args=(handlers, speed, include_sent), name='capture-replay')
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,177 @@
+import collections
+import itertools
+import logging
+import threading
+import time
+
+
+def is_query(command):
+    return command.endswith('?')
+
+
+class InFlightCommand:
+    """A sent command waiting for its response. Queries expect values, other commands expect ok / error"""
+    __slots__ = ('command', 'query', 'sent_at', 'received_at', 'response', 'expired', 'expired_at', '_event')
+
+    def __init__(self, command):
+        self.command = command
+        self.query = is_query(command)
+        self.sent_at = time.monotonic()
+        self.received_at = None
+        self.response = None
+        self.expired = False
+        self.expired_at = None
+        self._event = threading.Event()
+
+    def accepts(self, response):
+        if response.startswith('error'):
+            return True
+        return self.query != (response == 'ok')
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+    @property
+    def rtt(self):
+        if self.received_at is None:
+            return None
+        return self.received_at - self.sent_at
+
+
+class CommandTracker:
+    """
+    Keeps track of the commands in flight and matches responses to them by position and expected type (queries get
+    values, other commands get ok / error). At most ``max_in_flight`` commands can be outstanding, further commands
+    block in :meth:`register` until a slot is free.
+
+    Commands that timed out stay in the queue (expired), so that their late response is discarded instead of being
+    matched to another command. As their response may just as well be lost, they only do so for a bounded time: they
+    are dropped ``late_window`` seconds after they expired (by default a multiple of the smoothed round trip time), or
+    as soon as a response arrives that can be the one of a later command of the same kind (it arrives at least half the
+    minimum round trip time after that command was sent).
+    """
+
+    # Default late window: LATE_RTT_FACTOR * smoothed rtt, at least MIN_LATE_WINDOW seconds
+    LATE_RTT_FACTOR = 4
+    MIN_LATE_WINDOW = 0.05
+
+    def __init__(self, max_in_flight=4, history_size=256, late_window=None):
+        self.max_in_flight = max_in_flight
+        self.late_window = late_window
+        self.srtt = None
+        self.min_rtt = None
+        self.late_responses = 0
+        self.unmatched_responses = 0
+        self.timeouts = 0
+        # (command, rtt) of the last completed commands
+        self.history = collections.deque(maxlen=history_size)
+        # Called with (command, rtt) for every completed command, e.g. to feed metrics. Runs under the tracker's lock
+        self.observer = None
+
+        self._in_flight = collections.deque()
+        self._outstanding = 0
+        self._cond = threading.Condition()
+
+    def register(self, command, timeout=None):
+        """Call before sending the command. Blocks while max_in_flight commands are outstanding"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._outstanding < self.max_in_flight, timeout):
+                raise TimeoutError(f'Too many commands in flight, could not send {command}')
+            entry = InFlightCommand(command)
+            self._in_flight.append(entry)
+            self._outstanding += 1
+            return entry
+
+    def expire(self, entry):
+        """Marks a command as timed out, its slot is freed but the late response is still expected"""
+        with self._cond:
+            if entry.expired or entry.response is not None:
+                return
+            entry.expired = True
+            entry.expired_at = time.monotonic()
+            self.timeouts += 1
+            self._release()
+
+    def match(self, response):
+        """
+        Assigns the response to the oldest command in flight that accepts it
+
+        :return: The completed :class:`InFlightCommand`, None if the response was late or unexpected
+        """
+        received_at = time.monotonic()
+        with self._cond:
+            self._drop_expired(received_at)
+            for idx, entry in enumerate(self._in_flight):
+                if entry.accepts(response):
+                    break
+            else:
+                self.unmatched_responses += 1
+                logging.warning(f'Received unexpected Response ({response})')
+                return None
+
+            if entry.expired:
+                # The late response may have been lost, the response can also be the one of a later command
+                for later_idx in range(idx + 1, len(self._in_flight)):
+                    later = self._in_flight[later_idx]
+                    if not later.expired and later.accepts(response):
+                        if self.min_rtt is None or received_at - later.sent_at >= self.min_rtt / 2:
+                            idx, entry = later_idx, later
+                        break
+
+            # Expired commands before the matched one will not receive their response anymore
+            skipped = [e for e in itertools.islice(self._in_flight, idx) if not e.expired]
+            for _ in range(idx + 1):
+                self._in_flight.popleft()
+            self._in_flight.extendleft(reversed(skipped))
+
+            if entry.expired:
+                self.late_responses += 1
+                logging.warning(f'Discarding late Response of timed out Command {entry.command} ({response})')
+                return None
+            entry.response = response
+            entry.received_at = received_at
+            rtt = entry.rtt
+            self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+            self.history.append((entry.command, entry.rtt))
+            if self.observer is not None:
+                self.observer(entry.command, entry.rtt)
+            self._release()
+            entry._event.set()
+            return entry
+
+    def reset(self):
+        """Forgets all commands in flight (e.g. after reconnecting)"""
+        with self._cond:
+            for entry in self._in_flight:
+                if not entry.expired:
+                    entry.expired = True
+                    entry._event.set()
+            self._in_flight.clear()
+            self._outstanding = 0
+            self._cond.notify_all()
+
+    def in_flight(self):
+        """Commands awaiting their response (without the expired ones)"""
+        with self._cond:
+            return self._outstanding
+
+    def _drop_expired(self, now):
+        """Drops expired commands whose late window passed, the caller holds the lock"""
+        window = self.late_window
+        if window is None:
+            window = 1.0 if self.srtt is None else max(self.MIN_LATE_WINDOW, self.LATE_RTT_FACTOR * self.srtt)
+        if any(e.expired and now - e.expired_at > window for e in self._in_flight):
+            self._in_flight = collections.deque(e for e in self._in_flight
+                                                if not e.expired or now - e.expired_at <= window)
+
+    def rtt_stats(self):
+        """min / mean / max round trip time of the commands in history, per command"""
+        stats = {}
+        for command, rtt in list(self.history):
+            stats.setdefault(command.split(' ', 1)[0], []).append(rtt)
+        return {k: {'count': len(v), 'min': min(v), 'mean': sum(v) / len(v), 'max': max(v)} for k, v in stats.items()}
+
+    def _release(self):
+        self._outstanding -= 1
+        self._cond.notify()
@@ -0,0 +1,274 @@
+"""
+Specification of the text SDK commands: name of the method, command template, argument bounds, timeout class,
+response parser and SDK versions.
+
+The methods of :class:`tello.Drone1_3` / :class:`tello.Drone2_0` are generated from this table when the classes are
+defined (:func:`generate`), so they are reused by the asyncio client and the swarm. Each method is compiled from source
+with the argument bounds inlined and the template as an f-string, a call costs the same as a hand written method.
+The simulator parses and validates received commands with the same table (:func:`parse`).
+"""
+import string
+
+from utils import try_to_int
+
+SDK_1_3 = '1.3'
+SDK_2_0 = '2.0'
+SDK_ALL = (SDK_1_3, SDK_2_0)
+
+# Timeout classes: command_timeout, move_timeout or no response expected
+TIMEOUT_COMMAND = 'command'
+TIMEOUT_MOVE = 'move'
+TIMEOUT_NONE = 'none'
+
+MISSION_PADS = tuple(f'm{i}' for i in range(1, 9))
+
+
+class CommandSpec:
+    """
+    :param name: Name of the generated method
+    :param template: Command with the arguments as ``{name}`` placeholders, in the order of the method's arguments
+    :param bounds: {argument: (lower, upper)}, arguments are clamped to the bounds (like :func:`utils.validate_bounds`)
+    :param parser: result_conversion of the response
+    :param check: Called with the (clamped) arguments, raises AssertionError for invalid combinations
+    :param cached: Query answered from the state stream if it is fresh, see :meth:`tello.DroneInterface._query_state`
+    """
+    __slots__ = ('name', 'template', 'params', 'bounds', 'timeout', 'parser', 'sdk', 'check', 'cached', 'keyword',
+                 'words', 'format')
+
+    def __init__(self, name, template, bounds=None, timeout=TIMEOUT_COMMAND, parser=None, sdk=SDK_ALL, check=None,
+                 cached=False):
+        assert timeout in (TIMEOUT_COMMAND, TIMEOUT_MOVE, TIMEOUT_NONE)
+        self.name = name
+        self.template = template
+        self.params = tuple(field for _, field, _, _ in string.Formatter().parse(template) if field)
+        self.bounds = bounds or {}
+        assert set(self.bounds) <= set(self.params), name
+        self.timeout = timeout
+        self.parser = parser
+        self.sdk = sdk
+        self.check = check
+        self.cached = cached
+        self.keyword, *words = template.split()
+        # Per word after the keyword: argument name, or None for a literal (e.g. the l of flip l)
+        self.words = tuple((w[1:-1] if w.startswith('{') else None, w) for w in words)
+        # Compiled function(*args) -> command string
+        self.format = _compile(self, _format_body(self), f'format_{name}', ())
+
+    @property
+    def query(self):
+        return self.keyword.endswith('?')
+
+    def __repr__(self):
+        return f'CommandSpec({self.name!r}, {self.template!r}, sdk={self.sdk})'
+
+
+def _clamp_lines(spec):
+    lines = []
+    for param in spec.params:
+        if param in spec.bounds:
+            lower, upper = spec.bounds[param]
+            lines.append(f'{param} = {lower} if {param} < {lower} else {upper} if {param} > {upper} else {param}')
+    if spec.check is not None:
+        lines.append(f'_check({", ".join(spec.params)})')
+    return lines
+
+
+def _format_body(spec):
+    return _clamp_lines(spec) + [f'return f{spec.template!r}']
+
+
+def _method_body(spec):
+    command = f'f{spec.template!r}'
+    if spec.cached:
+        call = f'self._query_state({command}, result_conversion=_parser)'
+    elif spec.timeout == TIMEOUT_NONE:
+        call = f'self.send_command({command}, none_response=True)'
+    else:
+        timeout = ', self.move_timeout' if spec.timeout == TIMEOUT_MOVE else ''
+        parser = ', result_conversion=_parser' if spec.parser is not None else ''
+        call = f'self.send_command({command}{timeout}{parser})'
+    return _clamp_lines(spec) + [f'return {call}']
+
+
+def _compile(spec, body, name, leading):
+    arguments = ', '.join(leading + spec.params)
+    source = f'def {name}({arguments}):\n' + ''.join(f'    {line}\n' for line in body)
+    namespace = {'_check': spec.check, '_parser': spec.parser}
+    exec(compile(source, f'<command {spec.name}>', 'exec'), namespace)
+    return namespace[name]
+
+
+def _describe(spec):
+    parts = [f'Sends ``{spec.template}``']
+    if spec.bounds:
+        parts.append(', '.join(f'{k} in [{lower}, {upper}]' for k, (lower, upper) in spec.bounds.items()))
+    if spec.timeout == TIMEOUT_MOVE:
+        parts.append('waits up to move_timeout')
+    elif spec.timeout == TIMEOUT_NONE:
+        parts.append('no response expected')
+    if spec.cached:
+        parts.append('answered from the state stream if it is fresh')
+    return ', '.join(parts)
+
+
+def _check_go(x, y, z, *_):
+    assert not all(-20 < i < 20 for i in (x, y, z)), 'x, y and z can not all be between -20 and 20'
+
+
+def _check_jump(x, y, z, speed, yaw, mid1, mid2):
+    _check_go(x, y, z)
+    assert mid1 in MISSION_PADS and mid2 in MISSION_PADS
+
+
+def _check_go_mpd(x, y, z, speed, mid):
+    _check_go(x, y, z)
+    assert mid in MISSION_PADS
+
+
+def _check_curve_mpd(x1, y1, z1, x2, y2, z2, speed, mid):
+    assert mid in MISSION_PADS
+
+
+def _check_rc(a, b, c, d):
+    for x in (a, b, c, d):
+        assert -100 < x < 100
+
+
+def _check_mdirection(x):
+    assert x in range(3)
+
+
+def _moves():
+    for name, keyword in (('move_up', 'up'), ('move_down', 'down'), ('move_left', 'left'), ('move_right', 'right'),
+                          ('move_forward', 'forward'), ('move_backward', 'back')):
+        yield CommandSpec(name, keyword + ' {distance}', {'distance': (20, 500)}, TIMEOUT_MOVE)
+
+
+def _xyz(names, lower, upper):
+    return {name: (lower, upper) for name in names}
+
+
+_GO_1_3 = {**_xyz(('x', 'y', 'z'), 20, 500), 'speed': (10, 100)}
+_GO_2_0 = {**_xyz(('x', 'y', 'z'), -500, 500), 'speed': (10, 100)}
+_CURVE = ('x1', 'y1', 'z1', 'x2', 'y2', 'z2')
+
+SPECS = (
+    CommandSpec('enter_sdk_mode', 'command'),
+    CommandSpec('start_stream', 'streamon'),
+    CommandSpec('stop_stream', 'streamoff'),
+    CommandSpec('take_off', 'takeoff', timeout=TIMEOUT_MOVE),
+    CommandSpec('land', 'land', timeout=TIMEOUT_MOVE),
+    # For some reason does not send any response
+    CommandSpec('emergency', 'emergency', timeout=TIMEOUT_NONE),
+    *_moves(),
+    CommandSpec('clockwise', 'cw {degree}', {'degree': (1, 3600)}, TIMEOUT_MOVE, sdk=(SDK_1_3,)),
+    CommandSpec('counter_clockwise', 'ccw {degree}', {'degree': (1, 3600)}, TIMEOUT_MOVE, sdk=(SDK_1_3,)),
+    CommandSpec('clockwise', 'cw {degree}', {'degree': (1, 360)}, TIMEOUT_MOVE, sdk=(SDK_2_0,)),
+    CommandSpec('counter_clockwise', 'ccw {degree}', {'degree': (1, 360)}, TIMEOUT_MOVE, sdk=(SDK_2_0,)),
+    CommandSpec('flip_left', 'flip l'),
+    CommandSpec('flip_right', 'flip r'),
+    CommandSpec('flip_forward', 'flip f'),
+    CommandSpec('flip_backward', 'flip b'),
+    CommandSpec('go_location', 'go {x} {y} {z} {speed}', _GO_1_3, TIMEOUT_MOVE, sdk=(SDK_1_3,)),
+    CommandSpec('go_location', 'go {x} {y} {z} {speed}', _GO_2_0, TIMEOUT_MOVE, sdk=(SDK_2_0,), check=_check_go),
+    CommandSpec('curve', 'curve {x1} {y1} {z1} {x2} {y2} {z2} {speed}',
+                {**_xyz(_CURVE, 20, 500), 'speed': (10, 60)}, TIMEOUT_MOVE, sdk=(SDK_1_3,)),
+    CommandSpec('curve', 'curve {x1} {y1} {z1} {x2} {y2} {z2} {speed}',
+                {**_xyz(_CURVE, -500, 500), 'speed': (10, 60)}, TIMEOUT_MOVE, sdk=(SDK_2_0,)),
+    CommandSpec('set_speed', 'speed {speed}', {'speed': (10, 100)}),
+    CommandSpec('set_rc', 'rc {a} {b} {c} {d}', check=_check_rc),
+    CommandSpec('set_wifi_password', 'wifi {ssid} {passwd}'),
+    CommandSpec('get_speed', 'speed?', parser=try_to_int),  # Unit: cm/s
+    CommandSpec('get_battery', 'battery?', parser=try_to_int, cached=True),  # Unit: %
+    CommandSpec('get_flight_time', 'time?', parser=try_to_int, cached=True),  # Unit: s
+    CommandSpec('get_height', 'height?', parser=try_to_int, cached=True),  # Unit: dm
+    CommandSpec('get_temp', 'temp?', parser=try_to_int, cached=True),  # Unit: °C
+    CommandSpec('get_attitude', 'attitude?', cached=True),  # IMU Attitude Data
+    CommandSpec('get_barometer', 'baro?', cached=True),  # Unit: m
+    CommandSpec('get_acceleration', 'acceleration?', cached=True),  # Unit: 0.001g
+    CommandSpec('get_tof_distance', 'tof?', cached=True),  # Unit: mm
+    CommandSpec('get_wifi_snr', 'wifi?'),
+    # SDK 2.0 only
+    CommandSpec('stop', 'stop', sdk=(SDK_2_0,)),
+    CommandSpec('start_mpd', 'mon', sdk=(SDK_2_0,)),
+    CommandSpec('stop_mpd', 'moff', sdk=(SDK_2_0,)),
+    CommandSpec('mpd_direction', 'mdirection {x}', sdk=(SDK_2_0,), check=_check_mdirection),
+    CommandSpec('connect_ap', 'ap {ssid} {passwd}', sdk=(SDK_2_0,)),
+    CommandSpec('jump', 'jump {x} {y} {z} {speed} {yaw} {mid1} {mid2}', _GO_2_0, TIMEOUT_MOVE, sdk=(SDK_2_0,),
+                check=_check_jump),
+    CommandSpec('curve_mpd', 'curve {x1} {y1} {z1} {x2} {y2} {z2} {speed} {mid}',
+                {**_xyz(_CURVE, -500, 500), 'speed': (10, 60)}, TIMEOUT_MOVE, sdk=(SDK_2_0,), check=_check_curve_mpd),
+    CommandSpec('go_location_mpd', 'go {x} {y} {z} {speed} {mid}', _GO_2_0, TIMEOUT_MOVE, sdk=(SDK_2_0,),
+                check=_check_go_mpd),
+    CommandSpec('get_sdk_version', 'sdk?', sdk=(SDK_2_0,)),
+    CommandSpec('get_serial_number', 'sn?', sdk=(SDK_2_0,)),
+)
+
+
+def specs(sdk):
+    """:return: {method name: spec} of an SDK version"""
+    return {spec.name: spec for spec in SPECS if sdk in spec.sdk}
+
+
+_BY_SDK = {sdk: specs(sdk) for sdk in SDK_ALL}
+# (sdk, keyword) -> specs, for parsing received commands
+_BY_KEYWORD = {}
+for _sdk in SDK_ALL:
+    for _spec in _BY_SDK[_sdk].values():
+        _BY_KEYWORD.setdefault((_sdk, _spec.keyword), []).append(_spec)
+
+
+def spec(name, sdk=SDK_2_0):
+    return _BY_SDK[sdk][name]
+
+
+def generate(sdk):
+    """
+    Class decorator, adds a method for every spec of the SDK version. Methods defined in the class itself are kept.
+    """
+
+    def _decorator(cls):
+        for name, command in _BY_SDK[sdk].items():
+            if name in cls.__dict__:
+                continue
+            method = _compile(command, _method_body(command), name, ('self',))
+            method.__qualname__ = f'{cls.__qualname__}.{name}'
+            method.__module__ = cls.__module__
+            method.__doc__ = _describe(command)
+            setattr(cls, name, method)
+        return cls
+
+    return _decorator
+
+
+def _to_argument(value):
+    return int(value) if value.lstrip('-').isdigit() else value
+
+
+def parse(command, sdk=SDK_2_0):
+    """
+    Parses and validates a received command. Unlike the generated methods, arguments out of bounds are errors.
+
+    :return: (spec, arguments), None if the command is unknown in the SDK version
+    :raises ValueError: Wrong number of arguments, arguments out of bounds or invalid
+    """
+    keyword, *words = command.split()
+    candidates = _BY_KEYWORD.get((sdk, keyword))
+    if candidates is None:
+        return None
+    for spec in candidates:
+        if len(spec.words) == len(words) and all(p is not None or w == t for (p, t), w in zip(spec.words, words)):
+            break
+    else:
+        raise ValueError(f'Wrong arguments: {command}')
+    args = [_to_argument(w) for (param, _), w in zip(spec.words, words) if param is not None]
+    for param, value in zip(spec.params, args):
+        bounds = spec.bounds.get(param)
+        if bounds is not None and not (isinstance(value, int) and bounds[0] <= value <= bounds[1]):
+            raise ValueError(f'{param} out of bounds: {command}')
+    if spec.check is not None:
+        try:
+            spec.check(*args)
+        except (AssertionError, TypeError) as e:
+            raise ValueError(f'Invalid arguments: {command}') from e
+    return spec, args
@@ -1,5 +1,9 @@
+import concurrent.futures
 import os
 import re
+import sqlite3
+
+from crc import CRC8_TABLE, CRC16_TABLE, crc8, crc16
 
 
 def read_crc_codes(_file):
@@ -19,64 +23,198 @@ def read_crc_codes(_file):
         return codes
 
 
+# cmdId compared (received packets) or assigned (sent packets) in the decompiled sources
+_RE_CMD_ID = re.compile(rb"\bcmdId\s*(==|!=|=)\s*(\d+)|\b(\d+)\s*(==|!=)\s*[\w.]*\bcmdId\b")
+_RE_CLASS = re.compile(rb"\bclass (\w+)")
+_RE_SOURCE = re.compile(rb"/\* compiled from: (.+?) \*/")
+
+
+def scan_file(path):
+    """
+    :return: (class name, compiled from source name, [(cmd_id, line, 'compare' / 'assign')]), names are None if not
+             found
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    if b"cmdId" not in content:
+        return None, None, []
+    classname = _RE_CLASS.search(content)
+    source = _RE_SOURCE.search(content)
+    usages = []
+    line, pos = 1, 0
+    for match in _RE_CMD_ID.finditer(content):
+        line += content.count(b"\n", pos, match.start())
+        pos = match.start()
+        if match.group(2) is not None:
+            cmd_id, kind = match.group(2), "assign" if match.group(1) == b"=" else "compare"
+        else:
+            cmd_id, kind = match.group(3), "compare"
+        usages.append((int(cmd_id), line, kind))
+    return (classname and classname.group(1).decode(), source and source.group(1).decode(errors="replace"),
+            usages)
+
+
+def _scan_file(args):
+    path, stamp = args
+    return path, stamp, scan_file(path)
+
+
 def find_cmd_ids(file_path):
+    """cmd_ids compared per file name in one directory, see :func:`scan_sources` for a whole source tree"""
     dic = {}
-    match_id_compares = re.compile(r"(\.cmdId == \d*)")
-    for file in os.listdir(file_path):
-        with open(os.path.join(file_path, file), "r") as f:
-            content = f.read()
-            for match in re.findall(match_id_compares, content):
-                if file not in dic:
-                    dic[file] = []
-                dic[file].append(int(match[10:]))
+    for file in sorted(os.listdir(file_path)):
+        _, _, usages = scan_file(os.path.join(file_path, file))
+        ids = [cmd_id for cmd_id, _, kind in usages if kind == "compare"]
+        if ids:
+            dic[file] = ids
     return dic
 
 
 def write_cmd_ids(jadx_source_path):
-    package_path = "sources/com/ryzerobotics/tello/gcs/core/cmd/"
+    package_path = os.path.join(jadx_source_path, "sources/com/ryzerobotics/tello/gcs/core/cmd/")
     with open("cmd_ids", "w") as f:
-        re_class = re.compile(r"class (.+) extends e {")
-        re_source = re.compile(r"/\* compiled from: (.+) \*/")
-        for k, v in sorted(list(find_cmd_ids(os.path.join(jadx_source_path, package_path)).items()),
-                           key=lambda it: it[0]):
+        for file in sorted(os.listdir(package_path)):
+            classname, source, usages = scan_file(os.path.join(package_path, file))
+            ids = [str(cmd_id) for cmd_id, _, kind in usages if kind == "compare"]
+            if not ids:
+                continue
             f.write("\n# ===\n")
-            with open(os.path.join(jadx_source_path, package_path, k)) as k_file:
-                contents = k_file.read()
-                classname = re.search(re_class, contents).group(1)
-                source = re.search(re_source, contents).group(1)
-                f.write("Class: ")
-                f.write(classname)
-                f.write("\nSource: ")
-                f.write(source)
-                f.write("\n")
-                f.write("\n".join(v))
-                f.write("\n")
+            f.write(f"Class: {classname}\nSource: {source}\n")
+            f.write("\n".join(ids))
+            f.write("\n")
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, class TEXT, source TEXT);
+CREATE TABLE IF NOT EXISTS usages (path TEXT, cmd_id INTEGER, line INTEGER, kind TEXT);
+CREATE INDEX IF NOT EXISTS usages_cmd_id ON usages (cmd_id);
+CREATE INDEX IF NOT EXISTS usages_path ON usages (path);
+"""
+
+
+def _java_files(root):
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".java"):
+                    stat = entry.stat()
+                    yield entry.path, (stat.st_mtime_ns, stat.st_size)
+
+
+def _scan_files(files, processes):
+    # Starting the pool costs more than scanning a few files
+    if len(files) < 256:
+        yield from map(_scan_file, files)
+        return
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        yield from pool.map(_scan_file, files, chunksize=64)
+
+
+def scan_sources(root, database, processes=None):
+    """
+    Scans a Jadx output recursively for cmd_id usages into a SQLite database. Files whose mtime and size did not
+    change since the last scan into the same database are not read again, the others are scanned by a process pool.
+
+    :return: (files scanned, files unchanged, files removed)
+    """
+    root = os.path.abspath(root)
+    db = sqlite3.connect(database)
+    try:
+        db.executescript(_SCHEMA)
+        known = {path: (mtime, size) for path, mtime, size in db.execute("SELECT path, mtime_ns, size FROM files")}
+        files = {os.path.relpath(path, root): (path, stamp) for path, stamp in _java_files(root)}
+        changed = [(path, stamp) for rel, (path, stamp) in files.items() if known.get(rel) != stamp]
+        removed = [(rel,) for rel in known if rel not in files]
+
+        with db:
+            db.executemany("DELETE FROM files WHERE path = ?", removed)
+            db.executemany("DELETE FROM usages WHERE path = ?", removed)
+            for path, (mtime, size), (classname, source, usages) in _scan_files(changed, processes):
+                rel = os.path.relpath(path, root)
+                db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (rel, mtime, size, classname, source))
+                db.execute("DELETE FROM usages WHERE path = ?", (rel,))
+                db.executemany("INSERT INTO usages VALUES (?, ?, ?, ?)",
+                               [(rel, cmd_id, line, kind) for cmd_id, line, kind in usages])
+        return len(changed), len(files) - len(changed), len(removed)
+    finally:
+        db.close()
+
+
+def load_cmd_ids(database):
+    """:return: {cmd_id: [(class, source, path, line, kind)]} from a database of :func:`scan_sources`"""
+    db = sqlite3.connect(database)
+    try:
+        rows = db.execute("SELECT u.cmd_id, f.class, f.source, u.path, u.line, u.kind FROM usages u "
+                          "JOIN files f ON f.path = u.path ORDER BY u.cmd_id, u.path, u.line").fetchall()
+    finally:
+        db.close()
+    cmd_ids = {}
+    for cmd_id, *usage in rows:
+        cmd_ids.setdefault(cmd_id, []).append(tuple(usage))
+    return cmd_ids
+
+
+def diff_cmd_ids(old_database, new_database):
+    """
+    Compares two app versions. Obfuscated class names change between releases, usages are compared by the source
+    name the class was compiled from (the class name if unknown).
+
+    :return: {'added': {cmd_id: sources}, 'removed': {cmd_id: sources}, 'changed': {cmd_id: (old, new sources)}}
+    """
+
+    def sources(database):
+        return {cmd_id: sorted({source or classname for classname, source, *_ in usages})
+                for cmd_id, usages in load_cmd_ids(database).items()}
+
+    old, new = sources(old_database), sources(new_database)
+    return {
+        "added": {k: new[k] for k in sorted(new.keys() - old.keys())},
+        "removed": {k: old[k] for k in sorted(old.keys() - new.keys())},
+        "changed": {k: (old[k], new[k]) for k in sorted(old.keys() & new.keys()) if old[k] != new[k]},
+    }
 
 
 jadx_source_path = "/home/jaqxues/CodeProjects/Tello_1.1.1_Sources/"
 
-CODES_CRC8 = read_crc_codes("codes_crc8")
-CODES_CRC16 = read_crc_codes("codes_crc16")
+# Tables are shipped precompiled in crc.py, use read_crc_codes to check them against the smali dumps
+CODES_CRC8 = CRC8_TABLE
+CODES_CRC16 = CRC16_TABLE
 
 
 # Algorithm found in com.ryzerobotics.tello.gcs.core.a
 def calc_crc16(buf, size):
-    i = 0
-    code = 13970  # public static int a
-    while size > 0:
-        code = CODES_CRC16[(code ^ buf[i]) & 0xff] ^ (code >> 8)
-        i += 1
-        size -= 1
-    return code
+    return crc16(buf, 0, size)
 
 
 # Algorithm found in com.ryzerobotics.tello.gcs.core.b
 def calc_crc8(buf, size):
-    i = 0
-    code = 119
-    while size > 0:
-        code = CODES_CRC8[(code ^ buf[i]) & 0xff]
-        i += 1
-        size -= 1
-
-    return code
+    return crc8(buf, 0, size)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="cmd_id usages in decompiled (Jadx) app sources")
+    sub = parser.add_subparsers(dest="mode", required=True)
+    scan_parser = sub.add_parser("scan", help="Scan (or rescan changed files of) a source tree into a database")
+    scan_parser.add_argument("root")
+    scan_parser.add_argument("database")
+    scan_parser.add_argument("--processes", type=int)
+    dump_parser = sub.add_parser("dump", help="Print the cmd_ids of a database as JSON")
+    dump_parser.add_argument("database")
+    diff_parser = sub.add_parser("diff", help="Compare the databases of two app versions")
+    diff_parser.add_argument("old")
+    diff_parser.add_argument("new")
+    args = parser.parse_args()
+
+    if args.mode == "scan":
+        scanned, unchanged, removed = scan_sources(args.root, args.database, args.processes)
+        print(f"{scanned} files scanned, {unchanged} unchanged, {removed} removed")
+    elif args.mode == "dump":
+        print(json.dumps(load_cmd_ids(args.database), indent=2))
+    else:
+        print(json.dumps(diff_cmd_ids(args.old, args.new), indent=2))
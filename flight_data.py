@@ -0,0 +1,146 @@
+"""
+Typed records of the binary packets sent by the drone (AdvancedTello). Decoders take the packet data and return a
+record, None if the data is too short.
+
+Layouts were reverse engineered from the Tello App (see ``cmd_ids``) and cross-checked with the TelloPy project.
+"""
+import struct
+
+CMD_ID_WIFI = 26
+CMD_ID_LIGHT = 53
+CMD_ID_FLIGHT_DATA = 86
+CMD_ID_LOG_HEADER = 4176
+CMD_ID_LOG_DATA = 4177
+
+_FLIGHT_DATA = struct.Struct('<hhhhhBBBhhBBBBBB')
+_LOG_RECORD_HEADER = struct.Struct('<BBBBHB')  # 'U', length, 0, crc8, record id, xor key
+_LOG_RECORD_PAYLOAD = 10  # Offset of the (xor encoded) payload in a log record
+_MVO = struct.Struct('<2x3h3f')
+_IMU = struct.Struct('<20x6f4x4f12x3f')
+_IMU_TEMPERATURE = struct.Struct('<106xh')
+
+LOG_RECORD_MVO = 0x001d
+LOG_RECORD_IMU = 0x0800
+# bytes.translate tables to xor decode log records per key
+_XOR_TABLES = [bytes(b ^ key for b in range(256)) for key in range(256)]
+
+
+class Record:
+    """Base class of the records, fields are the slots (in packet order)"""
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f'{type(self).__name__}({", ".join(f"{k}={v!r}" for k, v in self.as_dict().items())})'
+
+
+class WifiInfo(Record):
+    __slots__ = ('strength', 'disturb')
+
+
+class LightInfo(Record):
+    __slots__ = ('strength',)
+
+
+class FlightData(Record):
+    """
+    Units: height in dm, speeds in dm/s, fly_time and fly_time_left in 0.1 s, battery_percentage in %. Flags are bools.
+    """
+    __slots__ = ('height', 'north_speed', 'east_speed', 'ground_speed', 'fly_time', 'imu_state', 'pressure_state',
+                 'down_visual_state', 'power_state', 'battery_state', 'gravity_state', 'wind_state',
+                 'imu_calibration_state', 'battery_percentage', 'battery_left', 'fly_time_left', 'em_sky', 'em_ground',
+                 'em_open', 'drone_hover', 'outage_recording', 'battery_low', 'battery_lower', 'factory_mode',
+                 'fly_mode', 'throw_fly_timer', 'camera_state', 'electrical_machinery_state', 'front_in', 'front_out',
+                 'front_lsc', 'temperature_height')
+
+
+class LogHeader(Record):
+    __slots__ = ('log_id',)
+
+
+class MvoData(Record):
+    """Visual odometry: velocities (raw units) and position in m relative to the take off point"""
+    __slots__ = ('vel_x', 'vel_y', 'vel_z', 'pos_x', 'pos_y', 'pos_z')
+
+
+class ImuData(Record):
+    """Accelerations in g, angular rates in rad/s, attitude quaternion, velocities in m/s, temperature (raw units)"""
+    __slots__ = ('acc_x', 'acc_y', 'acc_z', 'gyro_x', 'gyro_y', 'gyro_z', 'q0', 'q1', 'q2', 'q3', 'vg_x', 'vg_y',
+                 'vg_z', 'temperature')
+
+
+class LogData(Record):
+    """Records of one log packet, mvo / imu are None if the packet did not contain them"""
+    __slots__ = ('mvo', 'imu', 'unknown')
+
+
+def _flags(byte, bits):
+    return tuple(bool(byte >> bit & 1) for bit in bits)
+
+
+def decode_wifi(data):
+    if len(data) < 2:
+        return None
+    return WifiInfo(data[0], data[1])
+
+
+def decode_light(data):
+    if len(data) < 1:
+        return None
+    return LightInfo(data[0])
+
+
+def decode_flight_data(data):
+    if len(data) < _FLIGHT_DATA.size:
+        return None
+    (height, north_speed, east_speed, ground_speed, fly_time, states, imu_calibration_state, battery_percentage,
+     battery_left, fly_time_left, emergencies, fly_mode, throw_fly_timer, camera_state, electrical_machinery_state,
+     front) = _FLIGHT_DATA.unpack_from(data)
+    temperature_height = bool(data[_FLIGHT_DATA.size] & 1) if len(data) > _FLIGHT_DATA.size else None
+    return FlightData(height, north_speed, east_speed, ground_speed, fly_time, *_flags(states, (0, 1, 2, 3, 4, 5, 7)),
+                      imu_calibration_state, battery_percentage, battery_left, fly_time_left,
+                      *_flags(emergencies, range(8)), fly_mode, throw_fly_timer, camera_state,
+                      electrical_machinery_state, *_flags(front, range(3)), temperature_height)
+
+
+def decode_log_header(data):
+    if len(data) < 2:
+        return None
+    return LogHeader(data[0] | data[1] << 8)
+
+
+def decode_log_data(data):
+    """Log packets contain a sequence of records, each starting with 'U' and xor encoded with a per record key"""
+    mvo = imu = None
+    unknown = 0
+    pos = 1
+    n = len(data)
+    while n - pos >= _LOG_RECORD_PAYLOAD:
+        magic, length, zero, _, record_id, key = _LOG_RECORD_HEADER.unpack_from(data, pos)
+        if magic != 0x55 or zero != 0 or length < _LOG_RECORD_PAYLOAD + 2 or pos + length > n:
+            break
+        if record_id == LOG_RECORD_MVO or record_id == LOG_RECORD_IMU:
+            payload = bytes(data[pos + _LOG_RECORD_PAYLOAD:pos + length - 2]).translate(_XOR_TABLES[key])
+            if record_id == LOG_RECORD_MVO and len(payload) >= _MVO.size:
+                mvo = MvoData(*_MVO.unpack_from(payload))
+            elif record_id == LOG_RECORD_IMU and len(payload) >= _IMU_TEMPERATURE.size:
+                imu = ImuData(*_IMU.unpack_from(payload), *_IMU_TEMPERATURE.unpack_from(payload))
+        else:
+            unknown += 1
+        pos += length
+    return LogData(mvo, imu, unknown)
+
+
+DECODERS = {
+    CMD_ID_WIFI: decode_wifi,
+    CMD_ID_LIGHT: decode_light,
+    CMD_ID_FLIGHT_DATA: decode_flight_data,
+    CMD_ID_LOG_HEADER: decode_log_header,
+    CMD_ID_LOG_DATA: decode_log_data,
+}
@@ -0,0 +1,272 @@
+"""
+Low overhead metrics of a drone connection: counters are locked increments and histograms plain attribute increments
+on the hot path, gauges (and counters kept elsewhere, e.g. in :class:`command_tracker.CommandTracker`) are only read
+when collected.
+
+    server = metrics.serve([drone.metrics, advanced.metrics], port=9464)  # http://127.0.0.1:9464/metrics
+    print(drone.metrics.snapshot())
+"""
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+# Seconds, suited for round trip times from a few ms (queries) up to moves
+DEFAULT_BUCKETS = (0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0)
+
+
+class Counter:
+    """Incremented from several threads (senders, receivers, the scheduler), ``+=`` alone would lose updates"""
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate (upper bound of the bucket containing the quantile), None if empty"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def value(self):
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip(self.bounds + (float('inf'),), cumulative)),
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class _Family:
+    __slots__ = ('name', 'type', 'help', 'children', 'function')
+
+    def __init__(self, name, type, help, function=None):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.children = {}  # labels (tuple of pairs) -> Counter / Histogram / function
+        self.function = function
+
+
+class MetricsRegistry:
+    """
+    Named metric families with labels. The registry's own labels (e.g. drone) are added to every sample on export.
+
+    Getting a metric (:meth:`counter`, :meth:`histogram`) takes a lock, callers keep the returned object and only
+    increment it on the hot path.
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _family(self, name, type, help):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = _Family(name, type, help)
+        elif family.type != type:
+            raise ValueError(f'Metric {name} is a {family.type}, not a {type}')
+        return family
+
+    def counter(self, name, help='', **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._family(name, 'counter', help)
+            metric = family.children.get(key)
+            if metric is None:
+                metric = family.children[key] = Counter()
+            return metric
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._family(name, 'histogram', help)
+            metric = family.children.get(key)
+            if metric is None:
+                metric = family.children[key] = Histogram(buckets)
+            return metric
+
+    def gauge(self, name, function, help='', type='gauge', **labels):
+        """
+        Registers a metric whose value is read from function() on collection (None values are skipped). type can be
+        'counter' for totals counted elsewhere.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._family(name, type, help).children[key] = function
+
+    def collector(self, name, function, help='', type='counter'):
+        """Registers a function returning {labels dict as tuple of pairs: value} (for dynamic label sets)"""
+        with self._lock:
+            family = self._family(name, type, help)
+            family.function = function
+
+    def collect(self):
+        """:return: list of (name, type, help, [(labels dict, value)])"""
+        with self._lock:
+            families = [(f.name, f.type, f.help, list(f.children.items()), f.function)
+                        for f in self._families.values()]
+        result = []
+        for name, type, help, children, function in families:
+            samples = []
+            items = children
+            if function is not None:
+                try:
+                    items = items + list(function().items())
+                except Exception:
+                    logging.exception(f'Collecting metric {name} failed')
+            for key, metric in items:
+                if isinstance(metric, (Counter, Histogram)):
+                    value = metric.value() if isinstance(metric, Histogram) else metric.value
+                elif callable(metric):
+                    try:
+                        value = metric()
+                    except Exception:
+                        logging.exception(f'Collecting metric {name} failed')
+                        continue
+                else:
+                    value = metric
+                if value is not None:
+                    samples.append(({**self.labels, **dict(key)}, value))
+            result.append((name, type, help, samples))
+        return result
+
+    def snapshot(self):
+        """
+        :return: {name: value} for metrics without labels, {name: {label string: value}} otherwise. Histogram values
+                 are dicts of count, sum, cumulative buckets and p50 / p99 estimates.
+        """
+        snapshot = {}
+        for name, _, _, samples in self.collect():
+            # Only the labels of the metric, the registry's own labels are the same for all
+            samples = [({k: v for k, v in labels.items() if k not in self.labels}, value) for labels, value in samples]
+            if len(samples) == 1 and not samples[0][0]:
+                snapshot[name] = samples[0][1]
+            else:
+                snapshot[name] = {','.join(f'{k}={v}' for k, v in sorted(labels.items())): value
+                                  for labels, value in samples}
+        return snapshot
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels.items()) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in items) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def to_prometheus(registries):
+    """Prometheus text exposition format of one or several registries (families of the same name are merged)"""
+    if isinstance(registries, MetricsRegistry):
+        registries = [registries]
+    families = {}
+    for registry in registries:
+        for name, type, help, samples in registry.collect():
+            family = families.setdefault(name, (type, help, []))
+            family[2].extend(samples)
+
+    lines = []
+    for name, (type, help, samples) in families.items():
+        if help:
+            lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {type}')
+        for labels, value in samples:
+            if type == 'histogram':
+                for bound, count in value['buckets'].items():
+                    lines.append(f'{name}_bucket{_format_labels(labels, ("le", _format_value(bound)))} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value["sum"])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value["count"]}')
+            else:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class RateGauge:
+    """Gauge function for the rate of a total (e.g. a counter's value) per second since the previous collection"""
+
+    def __init__(self, total):
+        self.total = total
+        self._last = (time.monotonic(), total())
+
+    def __call__(self):
+        now, value = time.monotonic(), self.total()
+        last_time, last_value = self._last
+        self._last = (now, value)
+        if now - last_time <= 0:
+            return None
+        return (value - last_value) / (now - last_time)
+
+
+def serve(registries, port=9464, host='127.0.0.1'):
+    """
+    Serves the registries in the Prometheus text format on http://host:port/metrics from a daemon thread.
+
+    :param registries: Registry, list of registries or a function returning such a list (for drones added later)
+    :return: The server, stop with ``server.shutdown()``
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = to_prometheus(registries() if callable(registries) else registries).encode(encoding='utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(f'Metrics request: {format % args}')
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,324 @@
+"""
+Flight plans for :class:`tello.Drone2_0` (and Drone1_3). The plan is built and validated upfront, then executed on a
+thread of its own: each command is sent as soon as the response of the previous one arrives, the deadline of each
+step is its predicted duration plus a margin (instead of ``move_timeout``) and telemetry comes from the state stream
+instead of queries.
+
+    mission = Mission(drone).take_off().forward(100).clockwise(90).go(100, 50, 0, 50).land()
+    mission.abort_if(lambda state: state.bat < 15, 'battery low')
+    print(mission.predicted_duration())
+    result = mission.run()
+
+A failed step (error response or missed deadline), a true abort condition or :meth:`Mission.abort` stops the drone
+(``stop``) and lands it.
+"""
+import logging
+import math
+import threading
+import time
+
+import commands
+
+# Predicted durations in s, rotation in °/s
+TAKE_OFF_DURATION = 5.0
+LAND_DURATION = 5.0
+FLIP_DURATION = 2.0
+YAW_RATE = 90.0
+DEFAULT_SPEED = 100  # cm/s until a speed step, as reported by speed? after take off
+
+_MOVES = {'up': 'move_up', 'down': 'move_down', 'left': 'move_left', 'right': 'move_right', 'forward': 'move_forward',
+          'back': 'move_backward'}
+
+
+class MissionStep:
+    """A command (or a local step with command None) and its predicted duration in s"""
+    __slots__ = ('command', 'duration', 'action', 'flying')
+
+    def __init__(self, command, duration=0.0, action=None, flying=None):
+        self.command = command
+        self.duration = duration
+        # Local step, called with (mission, deadline in s), returns an error message or None
+        self.action = action
+        # True / False if the step requires the drone to be flying / landed
+        self.flying = flying
+
+    def __repr__(self):
+        return f'MissionStep({self.command or self.action.__name__!r}, {self.duration:.1f} s)'
+
+
+class StepResult:
+    __slots__ = ('step', 'response', 'started_at', 'completed_at', 'state')
+
+    def __init__(self, step, started_at):
+        self.step = step
+        self.response = None
+        self.started_at = started_at
+        self.completed_at = None
+        # Latest state when the step completed
+        self.state = None
+
+    @property
+    def duration(self):
+        return None if self.completed_at is None else self.completed_at - self.started_at
+
+    def __repr__(self):
+        duration = 'n/a' if self.duration is None else f'{self.duration:.2f} s'
+        name = self.step.command or self.step.action.__name__
+        return f'StepResult({name!r}, {self.response!r}, {duration} / {self.step.duration:.2f} s)'
+
+
+class MissionResult:
+    def __init__(self):
+        self.steps = []
+        self.started_at = time.monotonic()
+        self.completed_at = None
+        self.completed = False
+        self.aborted = None  # Reason of the abort
+
+    @property
+    def duration(self):
+        return (self.completed_at or time.monotonic()) - self.started_at
+
+    def dead_time(self):
+        """Time between the end of a step and the start of the next one, summed up over the mission"""
+        steps = [s for s in self.steps if s.completed_at is not None]
+        return sum(b.started_at - a.completed_at for a, b in zip(steps, steps[1:]))
+
+    def __repr__(self):
+        status = 'completed' if self.completed else f'aborted ({self.aborted})'
+        return f'MissionResult({status}, {len(self.steps)} steps, {self.duration:.2f} s)'
+
+
+class Mission:
+    """
+    Builder and executor of a flight plan. Builder methods validate (and clamp) their arguments with the rules of the
+    drone's SDK version and return the mission, so calls can be chained.
+
+    :param margin: Seconds added to the predicted duration of each step for its deadline (response latency, slow
+                   acceleration), defaults to the drone's command_timeout
+    :param slack: Factor for predicted durations, > 1 for drones slower than the prediction
+    :param on_abort: 'land' (stop, then land) or 'stop' (hover)
+    """
+
+    def __init__(self, drone, margin=None, slack=1.5, on_abort='land'):
+        assert on_abort in ('land', 'stop')
+        self.drone = drone
+        self.margin = drone.command_timeout if margin is None else margin
+        self.slack = slack
+        self.on_abort = on_abort
+        self.steps = []
+        self.result = None
+        self._specs = commands.specs(drone.get_sdk_name())
+        self._speed = DEFAULT_SPEED
+        self._conditions = []
+        self._abort_reason = None
+        self._abort = threading.Event()
+        self._thread = None
+
+    def _format(self, name, *args):
+        """:return: command and its (validated) arguments"""
+        command = self._specs[name].format(*args)
+        return command, [int(a) for a in command.split()[1:]]
+
+    def _add(self, command, duration=0.0, flying=True):
+        self.steps.append(MissionStep(command, duration, flying=flying))
+        return self
+
+    # Plan
+
+    def take_off(self):
+        return self._add('takeoff', TAKE_OFF_DURATION, flying=False)
+
+    def land(self):
+        return self._add('land', LAND_DURATION)
+
+    def set_speed(self, speed):
+        command, (self._speed,) = self._format('set_speed', speed)
+        return self._add(command, flying=None)
+
+    def move(self, direction, distance):
+        command, (distance,) = self._format(_MOVES[direction], distance)
+        return self._add(command, distance / self._speed)
+
+    def up(self, distance):
+        return self.move('up', distance)
+
+    def down(self, distance):
+        return self.move('down', distance)
+
+    def left(self, distance):
+        return self.move('left', distance)
+
+    def right(self, distance):
+        return self.move('right', distance)
+
+    def forward(self, distance):
+        return self.move('forward', distance)
+
+    def back(self, distance):
+        return self.move('back', distance)
+
+    def clockwise(self, degree):
+        command, (degree,) = self._format('clockwise', degree)
+        return self._add(command, degree / YAW_RATE)
+
+    def counter_clockwise(self, degree):
+        command, (degree,) = self._format('counter_clockwise', degree)
+        return self._add(command, degree / YAW_RATE)
+
+    def flip(self, direction):
+        assert direction in ('l', 'r', 'f', 'b')
+        return self._add(f'flip {direction}', FLIP_DURATION)
+
+    def go(self, x, y, z, speed):
+        command, (x, y, z, speed) = self._format('go_location', x, y, z, speed)
+        return self._add(command, math.sqrt(x * x + y * y + z * z) / speed)
+
+    def curve(self, x1, y1, z1, x2, y2, z2, speed):
+        command, (x1, y1, z1, x2, y2, z2, speed) = self._format('curve', x1, y1, z1, x2, y2, z2, speed)
+        length = math.dist((0, 0, 0), (x1, y1, z1)) + math.dist((x1, y1, z1), (x2, y2, z2))
+        return self._add(command, length / speed)
+
+    def hover(self, seconds):
+        """Waits without sending anything (keep it below 15 s, the drone lands after 15 s without a command)"""
+
+        def hover(mission, timeout):
+            return 'aborted' if mission._abort.wait(seconds) else None
+
+        self.steps.append(MissionStep(None, seconds, hover, flying=True))
+        return self
+
+    def wait_for(self, predicate, timeout=10.0):
+        """Waits until predicate(state) is true for a received state, e.g. ``lambda s: s.h >= 100``"""
+
+        def wait_for(mission, _):
+            subscription = mission.drone.subscribe_state()
+            try:
+                deadline = time.monotonic() + timeout
+                while not mission._abort.is_set():
+                    latest = subscription.get(min(0.05, max(0.0, deadline - time.monotonic())))
+                    if latest is not None and predicate(latest[0]):
+                        return None
+                    if time.monotonic() >= deadline:
+                        return f'condition not met within {timeout} s'
+                return 'aborted'
+            finally:
+                mission.drone.unsubscribe_state(subscription)
+
+        self.steps.append(MissionStep(None, 0.0, wait_for))
+        return self
+
+    def abort_if(self, predicate, reason='abort condition'):
+        """Aborts the mission as soon as predicate(state) is true for a received state"""
+        self._conditions.append((predicate, reason))
+        return self
+
+    def validate(self):
+        """Checks the order of the steps (nothing is flown before take off or after landing)"""
+        if not self.steps:
+            raise ValueError('Mission has no steps')
+        flying = False
+        for i, step in enumerate(self.steps):
+            if step.flying is not None and step.flying != flying:
+                raise ValueError(f'Step {i} ({step.command}) requires the drone to be '
+                                 f'{"flying" if step.flying else "landed"}')
+            if step.command == 'takeoff':
+                flying = True
+            elif step.command == 'land':
+                flying = False
+        return self
+
+    def predicted_duration(self):
+        return sum(step.duration for step in self.steps)
+
+    # Execution
+
+    def run(self):
+        """Flies the mission on the calling thread, :return: :class:`MissionResult`"""
+        self.validate()
+        self._abort.clear()
+        self._abort_reason = None
+        self.result = result = MissionResult()
+        drone = self.drone
+        watcher = drone.subscribe_state(self._check_conditions) if self._conditions else None
+        try:
+            for step in self.steps:
+                if self._abort.is_set():
+                    break
+                error = self._run_step(step, result)
+                if error is not None:
+                    self._abort_reason = self._abort_reason or error
+                    break
+            else:
+                result.completed = not self._abort.is_set()
+        finally:
+            if watcher is not None:
+                drone.unsubscribe_state(watcher)
+        if not result.completed:
+            result.aborted = self._abort_reason or 'aborted'
+            logging.error(f'Mission aborted: {result.aborted}')
+            self._stop_drone()
+        result.completed_at = time.monotonic()
+        return result
+
+    def start(self):
+        """Flies the mission on a background thread, see :meth:`wait` and :meth:`abort`"""
+        self.validate()
+        self._thread = threading.Thread(target=self.run, name='mission')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """:return: :class:`MissionResult` of a started mission, None if it is still running"""
+        self._thread.join(timeout)
+        return None if self._thread.is_alive() else self.result
+
+    def abort(self, reason='aborted by user'):
+        """Aborts the running mission (the step in flight is stopped, then the drone lands), does not block"""
+        if self._abort_reason is None:
+            self._abort_reason = reason
+        self._abort.set()
+
+    def _check_conditions(self, state, received_at):
+        # Receiver thread, only flag the abort
+        for predicate, reason in self._conditions:
+            if predicate(state):
+                self.abort(reason)
+
+    def _run_step(self, step, result):
+        """:return: error message, None on success"""
+        drone = self.drone
+        record = StepResult(step, time.monotonic())
+        result.steps.append(record)
+        deadline = step.duration * self.slack + self.margin
+        if step.action is not None:
+            error = step.action(self, deadline)
+        else:
+            entry = drone.commands.register(step.command)
+            drone._send(step.command)
+            deadline += record.started_at
+            # Wakes up immediately on the response, the slices only bound the reaction time to abort
+            while not entry.wait(min(0.05, max(0.0, deadline - time.monotonic()))):
+                if self._abort.is_set() or time.monotonic() >= deadline:
+                    break
+            record.response = entry.response
+            if entry.response is None:
+                drone.commands.expire(entry)
+                error = 'aborted' if self._abort.is_set() else f'no response for {step.command} in time'
+            elif entry.response != 'ok':
+                error = f'{step.command} failed ({entry.response})'
+            else:
+                error = None
+        record.completed_at = time.monotonic()
+        record.state = drone.state
+        return error
+
+    def _stop_drone(self):
+        drone = self.drone
+        # Commands of the mission still in flight would swallow the responses
+        drone.commands.reset()
+        if drone.get_sdk_name() != '1.3':
+            drone.send_command('stop', self.margin)
+        if self.on_abort == 'land':
+            drone.send_command('land', drone.move_timeout)
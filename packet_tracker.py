@@ -0,0 +1,231 @@
+"""
+Reliable delivery of binary packets (AdvancedTello take off, land, flip): the drone acknowledges them with a packet of
+the same cmd_id and seq_num. Unacknowledged packets are sent again (same seq_num) after a retransmission timeout
+derived from the measured round trip times (RFC 6298: SRTT / RTTVAR, Karn's algorithm, exponential backoff), until
+``max_retries`` retransmissions were sent.
+
+    future = tello.land()
+    if not future.result(10):
+        print('land was not acknowledged', future.packet)
+"""
+import concurrent.futures
+import logging
+import threading
+import time
+
+
+class PendingPacket:
+    """A sent packet waiting for its acknowledgement"""
+    __slots__ = ('cmd_id', 'seq', 'raw', 'max_retries', 'future', 'sent_at', 'last_sent_at', 'attempts',
+                 'acked_at', 'ack_data', 'task')
+
+    def __init__(self, cmd_id, seq, raw, max_retries, future):
+        self.cmd_id = cmd_id
+        self.seq = seq
+        self.raw = raw
+        self.max_retries = max_retries
+        self.future = future
+        self.sent_at = self.last_sent_at = time.monotonic()
+        self.attempts = 1
+        self.acked_at = None
+        self.ack_data = None
+        # Retransmission scheduled on the scheduler
+        self.task = None
+
+    @property
+    def rtt(self):
+        """Time from the last transmission to the acknowledgement"""
+        if self.acked_at is None:
+            return None
+        return self.acked_at - self.last_sent_at
+
+    def __repr__(self):
+        status = 'pending' if self.future is None or not self.future.done() else \
+            'acked' if self.acked_at is not None else 'failed'
+        return f'PendingPacket(cmd_id={self.cmd_id}, seq={self.seq}, {status}, {self.attempts} attempt(s))'
+
+
+class _DeliveryStats:
+    __slots__ = ('sent', 'retransmissions', 'acked', 'failed', 'rtt_sum', 'rtt_count')
+
+    def __init__(self):
+        self.sent = 0
+        self.retransmissions = 0
+        self.acked = 0
+        self.failed = 0
+        self.rtt_sum = 0.0
+        self.rtt_count = 0
+
+
+class PacketTracker:
+    """
+    Keeps the packets awaiting an acknowledgement by (cmd_id, seq_num) and schedules their retransmissions on a
+    :class:`scheduler.Scheduler`. Results are :class:`concurrent.futures.Future` of True (acknowledged) or False (no
+    acknowledgement after all retransmissions), with the :class:`PendingPacket` as ``future.packet``.
+
+    :param transmit: Called with the raw bytes to send a packet again (on the scheduler thread, must not block)
+    :param initial_rto: Retransmission timeout in s until the first round trip time was measured
+    """
+
+    # RFC 6298 gains
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, transmit, scheduler, initial_rto=1.0, min_rto=0.2, max_rto=4.0, max_retries=5):
+        self.transmit = transmit
+        self.scheduler = scheduler
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.max_retries = max_retries
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.duplicate_acks = 0
+        self.unmatched_acks = 0
+
+        self._pending = {}  # (cmd_id, seq) -> PendingPacket
+        self._stats = {}  # cmd_id -> _DeliveryStats
+        self._lock = threading.Lock()
+
+    def _stats_of(self, cmd_id):
+        stats = self._stats.get(cmd_id)
+        if stats is None:
+            stats = self._stats[cmd_id] = _DeliveryStats()
+        return stats
+
+    def track(self, cmd_id, seq, raw, max_retries=None):
+        """
+        Call right before the first transmission of raw, so that the acknowledgement cannot overtake it
+
+        :return: Future of the delivery
+        """
+        future = concurrent.futures.Future()
+        entry = PendingPacket(cmd_id, seq & 0xffff, bytes(raw), self.max_retries if max_retries is None
+                              else max_retries, future)
+        future.packet = entry
+        with self._lock:
+            previous = self._pending.pop((cmd_id, entry.seq), None)
+            self._pending[(cmd_id, entry.seq)] = entry
+            self._stats_of(cmd_id).sent += 1
+            entry.task = self.scheduler.call_later(self.rto, self._on_timeout, entry, name=f'retransmit {cmd_id}')
+        if previous is not None:
+            # seq_num wrapped around while the old packet was still pending
+            self._give_up(previous)
+        return future
+
+    def acknowledge(self, cmd_id, seq, data=None):
+        """Call for every received packet that may be an acknowledgement. :return: the acknowledged PendingPacket"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._pending.pop((cmd_id, seq), None)
+            if entry is None:
+                # Late ack of a retransmitted (or given up) packet
+                if cmd_id in self._stats:
+                    self.duplicate_acks += 1
+                else:
+                    self.unmatched_acks += 1
+                return None
+            self.scheduler.cancel(entry.task)
+            entry.acked_at = now
+            entry.ack_data = None if data is None else bytes(data)
+            stats = self._stats_of(cmd_id)
+            stats.acked += 1
+            # Karn's algorithm: the ack of a retransmitted packet can belong to any of its transmissions
+            if entry.attempts == 1:
+                self._update_rto(now - entry.sent_at)
+                stats.rtt_sum += now - entry.sent_at
+                stats.rtt_count += 1
+        entry.future.set_result(True)
+        return entry
+
+    def _update_rto(self, rtt):
+        """Caller holds the lock"""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+    def _on_timeout(self, entry):
+        with self._lock:
+            if self._pending.get((entry.cmd_id, entry.seq)) is not entry:
+                return
+            if entry.attempts > entry.max_retries:
+                del self._pending[(entry.cmd_id, entry.seq)]
+                give_up = True
+            else:
+                give_up = False
+                # Exponential backoff of this packet, the shared RTO recovers with the next RTT sample
+                timeout = min(self.max_rto, self.rto * 2 ** entry.attempts)
+                entry.attempts += 1
+                entry.last_sent_at = time.monotonic()
+                self._stats_of(entry.cmd_id).retransmissions += 1
+                entry.task = self.scheduler.call_later(timeout, self._on_timeout, entry,
+                                                       name=f'retransmit {entry.cmd_id}')
+        if give_up:
+            self._give_up(entry)
+            return
+        logging.debug(f'Retransmitting packet {entry.cmd_id} (seq {entry.seq}, attempt {entry.attempts})')
+        self.transmit(entry.raw)
+
+    def _give_up(self, entry):
+        self.scheduler.cancel(entry.task)
+        with self._lock:
+            self._stats_of(entry.cmd_id).failed += 1
+        logging.error(f'Packet {entry.cmd_id} (seq {entry.seq}) not acknowledged after {entry.attempts} attempt(s)')
+        entry.future.set_result(False)
+
+    def pending(self):
+        with self._lock:
+            return list(self._pending.values())
+
+    def cancel_all(self):
+        """Stops retransmitting, the futures of the pending packets resolve to False"""
+        with self._lock:
+            entries, self._pending = list(self._pending.values()), {}
+        for entry in entries:
+            self._give_up(entry)
+
+    def stats(self):
+        """:return: {cmd_id: {sent, retransmissions, acked, failed, rtt_mean}} and the current RTO estimate"""
+        with self._lock:
+            return {
+                'commands': {cmd_id: {'sent': s.sent, 'retransmissions': s.retransmissions, 'acked': s.acked,
+                                      'failed': s.failed,
+                                      'rtt_mean': s.rtt_sum / s.rtt_count if s.rtt_count else None}
+                             for cmd_id, s in self._stats.items()},
+                'srtt': self.srtt,
+                'rttvar': self.rttvar,
+                'rto': self.rto,
+                'pending': len(self._pending),
+                'duplicate_acks': self.duplicate_acks,
+                'unmatched_acks': self.unmatched_acks,
+            }
+
+
+if __name__ == '__main__':
+    import sys
+
+    from advanced_tello import AdvancedTello
+    from simulator import Simulator
+
+    # Delivery against the simulator with loss in both directions, e.g. python packet_tracker.py 0.3
+    LOSS = float(sys.argv[1]) if len(sys.argv) > 1 else 0.2
+
+    with Simulator(latency=0.02, jitter=0.01, loss=LOSS, time_scale=0, seed=1) as simulator:
+        drone = simulator.add(port=0)
+        tello = AdvancedTello('127.0.0.1', drone.port)
+        try:
+            tello.connect()
+            results = [send().result(30) for _ in range(10) for send in (tello.take_off, tello.flip, tello.land)]
+            print(f'{sum(results)} / {len(results)} delivered, {simulator.dropped} datagrams dropped')
+            stats = tello.delivery_stats()
+            for cmd_id, command in stats.pop('commands').items():
+                print(cmd_id, command)
+            print(stats)
+            # Retransmissions of acknowledged packets are cancelled, no task is left behind
+            assert not tello.packets.pending() and not tello.packets.scheduler.tasks()
+        finally:
+            tello.close()
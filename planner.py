@@ -0,0 +1,338 @@
+"""
+Compresses dense waypoint routes into few ``go`` / ``curve`` commands (SDK 2.0).
+
+Requires numpy (like :mod:`telemetry_history`, the rest of the library works without it).
+
+Waypoints are positions in cm in the frame of ``go`` (relative to the drone when the route starts, the drone does not
+turn while flying it), the first waypoint is the start position. Collinear points are merged (Douglas-Peucker with
+``tolerance``), runs of vertices on a common circle become ``curve`` commands if all original points between them
+are within ``tolerance`` of the arc. Legs are split to the bounds of the SDK (at most 500 cm per axis, curve radius
+0.5 - 10 m), legs shorter than the 20 cm minimum are merged into their neighbours.
+
+    plan = plan_route(points, speed=60, tolerance=5)
+    print(len(points), '->', len(plan.legs), plan.duration)
+    plan.to_mission(Mission(drone).take_off()).land().run()
+"""
+import logging
+import math
+
+import numpy as np
+
+from utils import validate_bounds as validate
+
+MAX_LEG = 500  # cm per axis
+MIN_LEG = 20  # cm, at least one axis
+MIN_RADIUS = 50
+MAX_RADIUS = 1000
+MAX_CURVE_SPEED = 60
+# Largest angle of one curve command, the drone flies through the middle point of the arc
+MAX_SWEEP = math.pi
+
+
+class RoutePlan:
+    """
+    Legs are ('go', x, y, z, speed) or ('curve', x1, y1, z1, x2, y2, z2, speed) with integer offsets relative to the
+    start of the leg.
+
+    :param command_overhead: Seconds per command (response, acceleration and settling) for the predicted duration
+    :param end_error: Distance in cm of the end of the last leg from the last waypoint, only not 0 if the whole route
+                      ends closer to its start than the minimum leg
+    """
+
+    def __init__(self, legs, points, command_overhead=1.0, end_error=0.0):
+        self.legs = legs
+        self.points = points
+        self.command_overhead = command_overhead
+        self.end_error = end_error
+
+    @property
+    def distance(self):
+        """Flown distance in cm"""
+        return sum(_leg_length(leg) for leg in self.legs)
+
+    @property
+    def duration(self):
+        """Predicted flight time in s"""
+        return sum(_leg_length(leg) / leg[-1] + self.command_overhead for leg in self.legs)
+
+    def commands(self):
+        return [' '.join(map(str, leg)) for leg in self.legs]
+
+    def to_mission(self, mission):
+        """Adds the legs to a :class:`mission.Mission`, :return: the mission"""
+        for leg in self.legs:
+            getattr(mission, leg[0])(*leg[1:])
+        return mission
+
+    def __repr__(self):
+        return f'RoutePlan({self.points} points -> {len(self.legs)} commands, {self.duration:.1f} s)'
+
+
+def _leg_length(leg):
+    if leg[0] == 'go':
+        return math.hypot(*leg[1:4])
+    mid, end = leg[1:4], leg[4:7]
+    # Two chords, a slight underestimate of the arc length
+    return math.hypot(*mid) + math.dist(mid, end)
+
+
+def simplify(points, tolerance):
+    """
+    Douglas-Peucker simplification, all open intervals of one recursion level are processed in one vectorized pass
+
+    :return: Indices of the kept points (sorted, first and last included)
+    """
+    n = len(points)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n - 1]] = True
+    starts, ends = np.array([0]), np.array([n - 1])
+    while starts.size:
+        lengths = ends - starts - 1
+        open_ = lengths > 0
+        starts, ends, lengths = starts[open_], ends[open_], lengths[open_]
+        if not starts.size:
+            break
+        offsets = np.cumsum(lengths) - lengths
+        interval = np.repeat(np.arange(starts.size), lengths)
+        idx = np.arange(lengths.sum()) - offsets[interval] + starts[interval] + 1
+
+        a = points[starts][interval]
+        ab = points[ends][interval] - a
+        ap = points[idx] - a
+        t = np.clip(np.einsum('ij,ij->i', ap, ab) / np.maximum(np.einsum('ij,ij->i', ab, ab), 1e-12), 0.0, 1.0)
+        dist = np.linalg.norm(ap - t[:, None] * ab, axis=1)
+
+        largest = np.maximum.reduceat(dist, offsets)
+        split = largest > tolerance
+        candidates = np.flatnonzero((dist == largest[interval]) & split[interval])
+        if not candidates.size:
+            break
+        # First farthest point per interval
+        first = candidates[np.r_[True, interval[candidates[1:]] != interval[candidates[:-1]]]]
+        pivots, parents = idx[first], interval[first]
+        keep[pivots] = True
+        starts = np.concatenate((starts[parents], pivots))
+        ends = np.concatenate((pivots, ends[parents]))
+    return np.flatnonzero(keep)
+
+
+def _circles(a, b, c):
+    """Circumcircles of the triangles (a, b, c), rows of each: center, radius and unit normal (nan if collinear)"""
+    u, v = a - c, b - c
+    normal = np.cross(u, v)
+    area2 = np.einsum('ij,ij->i', normal, normal)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        uu = np.einsum('ij,ij->i', u, u)[:, None]
+        vv = np.einsum('ij,ij->i', v, v)[:, None]
+        center = c + np.cross(uu * v - vv * u, normal) / (2 * area2[:, None])
+        radius = np.linalg.norm(a - center, axis=1)
+        normal = normal / np.sqrt(area2)[:, None]
+    return center, radius, normal
+
+
+def _verify_arcs(points, first, last, center, radius, normal, tolerance):
+    """
+    :return: Mask of the arcs (first to last original point on the circle) within tolerance of all original points
+             and of the straight paths between them (sagitta of each chord)
+    """
+    usable = (radius >= MIN_RADIUS) & (radius <= MAX_RADIUS)
+    lengths = last - first + 1
+    offsets = np.cumsum(lengths) - lengths
+    arc = np.repeat(np.arange(len(first)), lengths)
+    idx = np.arange(lengths.sum()) - offsets[arc] + first[arc]
+    with np.errstate(invalid='ignore'):
+        rel = points[idx] - center[arc]
+        height = np.einsum('ij,ij->i', rel, normal[arc])
+        planar = np.linalg.norm(rel - height[:, None] * normal[arc], axis=1)
+        error = np.hypot(planar - radius[arc], height)
+        # Chord to the next point, the last point of each arc has none
+        half = np.linalg.norm(points[np.minimum(idx + 1, len(points) - 1)] - points[idx], axis=1) / 2
+        half[offsets + lengths - 1] = 0.0
+        r = radius[arc]
+        sagitta = r - np.sqrt(np.maximum(r * r - half * half, 0.0))
+        error = np.maximum(error, np.where(half < r, sagitta, np.inf))
+    return usable & (np.maximum.reduceat(error, offsets) <= tolerance)
+
+
+def _find_arcs(points, vertices, tolerance):
+    """
+    Fits arcs to the simplified vertices: circumcircles of consecutive vertex triplets are verified against the
+    original points, then neighbouring arcs are merged pairwise (circle through first, shared and last point) for as
+    long as the merged arcs verify.
+
+    :return: list of (first point, last point, center, radius, normal) of verified arcs, ordered and not overlapping
+    """
+    if len(vertices) < 3:
+        return []
+    # Non overlapping triplets (vertex 2k to 2k + 2), both phases, the better phase is kept below
+    arcs = []
+    for phase in (0, 1):
+        start = np.arange(phase, len(vertices) - 2, 2)
+        first, middle, last = vertices[start], vertices[start + 1], vertices[start + 2]
+        center, radius, normal = _circles(points[first], points[middle], points[last])
+        ok = _verify_arcs(points, first, last, center, radius, normal, tolerance)
+        arcs.append([first[ok], last[ok], center[ok], radius[ok], normal[ok]])
+    first, last, center, radius, normal = max(arcs, key=lambda a: len(a[0]))
+
+    while len(first) > 1:
+        # Merge candidates: arcs sharing an end point, the merged circle goes through the shared point
+        adjacent = np.flatnonzero(last[:-1] == first[1:])
+        if not adjacent.size:
+            break
+        c, r, n = _circles(points[first[adjacent]], points[last[adjacent]], points[last[adjacent + 1]])
+        ok = _verify_arcs(points, first[adjacent], last[adjacent + 1], c, r, n, tolerance)
+        # Pairs do not overlap: skip a pair if its left arc was merged into the previous one
+        merge = []
+        taken = -1
+        for i, pair in enumerate(adjacent):
+            if ok[i] and pair > taken:
+                merge.append(i)
+                taken = pair + 1
+        if not merge:
+            break
+        merge = np.array(merge)
+        left = adjacent[merge]
+        last[left] = last[left + 1]
+        center[left], radius[left], normal[left] = c[merge], r[merge], n[merge]
+        keep = np.ones(len(first), dtype=bool)
+        keep[left + 1] = False
+        first, last, center, radius, normal = first[keep], last[keep], center[keep], radius[keep], normal[keep]
+    return list(zip(first, last, center, radius, normal))
+
+
+def _arc_pieces(points, vertices, start, end, center, radius, normal):
+    """:return: list of (middle point, end point) of curve commands along the arc, None if it cannot be flown"""
+    e1 = points[start] - center
+    e1 /= np.linalg.norm(e1)
+    e2 = np.cross(normal, e1)
+    arc = points[vertices[(vertices >= start) & (vertices <= end)]] - center
+    angles = np.unwrap(np.arctan2(arc @ e2, arc @ e1))
+    sweep = angles[-1] - angles[0]
+    if not 0 < sweep < 2 * math.pi:
+        return None
+    # Chords of at most MAX_LEG, so no axis exceeds it
+    max_sweep = min(MAX_SWEEP, 2 * math.asin(min(1.0, MAX_LEG / (2 * radius))))
+    count = math.ceil(sweep / max_sweep)
+    theta = np.linspace(0.0, sweep, 2 * count + 1)
+    positions = center + radius * (np.cos(theta)[:, None] * e1 + np.sin(theta)[:, None] * e2)
+    positions[-1] = points[end]
+    return [(positions[2 * i + 1], positions[2 * i + 2]) for i in range(count)]
+
+
+def plan_route(waypoints, speed=50, tolerance=5.0, arcs=True, command_overhead=1.0):
+    """
+    :param waypoints: (n, 3) array like of positions in cm, the first one is the start
+    :param speed: cm/s, 10 - 100 (curves at most 60)
+    :param tolerance: Maximum distance in cm of the flown path from the waypoints (before the 20 cm minimum leg merge)
+    :return: :class:`RoutePlan`
+    """
+    points = np.asarray(waypoints, dtype=float)
+    assert points.ndim == 2 and points.shape[1] == 3
+    speed = validate(speed, 10, 100)
+    curve_speed = min(speed, MAX_CURVE_SPEED)
+    count = len(points)
+    if count > 1:
+        # Consecutive duplicates would make zero length chords
+        points = points[np.r_[True, np.any(points[1:] != points[:-1], axis=1)]]
+    if len(points) < 2:
+        return RoutePlan([], count, command_overhead)
+
+    vertices = simplify(points, tolerance)
+    # Targets as absolute positions: ('go', end) or ('curve', middle, end)
+    targets = []
+    previous = vertices[0]
+    for start, end, center, radius, normal in (_find_arcs(points, vertices, tolerance) if arcs else []):
+        if start < previous:
+            continue
+        pieces = _arc_pieces(points, vertices, start, end, center, radius, normal)
+        if pieces is None:
+            continue
+        targets += [('go', points[i]) for i in vertices[(vertices > previous) & (vertices <= start)]]
+        targets += [('curve', middle, end_point) for middle, end_point in pieces]
+        previous = end
+    targets += [('go', points[i]) for i in vertices[vertices > previous]]
+    legs, end = _to_legs(points[0], targets, speed, curve_speed)
+    end_error = float(np.linalg.norm(np.rint(points[-1]) - end))
+    if end_error:
+        logging.warning(f'Route ends {end_error:.1f} cm from its last waypoint, closer to the start than the '
+                        f'{MIN_LEG} cm minimum leg')
+    return RoutePlan(legs, count, command_overhead, end_error)
+
+
+def _too_short(offset):
+    return all(-MIN_LEG < i < MIN_LEG for i in offset)
+
+
+def _to_legs(start, targets, speed, curve_speed):
+    """
+    Relative integer legs from absolute targets, rounding happens on absolute positions so errors do not add up
+
+    :return: (legs, end position), the end differs from the last target if it is closer than MIN_LEG to the start
+    """
+    # Merge too short go legs into the previous go leg while that stays long enough, otherwise skip them (the next
+    # leg starts earlier). The last target is carried into the previous legs of any type, it must not be skipped
+    start = np.rint(start)
+    merged = []
+    position = start
+    for kind, *target in targets:
+        target = [np.rint(t) for t in target]
+        if kind == 'curve' and (_too_short(target[0] - position) or _too_short(target[1] - position)):
+            kind, target = 'go', target[1:]
+        if kind == 'go' and _too_short(target[0] - position):
+            origin = merged[-2][-1] if len(merged) > 1 else start
+            if merged and merged[-1][0] == 'go' and not _too_short(target[0] - origin):
+                merged[-1] = ('go', target[0])
+                position = target[0]
+            continue
+        merged.append((kind, *target))
+        position = target[-1]
+    if targets:
+        end = np.rint(targets[-1][-1])
+        if np.any(position != end) and _carry(merged, start, end):
+            position = end
+
+    legs = []
+    position = np.rint(start)
+    for kind, *target in merged:
+        if kind == 'curve':
+            middle, end = target
+            offsets = np.concatenate((middle - position, end - position))
+            if np.abs(offsets).max() <= MAX_LEG:
+                legs.append(('curve', *map(int, offsets), curve_speed))
+                position = end
+                continue
+            # Start moved by a dropped leg, fly the chord instead
+            target = [end]
+        end = target[0]
+        origin = position
+        parts = max(1, math.ceil(np.abs(end - origin).max() / MAX_LEG))
+        for i in range(1, parts + 1):
+            point = np.rint(origin + (end - origin) * i / parts)
+            # Only possible after merging, the next leg starts from the current position instead
+            if _too_short(point - position):
+                continue
+            legs.append(('go', *map(int, point - position), speed))
+            position = point
+    return legs, position
+
+
+def _carry(merged, start, end):
+    """
+    Ends the last merged leg at end instead, legs that become shorter than MIN_LEG are removed and end is carried into
+    the leg before. A curve keeps its middle point if the arc through it and end can still be flown.
+
+    :return: False if end is too close to start for any leg
+    """
+    while merged:
+        kind, *target = merged.pop()
+        origin = merged[-1][-1] if merged else start
+        if _too_short(end - origin):
+            continue
+        if kind == 'curve' and not _too_short(target[0] - origin):
+            radius = _circles(origin[None], target[0][None], end[None])[1][0]
+            if MIN_RADIUS <= radius <= MAX_RADIUS:
+                merged.append(('curve', target[0], end))
+                return True
+        merged.append(('go', end))
+        return True
+    return False
@@ -0,0 +1,286 @@
+"""
+Process wide scheduler for periodic and one-shot tasks (joystick packets, heartbeats, time replies, ...) of any number of
+drones, running on a single thread.
+
+Periodic tasks are aligned to a grid of their interval, so e.g. the 50 Hz joystick tasks of all drones become due at the
+same time and are executed in one wake-up.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class ScheduledTask:
+    __slots__ = ('name', 'function', 'args', 'interval', 'deadline', 'cancelled', 'runs', 'missed', 'lateness_total',
+                 'lateness_max', 'runtime_total', 'runtime_max', 'scheduler')
+
+    def __init__(self, name, function, args, interval, deadline):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.interval = interval
+        self.deadline = deadline
+        self.cancelled = False
+        self.runs = 0
+        self.missed = 0
+        self.lateness_total = 0.0
+        self.lateness_max = 0.0
+        self.runtime_total = 0.0
+        self.runtime_max = 0.0
+        self.scheduler = None
+
+    def cancel(self):
+        if self.scheduler is None:
+            self.cancelled = True
+        else:
+            self.scheduler.cancel(self)
+
+    def stats(self):
+        runs = self.runs or 1
+        return {
+            'runs': self.runs,
+            'missed': self.missed,
+            'lateness_mean': self.lateness_total / runs,
+            'lateness_max': self.lateness_max,
+            'runtime_mean': self.runtime_total / runs,
+            'runtime_max': self.runtime_max,
+        }
+
+
+class Scheduler:
+    """
+    Heap based scheduler on one thread. Tasks due within ``coalesce`` seconds of each other run in the same wake-up.
+    Tasks must not block, a slow task delays all others (see runtime_max in :meth:`stats`).
+    """
+
+    def __init__(self, coalesce=0.0005):
+        self.coalesce = coalesce
+        self.wakeups = 0
+        self._epoch = time.monotonic()
+        self._heap = []
+        self._seq = itertools.count()
+        self._tasks = set()
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='tello-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def call_later(self, delay, function, *args, name=None):
+        """Runs function(*args) once after delay seconds"""
+        return self._add(ScheduledTask(name or _name(function), function, args, None, time.monotonic() + delay))
+
+    def call_soon(self, function, *args, name=None):
+        return self.call_later(0, function, *args, name=name)
+
+    def call_every(self, interval, function, *args, name=None, align=True):
+        """
+        Runs function(*args) every interval seconds. Missed ticks (overrun) are skipped.
+
+        :param align: Start on the grid of the interval (shared by all tasks), so tasks with the same interval are
+                      batched into one wake-up
+        """
+        now = time.monotonic()
+        if align:
+            deadline = now + interval - (now - self._epoch) % interval
+        else:
+            deadline = now + interval
+        return self._add(ScheduledTask(name or _name(function), function, args, interval, deadline))
+
+    def cancel(self, task):
+        with self._cond:
+            task.cancelled = True
+            self._tasks.discard(task)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def tasks(self):
+        with self._cond:
+            return [task for task in self._tasks if not task.cancelled]
+
+    def stats(self):
+        """Per task timing metrics (lateness and run time in seconds)"""
+        return {f'{task.name}#{id(task):x}': task.stats() for task in self.tasks()}
+
+    def _add(self, task):
+        task.scheduler = self
+        with self._cond:
+            self._tasks.add(task)
+            heapq.heappush(self._heap, (task.deadline, next(self._seq), task))
+            if self._heap[0][2] is task:
+                self._cond.notify()
+        return task
+
+    def _run(self):
+        heap = self._heap
+        while True:
+            with self._cond:
+                while self._running:
+                    if heap:
+                        timeout = heap[0][0] - time.monotonic()
+                        if timeout <= self.coalesce:
+                            break
+                        self._cond.wait(timeout)
+                    else:
+                        self._cond.wait()
+                if not self._running:
+                    return
+                # Everything that is due (or almost due) runs in this wake-up
+                limit = time.monotonic() + self.coalesce
+                due = []
+                while heap and heap[0][0] <= limit:
+                    due.append(heapq.heappop(heap)[2])
+            self.wakeups += 1
+
+            for task in due:
+                if task.cancelled:
+                    with self._cond:
+                        self._tasks.discard(task)
+                    continue
+                start = time.monotonic()
+                lateness = max(0.0, start - task.deadline)
+                try:
+                    task.function(*task.args)
+                except Exception:
+                    logging.exception(f'Scheduled task {task.name} failed')
+                end = time.monotonic()
+                task.runs += 1
+                task.lateness_total += lateness
+                task.lateness_max = max(task.lateness_max, lateness)
+                task.runtime_total += end - start
+                task.runtime_max = max(task.runtime_max, end - start)
+
+                with self._cond:
+                    if task.interval is None or task.cancelled:
+                        self._tasks.discard(task)
+                        continue
+                    task.deadline += task.interval
+                    if task.deadline < end:
+                        behind = int((end - task.deadline) // task.interval) + 1
+                        task.missed += behind
+                        task.deadline += behind * task.interval
+                    heapq.heappush(heap, (task.deadline, next(self._seq), task))
+
+
+class ScheduledEmitter:
+    """Same interface as :class:`utils.PeriodicEmitter`, but runs on a (shared) :class:`Scheduler`"""
+
+    def __init__(self, scheduler, interval, function, *args, name=None):
+        self.scheduler = scheduler
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.name = name or _name(function)
+        # Last started task, kept after stopping for its stats
+        self._task = None
+
+    @property
+    def is_running(self):
+        return self._task is not None and not self._task.cancelled
+
+    def start(self):
+        if not self.is_running:
+            self._task = self.scheduler.call_every(self.interval, self.function, *self.args, name=self.name)
+
+    def stop(self):
+        if self.is_running:
+            self.scheduler.cancel(self._task)
+
+    def stats(self):
+        return {} if self._task is None else self._task.stats()
+
+
+def _name(function):
+    return getattr(function, '__qualname__', None) or repr(function)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_scheduler():
+    """The process wide :class:`Scheduler` (created on first use)"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Scheduler()
+        return _shared
+
+
+if __name__ == '__main__':
+    import socket
+    import statistics
+    import sys
+
+    from advanced_tello import PacketBuffer, _JOYSTICK_DATA
+    from utils import PeriodicEmitter, RepeatedTimer
+
+    INTERVAL = 0.02
+    DURATION = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = sink.getsockname()
+
+    def drain():
+        sink.setblocking(False)
+        try:
+            while True:
+                sink.recv(64)
+        except BlockingIOError:
+            pass
+
+    class SimulatedDrone:
+        def __init__(self):
+            self.buffer = PacketBuffer(80, 96, _JOYSTICK_DATA.size)
+            self.calls = []
+
+        def tick(self):
+            self.calls.append(time.monotonic())
+            sender.sendto(self.buffer.encode_fields(0, _JOYSTICK_DATA, 1024, 1024, 12, 0, 0, 0), address)
+
+    def run(kind, n):
+        drones = [SimulatedDrone() for _ in range(n)]
+        scheduler = None
+        if kind == 'RepeatedTimer':
+            timers = [RepeatedTimer(INTERVAL, d.tick) for d in drones]
+        elif kind == 'PeriodicEmitter':
+            timers = [PeriodicEmitter(INTERVAL, d.tick) for d in drones]
+        else:
+            scheduler = Scheduler()
+        cpu, wall = time.process_time(), time.monotonic()
+        if scheduler is None:
+            for timer in timers:
+                timer.start()
+        else:
+            for d in drones:
+                scheduler.call_every(INTERVAL, d.tick)
+        while time.monotonic() - wall < DURATION:
+            time.sleep(0.1)
+            drain()
+        if scheduler is None:
+            for timer in timers:
+                timer.stop()
+        else:
+            scheduler.stop()
+        cpu, wall = time.process_time() - cpu, time.monotonic() - wall
+        drain()
+
+        deviations = sorted(abs(b - a - INTERVAL) for d in drones for a, b in zip(d.calls, d.calls[1:]))
+        rate = sum(len(d.calls) for d in drones) / wall / n
+        print(f'{kind:16s} {n:4d} drones  cpu {cpu / wall * 100:6.1f} %  rate {rate:5.1f} Hz/drone  '
+              f'jitter mean {statistics.fmean(deviations) * 1000:6.2f} ms  '
+              f'p99 {deviations[int(len(deviations) * 0.99)] * 1000:6.2f} ms'
+              + (f'  wakeups {scheduler.wakeups / wall:6.1f}/s' if scheduler else ''))
+
+    for n in (1, 10, 100):
+        for kind in ('RepeatedTimer', 'PeriodicEmitter', 'Scheduler'):
+            run(kind, n)
@@ -0,0 +1,555 @@
+"""
+Local stand-in for one or many Tello drones, for tests and benchmarks without hardware.
+
+Each simulated drone listens on its own command port and speaks
+ * the text SDK (1.3 / 2.0): commands are answered in order, moves take distance / speed seconds (scaled by
+   ``time_scale``), queries are answered immediately. State datagrams are sent to ``state_port`` after ``command``,
+   synthetic H.264 (raw, 1460 byte datagrams) to ``video_port`` after ``streamon``.
+ * the binary protocol: conn_req / conn_ack, joystick, take off / land / flip (acknowledged with the same cmd_id and
+   seq_num), flight data and wifi packets with valid CRCs, synthetic video with the app framing to the port from
+   conn_req.
+
+Latency, jitter and loss apply to every datagram (loss in both directions).
+
+    with Simulator(latency=0.005, loss=0.01, time_scale=0.1) as sim:
+        drone = sim.add(port=0, state_port=9000)
+        client = Drone2_0(local_port=0, local_state_port=9000, tello_ip='127.0.0.1', tello_port=drone.port)
+
+Command line: ``python simulator.py --drones 4 --port 8889 --state-port 8890`` (ports are increased per drone)
+"""
+import logging
+import math
+import random
+import selectors
+import socket
+import threading
+import time
+
+import commands
+import flight_data
+from advanced_tello import AdvancedTello, PacketDecoder, PacketEncoder, _JOYSTICK_DATA
+from scheduler import Scheduler
+from video import SDK_FRAGMENT_SIZE
+
+_SPS_PPS = (b'\x00\x00\x00\x01\x67\x4d\x40\x28\x95\xa0\x3c\x05\xb9'
+            b'\x00\x00\x00\x01\x68\xee\x38\x80')
+_APP_FRAGMENT_SIZE = 1458
+
+TAKE_OFF_HEIGHT = 80
+TAKE_OFF_DURATION = 3.0
+LAND_DURATION = 3.0
+FLIP_DURATION = 1.5
+YAW_RATE = 90.0  # °/s
+JOYSTICK_SPEED = (100.0, 200.0)  # cm/s at full stick, slow and fast mode
+
+
+class SimulatedDrone:
+    """State of one simulated drone. All methods run on the scheduler thread of the :class:`Simulator`."""
+
+    def __init__(self, simulator, name, ip='127.0.0.1', port=8889, sdk='2.0', state_port=8890, video_port=11111,
+                 state_rate=10.0, video_fps=30.0, video_bitrate=1_000_000, gop=30, battery=100.0):
+        assert sdk in ('1.3', '2.0')
+        self.simulator = simulator
+        self.name = name
+        self.sdk = sdk
+        self.state_port = state_port
+        self.video_port = video_port
+        self.state_rate = state_rate
+        self.video_fps = video_fps
+        self.gop = gop
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((ip, port))
+        self.socket.setblocking(False)
+
+        # Flight model, positions in cm (z is the height), yaw in °, velocities in cm/s
+        self.x = self.y = self.z = 0.0
+        self.yaw = 0.0
+        self.velocity = (0.0, 0.0, 0.0, 0.0)  # x, y, z, yaw rate, from rc / joystick
+        self.speed = 100
+        self.battery = battery
+        self.flying = False
+        self.motor_time = 0.0
+        self.mission_pads = False
+        self._updated = time.monotonic()
+
+        # Text SDK
+        self.sdk_mode = False
+        self.client = None
+        self.commands = 0
+        self._busy_until = 0.0
+        self._pending = []
+        self._state_task = None
+
+        # Video
+        self.streaming = False
+        self._video_task = None
+        self._video_target = None
+        self._video_framing = 'sdk'
+        self._frame_number = 0
+        self._force_keyframe = True
+        frame_size = int(video_bitrate / 8 / video_fps)
+        self._frame_sizes = (frame_size * 4, frame_size // 2)  # keyframe, other frames
+        # Start codes must not occur inside the payload
+        self._payload = simulator.random.randbytes(frame_size * 4).replace(b'\x00', b'\x01')
+
+        # Binary protocol
+        self.binary_client = None
+        self._decoder = PacketDecoder()
+        self._encoder = PacketEncoder()
+        self._binary_tasks = []
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def close(self):
+        for task in [self._state_task, self._video_task] + self._binary_tasks + self._pending:
+            if task is not None:
+                task.cancel()
+        self.socket.close()
+
+    def _send(self, data, address):
+        self.simulator.send(self.socket, data, address)
+
+    def _advance(self):
+        """Integrates rc / joystick velocities up to now"""
+        now = time.monotonic()
+        dt, self._updated = now - self._updated, now
+        if self.flying:
+            vx, vy, vz, vyaw = self.velocity
+            self.x += vx * dt
+            self.y += vy * dt
+            self.z = max(0.0, self.z + vz * dt)
+            self.yaw = (self.yaw + vyaw * dt + 180) % 360 - 180
+            self.motor_time += dt
+            self.battery = max(0.0, self.battery - 0.1 * dt)
+        else:
+            self.battery = max(0.0, self.battery - 0.01 * dt)
+
+    def on_datagram(self, data, address):
+        if data[:1] == b'\xcc' or data.startswith(b'conn_req:'):
+            self._on_binary(data, address)
+            return
+        try:
+            command = data.decode(encoding='utf-8').strip()
+        except UnicodeDecodeError:
+            return
+        self._on_command(command, address)
+
+    # Text SDK
+
+    def _on_command(self, command, address):
+        self._advance()
+        self.commands += 1
+        self.client = address
+        name = command.split(' ', 1)[0]
+        if not self.sdk_mode:
+            if name != 'command':
+                return
+            self.sdk_mode = True
+            self._state_task = self.simulator.scheduler.call_every(1 / self.state_rate, self._send_state,
+                                                                   name=f'{self.name} state')
+        # Commands and their argument bounds of the SDK version are checked with the client's command table
+        try:
+            parsed = commands.parse(command, self.sdk)
+        except ValueError:
+            self._send(b'error', address)
+            return
+        if parsed is None:
+            self._send(f'unknown command: {name}'.encode(encoding='utf-8'), address)
+            return
+        spec, args = parsed
+        if spec.query:
+            self._send(self._query(name).encode(encoding='utf-8'), address)
+            return
+        result = self._execute(name, args)
+        if result is None:
+            return
+        response, duration = result
+        if duration is None:
+            self._send(response.encode(encoding='utf-8'), address)
+            return
+        # Commands with a duration are executed one after the other
+        now = time.monotonic()
+        self._busy_until = max(now, self._busy_until) + duration * self.simulator.time_scale
+        task = self.simulator.scheduler.call_later(self._busy_until - now, self._complete, response, address,
+                                                   name=f'{self.name} {name}')
+        self._pending.append(task)
+
+    def _complete(self, response, address):
+        self._pending = [task for task in self._pending if not task.cancelled and task.runs == 0]
+        self._advance()
+        if isinstance(response, tuple):
+            response, apply = response
+            apply()
+        self._send(response.encode(encoding='utf-8'), address)
+
+    def _cancel_pending(self):
+        for task in self._pending:
+            task.cancel()
+        self._pending = []
+        self._busy_until = 0.0
+
+    def _execute(self, name, args):
+        """
+        :param args: Arguments checked by :func:`commands.parse` (literals like the direction of flip are left out)
+        :return: (response, duration in s or None to answer immediately), None for no response
+        """
+        flying = self.flying
+        if name == 'command':
+            return 'ok', None
+        if name in ('streamon', 'streamoff'):
+            self._set_streaming(name == 'streamon', (self.client[0], self.video_port), 'sdk')
+            return 'ok', None
+        if name == 'takeoff':
+            if flying:
+                return 'error', None
+            return ('ok', self._take_off), TAKE_OFF_DURATION
+        if name == 'land':
+            if not flying:
+                return 'error Motor stop', None
+            return ('ok', self._land), LAND_DURATION
+        if name == 'emergency':
+            self._cancel_pending()
+            self.flying = False
+            self.z = 0.0
+            return None
+        if name == 'rc':
+            a, b, c, d = args
+            heading = math.radians(self.yaw)
+            # Stick values in % are taken as cm/s
+            self.velocity = (b * math.cos(heading) - a * math.sin(heading),
+                             b * math.sin(heading) + a * math.cos(heading), float(c), d * YAW_RATE / 100)
+            return None
+        if name == 'speed':
+            (self.speed,) = args
+            return 'ok', None
+        if name in ('wifi', 'ap', 'mon', 'moff', 'mdirection'):
+            if name in ('mon', 'moff'):
+                self.mission_pads = name == 'mon'
+            return 'ok', None
+        if name == 'stop':
+            self._cancel_pending()
+            self.velocity = (0.0, 0.0, 0.0, 0.0)
+            return 'ok', None
+
+        # Flight commands
+        if not flying:
+            return 'error Motor stop', None
+        if name in ('up', 'down', 'left', 'right', 'forward', 'back'):
+            (distance,) = args
+            dx, dy, dz = {'forward': (distance, 0, 0), 'back': (-distance, 0, 0), 'left': (0, -distance, 0),
+                          'right': (0, distance, 0), 'up': (0, 0, distance), 'down': (0, 0, -distance)}[name]
+            return ('ok', lambda: self._move(dx, dy, dz)), distance / self.speed
+        if name in ('cw', 'ccw'):
+            (degree,) = args
+            return ('ok', lambda: self._rotate(degree if name == 'cw' else -degree)), degree / YAW_RATE
+        if name == 'flip':
+            if self.battery < 50:
+                return 'error', None
+            return 'ok', FLIP_DURATION
+        if name in ('go', 'jump'):
+            x, y, z, speed = args[:4]
+            yaw = args[4] if name == 'jump' else 0
+            return ('ok', lambda: (self._move(x, y, z), self._rotate(yaw))), math.sqrt(x * x + y * y + z * z) / speed
+        if name == 'curve':
+            x1, y1, z1, x2, y2, z2, speed = args[:7]
+            length = math.dist((0, 0, 0), (x1, y1, z1)) + math.dist((x1, y1, z1), (x2, y2, z2))
+            return ('ok', lambda: self._move(x2, y2, z2)), length / speed
+        return f'unknown command: {name}', None
+
+    def _take_off(self):
+        self.flying = True
+        self.z = TAKE_OFF_HEIGHT
+
+    def _land(self):
+        self.flying = False
+        self.z = 0.0
+        self.velocity = (0.0, 0.0, 0.0, 0.0)
+
+    def _move(self, forward, right, up):
+        heading = math.radians(self.yaw)
+        self.x += forward * math.cos(heading) - right * math.sin(heading)
+        self.y += forward * math.sin(heading) + right * math.cos(heading)
+        self.z = max(0.0, self.z + up)
+
+    def _rotate(self, degree):
+        self.yaw = (self.yaw + degree + 180) % 360 - 180
+
+    def _tof(self):
+        """Distance to the ground in cm"""
+        return int(self.z) + 10 if self.flying else 10
+
+    def _query(self, name):
+        """:param name: Query of the SDK version"""
+        tof = self._tof() * 10  # mm, the state reports cm
+        responses = {
+            'battery?': f'{int(self.battery)}',
+            'speed?': f'{float(self.speed)}',
+            'time?': f'{int(self.motor_time)}s',
+            'height?': f'{int(self.z // 10)}dm',
+            'temp?': '62~65C',
+            'attitude?': f'pitch:0;roll:0;yaw:{int(self.yaw)};',
+            'baro?': f'{self.z / 100:.2f}',
+            'acceleration?': 'agx:-2.00;agy:10.00;agz:-999.00;',
+            'tof?': f'{tof}mm',
+            'wifi?': '90',
+            'sdk?': '20',
+            'sn?': f'0TQSIM{self.port:05d}',
+        }
+        return responses.get(name, f'unknown command: {name}')
+
+    def state_datagram(self):
+        state = (f'pitch:0;roll:0;yaw:{int(self.yaw)};vgx:{int(self.velocity[0])};vgy:{int(self.velocity[1])};'
+                 f'vgz:{int(self.velocity[2])};templ:62;temph:65;tof:{self._tof()};'
+                 f'h:{int(self.z)};bat:{int(self.battery)};baro:{self.z / 100:.2f};time:{int(self.motor_time)};'
+                 f'agx:-2.00;agy:10.00;agz:-999.00;\r\n')
+        if self.sdk == '2.0':
+            state = 'mid:-1;x:0;y:0;z:0;mpry:0,0,0;' + state
+        return state.encode(encoding='utf-8')
+
+    def _send_state(self):
+        self._advance()
+        if self.client is not None:
+            self._send(self.state_datagram(), (self.client[0], self.state_port))
+
+    # Video
+
+    def _set_streaming(self, streaming, target, framing):
+        self._video_target = target
+        self._video_framing = framing
+        if streaming and self._video_task is None:
+            self._force_keyframe = True
+            self._video_task = self.simulator.scheduler.call_every(1 / self.video_fps, self._send_frame,
+                                                                   name=f'{self.name} video')
+        elif not streaming and self._video_task is not None:
+            self._video_task.cancel()
+            self._video_task = None
+        self.streaming = streaming
+
+    def synthetic_frame(self):
+        """Next synthetic access unit, SPS / PPS and an IDR slice every gop frames, otherwise a P slice"""
+        keyframe = self._force_keyframe or self._frame_number % self.gop == 0
+        self._force_keyframe = False
+        self._frame_number += 1
+        size = self._frame_sizes[0 if keyframe else 1] + self._frame_number % 97
+        if keyframe:
+            frame = _SPS_PPS + b'\x00\x00\x00\x01\x65' + self._payload[:size]
+        else:
+            frame = b'\x00\x00\x00\x01\x41' + self._payload[:size]
+        if len(frame) % SDK_FRAGMENT_SIZE == 0:
+            # A datagram shorter than the fragment size ends the frame
+            frame += b'\x01'
+        return frame
+
+    def _send_frame(self):
+        frame = self.synthetic_frame()
+        if self._video_framing == 'sdk':
+            for pos in range(0, len(frame), SDK_FRAGMENT_SIZE):
+                self._send(frame[pos:pos + SDK_FRAGMENT_SIZE], self._video_target)
+        else:
+            number = self._frame_number & 0xff
+            count = -(-len(frame) // _APP_FRAGMENT_SIZE)
+            for i in range(count):
+                header = bytes((number, i | 0x80 if i == count - 1 else i))
+                self._send(header + frame[i * _APP_FRAGMENT_SIZE:(i + 1) * _APP_FRAGMENT_SIZE], self._video_target)
+
+    # Binary protocol
+
+    def _on_binary(self, data, address):
+        self._advance()
+        if data.startswith(b'conn_req:'):
+            self.binary_client = address
+            self._send(b'conn_ack:' + data[9:11], address)
+            video_port = int.from_bytes(data[9:11], byteorder='little')
+            self._set_streaming(True, (address[0], video_port), 'app')
+            if not self._binary_tasks:
+                scheduler = self.simulator.scheduler
+                self._binary_tasks = [
+                    scheduler.call_every(0.1, self._send_flight_data, name=f'{self.name} flight data'),
+                    scheduler.call_every(1.0, self._send_wifi, name=f'{self.name} wifi'),
+                ]
+                self._send_packet(AdvancedTello.CMD_ID_TIME_REQ, 0)
+            return
+        packet = self._decoder.decode(data)
+        if packet is None:
+            return
+        self.binary_client = address
+        cmd_id = packet.cmd_id
+        if cmd_id == AdvancedTello.CMD_ID_JOYSTICK:
+            if len(packet.data) >= _JOYSTICK_DATA.size:
+                low, high, *_ = _JOYSTICK_DATA.unpack_from(packet.data)
+                self._on_joystick(low | high << 32)
+        elif cmd_id == AdvancedTello.CMD_ID_TAKE_OFF:
+            self._ack(packet)
+            if not self.flying:
+                self.simulator.scheduler.call_later(TAKE_OFF_DURATION * self.simulator.time_scale, self._take_off)
+        elif cmd_id == AdvancedTello.CMD_ID_LAND:
+            self._ack(packet)
+            if self.flying:
+                self.simulator.scheduler.call_later(LAND_DURATION * self.simulator.time_scale, self._land)
+        elif cmd_id == AdvancedTello.CMD_ID_FLIP:
+            self._ack(packet)
+        elif cmd_id == AdvancedTello.CMD_ID_VIDEO_STUFF:
+            # Requests a keyframe
+            self._force_keyframe = True
+
+    def _on_joystick(self, stick):
+        roll, pitch, throttle, yaw = ((stick >> shift & 2047) - 1024 for shift in (0, 11, 22, 33))
+        top_speed = JOYSTICK_SPEED[stick >> 44 & 1] / 660
+        heading = math.radians(self.yaw)
+        forward, right = pitch * top_speed, roll * top_speed
+        self.velocity = (forward * math.cos(heading) - right * math.sin(heading),
+                         forward * math.sin(heading) + right * math.cos(heading),
+                         throttle * top_speed, yaw * YAW_RATE / 660)
+
+    def _send_packet(self, cmd_id, seq, data=b'', pac_type=72):
+        if self.binary_client is not None:
+            raw = self._encoder.layout(cmd_id, pac_type, len(data)).encode(seq, data)
+            self._send(bytes(raw), self.binary_client)
+
+    def _ack(self, packet):
+        self._send_packet(packet.cmd_id, packet.seq_num, b'\x00')
+
+    def _send_flight_data(self):
+        self._advance()
+        vx, vy, vz, _ = self.velocity
+        data = flight_data._FLIGHT_DATA.pack(
+            int(self.z // 10), int(vx // 10), int(vy // 10), int(vz // 10), int(self.motor_time * 10), 0b1,
+            0, int(self.battery), 3800, int(self.battery * 6), 0b1000 if self.flying else 0, 6 if self.flying else 1,
+            0, 0, 0, 0) + b'\x00'
+        self._send_packet(flight_data.CMD_ID_FLIGHT_DATA, 0, data)
+
+    def _send_wifi(self):
+        self._send_packet(flight_data.CMD_ID_WIFI, 0, b'\x5a\x00')
+
+
+class Simulator:
+    """Serves any number of :class:`SimulatedDrone` with one I/O thread and one :class:`scheduler.Scheduler`"""
+
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, time_scale=1.0, seed=None):
+        """
+        :param latency: Delay of every datagram sent by the drones in s
+        :param jitter: Additional uniformly distributed delay in s (reorders datagrams)
+        :param loss: Probability to drop a datagram (in both directions)
+        :param time_scale: Factor for the duration of moves, take off etc. (0 to complete immediately)
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.time_scale = time_scale
+        self.random = random.Random(seed)
+        self.drones = {}
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+        self.scheduler = Scheduler()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='tello-simulator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, name=None, **kwargs):
+        """Adds a drone, kwargs are passed to :class:`SimulatedDrone` (port=0 picks a free port)"""
+        name = name or f'sim{len(self.drones)}'
+        drone = SimulatedDrone(self, name, **kwargs)
+        self.drones[name] = drone
+        self._selector.register(drone.socket, selectors.EVENT_READ, drone)
+        self._wakeup_send.send(b'\0')
+        logging.info(f'Simulated drone {name} (SDK {drone.sdk}) on port {drone.port}, state to {drone.state_port}')
+        return drone
+
+    def __getitem__(self, name):
+        return self.drones[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._running = False
+        self._wakeup_send.send(b'\0')
+        self._thread.join()
+        self.scheduler.stop()
+        for drone in self.drones.values():
+            drone.close()
+        self._selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
+    def send(self, sock, data, address):
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            self.scheduler.call_later(delay, self._sendto, sock, data, address, name='delayed send')
+        else:
+            self._sendto(sock, data, address)
+
+    def _sendto(self, sock, data, address):
+        try:
+            sock.sendto(data, address)
+            self.sent += 1
+        except OSError as e:
+            logging.debug(f'Simulator send failed ({e})')
+
+    def _run(self):
+        while self._running:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    try:
+                        key.fileobj.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    data, address = key.fileobj.recvfrom(2048)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    continue
+                self.received += 1
+                if self.loss and self.random.random() < self.loss:
+                    self.dropped += 1
+                    continue
+                # All drone logic runs on the scheduler thread
+                self.scheduler.call_soon(key.data.on_datagram, data, address, name='datagram')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Simulates Tello drones on localhost')
+    parser.add_argument('--drones', type=int, default=1)
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8889, help='Command port of the first drone')
+    parser.add_argument('--state-port', type=int, default=8890, help='State port of the first drone')
+    parser.add_argument('--video-port', type=int, default=11111, help='Video port of the first drone')
+    parser.add_argument('--port-step', type=int, default=10, help='Port increase per drone')
+    parser.add_argument('--sdk', choices=('1.3', '2.0'), default='2.0')
+    parser.add_argument('--latency', type=float, default=0.0, help='s')
+    parser.add_argument('--jitter', type=float, default=0.0, help='s')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability')
+    parser.add_argument('--time-scale', type=float, default=1.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    simulator = Simulator(args.latency, args.jitter, args.loss, args.time_scale)
+    for i in range(args.drones):
+        step = i * args.port_step
+        simulator.add(ip=args.ip, port=args.port + step, sdk=args.sdk, state_port=args.state_port + step,
+                      video_port=args.video_port + step)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.close()
@@ -0,0 +1,307 @@
+import concurrent.futures
+import heapq
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from tello import Drone2_0, DroneInterface
+
+
+class SwarmResult:
+    __slots__ = ('name', 'command', 'response', 'rtt')
+
+    def __init__(self, name, command, response, rtt):
+        self.name = name
+        self.command = command
+        self.response = response
+        self.rtt = rtt
+
+    @property
+    def ok(self):
+        return not isinstance(self.response, str) or not (self.response == 'none_response'
+                                                           or self.response.startswith('error'))
+
+    def __repr__(self):
+        rtt = 'timeout' if self.rtt is None else f'{self.rtt * 1000:.1f} ms'
+        return f'SwarmResult({self.name}, {self.command!r} -> {self.response!r}, {rtt})'
+
+
+class SwarmDrone(Drone2_0):
+    """
+    Drone2_0 without threads of its own, all sockets are served by the I/O thread of the :class:`Swarm`.
+
+    Commands do not block, they return a :class:`concurrent.futures.Future` with the (converted) response, or
+    'none_response' if the command timed out.
+    """
+
+    # Getters return futures, telemetry is not answered from the state stream
+    state_max_age = None
+
+    def __init__(self, swarm, name, tello_ip, tello_port=DroneInterface.TELLO_COMMAND_PORT, local_port=0,
+                 command_timeout=3.0, move_timeout=15.0, max_in_flight=4,
+                 local_state_port=DroneInterface.TELLO_STATE_PORT):
+        self.swarm = swarm
+        self.name = name
+        self._init_state(tello_ip, tello_port, swarm.local_ip, local_state_port, command_timeout, move_timeout,
+                         max_in_flight, None)
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((swarm.local_ip, local_port))
+        self.socket.setblocking(False)
+
+    def __del__(self):
+        self.socket.close()
+
+    def _close_sockets(self):
+        # Served and closed by the swarm, see Swarm.close
+        pass
+
+    def send_command(self, command, command_timeout=None, none_response=False, result_conversion=None):
+        if command_timeout is None:
+            command_timeout = self.command_timeout
+        logging.debug(f'>> Send Command ({self.name}): {command}')
+
+        future = concurrent.futures.Future()
+        if none_response:
+            self._send(command)
+            future.set_result('ok')
+            return future
+
+        entry = self.commands.register(command)
+        self.swarm._watch(self, entry, future, command_timeout, result_conversion)
+        self._send(command)
+        return future
+
+    def _on_response(self, data):
+        self._packets_received.inc()
+        self._bytes_received.inc(len(data))
+        try:
+            entry = self.commands.match(data.decode(encoding='utf-8').rstrip('\r\n'))
+        except UnicodeDecodeError:
+            logging.error(f'Illegal Answer? ({self.name})')
+            return
+        if entry is not None:
+            self.swarm._complete(entry, entry.response)
+
+    def _on_state(self, data):
+        self._state_packets.inc()
+        self._state_bytes.inc(len(data))
+        state = self._state_parser.parse(data)
+        if state is None:
+            self._state_errors.inc()
+        else:
+            self._states_parsed.inc()
+            self._on_state_received(state, time.monotonic())
+
+
+class Swarm:
+    """
+    Controls any number of :class:`SwarmDrone` (SDK 2.0) with a single selector based I/O thread. Each drone has its
+    own command socket, state sockets are shared per local port and demultiplexed by the sender's ip.
+
+        swarm = Swarm()
+        swarm.add('a', '192.168.1.10')
+        swarm.add('b', '192.168.1.11')
+        swarm.broadcast('enter_sdk_mode')
+        swarm.broadcast('take_off')
+    """
+
+    def __init__(self, local_ip=''):
+        self.local_ip = local_ip
+        self.drones = {}
+
+        self._selector = selectors.DefaultSelector()
+        self._state_sockets = {}  # local port -> socket
+        self._state_routes = {}  # (local port, ip) -> drone
+        # Outstanding commands, ordered by deadline. Completed ones are removed lazily
+        self._deadlines = []
+        self._waiting = {}  # InFlightCommand -> (drone, future, result_conversion)
+        self._lock = threading.Lock()
+        self._running = True
+
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+
+        self._io_thread = threading.Thread(target=self._run)
+        self._io_thread.daemon = True
+        self._io_thread.start()
+
+    def add(self, name, tello_ip, tello_port=DroneInterface.TELLO_COMMAND_PORT, local_port=0,
+            local_state_port=DroneInterface.TELLO_STATE_PORT, **kwargs):
+        """
+        Adds a drone, local_port 0 picks a free port. kwargs are passed to :class:`SwarmDrone`
+
+        State datagrams are routed by the sender's ip, drones with the same ip (e.g. simulated drones on localhost or
+        drones behind NAT) need distinct local_state_ports.
+        """
+        drone = SwarmDrone(self, name, tello_ip, tello_port, local_port, local_state_port=local_state_port, **kwargs)
+        with self._lock:
+            routed = self._state_routes.get((local_state_port, tello_ip))
+            if routed is not None:
+                drone.socket.close()
+                raise ValueError(f'State port {local_state_port} already receives the states of {routed.name} '
+                                 f'({tello_ip}), use another local_state_port for {name}')
+            state_socket = self._state_sockets.get(local_state_port)
+            if state_socket is None:
+                state_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                state_socket.bind((self.local_ip, local_state_port))
+                state_socket.setblocking(False)
+                self._state_sockets[local_state_port] = state_socket
+                self._selector.register(state_socket, selectors.EVENT_READ, local_state_port)
+            self._state_routes[(local_state_port, tello_ip)] = drone
+            self._selector.register(drone.socket, selectors.EVENT_READ, drone)
+            self.drones[name] = drone
+        self._wakeup()
+        return drone
+
+    def __getitem__(self, name):
+        return self.drones[name]
+
+    def __iter__(self):
+        return iter(self.drones.values())
+
+    def __len__(self):
+        return len(self.drones)
+
+    def broadcast(self, method, *args, timeout=None, **kwargs):
+        """
+        Calls the given :class:`tello.Drone2_0` method (name or unbound function) on all drones at once and waits for
+        every response (each drone until its own deadline).
+
+        :param timeout: Additional overall limit for waiting, by default only the per-command timeouts apply
+        :return: dict of name -> :class:`SwarmResult`
+        """
+        if isinstance(method, str):
+            method = getattr(SwarmDrone, method)
+        futures = {name: method(drone, *args, **kwargs) for name, drone in self.drones.items()}
+        return self.collect(futures, timeout)
+
+    def send_all(self, command, command_timeout=None):
+        """Sends the raw command to all drones at once, see :meth:`broadcast`"""
+        futures = {name: drone.send_command(command, command_timeout) for name, drone in self.drones.items()}
+        return self.collect(futures)
+
+    def collect(self, futures, timeout=None):
+        """Waits for a dict of name -> Future (as returned by the SwarmDrone commands)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        results = {}
+        for name, future in futures.items():
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                response = future.result(remaining)
+            except concurrent.futures.TimeoutError:
+                response = 'none_response'
+            rtt = getattr(future, 'rtt', None)
+            results[name] = SwarmResult(name, getattr(future, 'command', None), response, rtt)
+        return results
+
+    def close(self):
+        self._running = False
+        self._wakeup()
+        self._io_thread.join()
+        for drone in self.drones.values():
+            drone.socket.close()
+        for state_socket in self._state_sockets.values():
+            state_socket.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+        self._selector.close()
+        with self._lock:
+            waiting, self._waiting = self._waiting, {}
+        for _, future, _ in waiting.values():
+            future.set_result('none_response')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _watch(self, drone, entry, future, command_timeout, result_conversion):
+        future.command = entry.command
+        future.rtt = None
+        with self._lock:
+            self._waiting[entry] = (drone, future, result_conversion)
+            heapq.heappush(self._deadlines, (entry.sent_at + command_timeout, id(entry), entry))
+        self._wakeup()
+
+    def _complete(self, entry, response):
+        with self._lock:
+            waiting = self._waiting.pop(entry, None)
+        if waiting is None:
+            return
+        drone, future, result_conversion = waiting
+        if response is None:
+            logging.error(f'No Response for Command {entry.command} ({drone.name})')
+            response = 'none_response'
+        else:
+            future.rtt = entry.rtt
+            if result_conversion:
+                response = result_conversion(response)
+        future.set_result(response)
+
+    def _expire_overdue(self):
+        """Expires overdue commands, returns the time until the next deadline"""
+        now = time.monotonic()
+        overdue = []
+        with self._lock:
+            while self._deadlines:
+                deadline, _, entry = self._deadlines[0]
+                if entry not in self._waiting:
+                    heapq.heappop(self._deadlines)
+                elif deadline <= now:
+                    heapq.heappop(self._deadlines)
+                    overdue.append((self._waiting[entry][0], entry))
+                else:
+                    break
+            timeout = self._deadlines[0][0] - now if self._deadlines else None
+        for drone, entry in overdue:
+            drone.commands.expire(entry)
+            self._complete(entry, None)
+        return timeout
+
+    def _run(self):
+        while self._running:
+            timeout = self._expire_overdue()
+            for key, _ in self._selector.select(timeout):
+                sock = key.fileobj
+                if key.data is None:
+                    try:
+                        sock.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    data, address = sock.recvfrom(2048)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError as e:
+                    logging.error(f'Swarm Socket Failed ({e})')
+                    continue
+                if isinstance(key.data, SwarmDrone):
+                    key.data._on_response(data)
+                else:
+                    drone = self._state_routes.get((key.data, address[0]))
+                    if drone is None:
+                        # Single drone on this port (e.g. behind NAT or on localhost)
+                        drones = [d for (port, _), d in self._state_routes.items() if port == key.data]
+                        drone = drones[0] if len(drones) == 1 else None
+                    if drone is not None:
+                        drone._on_state(data)
+
+    def latency_report(self):
+        """Round trip time statistics per drone and command, see :meth:`command_tracker.CommandTracker.rtt_stats`"""
+        return {name: drone.commands.rtt_stats() for name, drone in self.drones.items()}
+
+    def metrics(self):
+        """Metrics registries of all drones, e.g. ``metrics.serve(swarm.metrics)`` also serves drones added later"""
+        return [drone.metrics for drone in list(self.drones.values())]
@@ -0,0 +1,244 @@
+"""
+Typed state records parsed from the state datagrams (port 8890).
+
+SDK 1.3: ``pitch:%d;roll:%d;yaw:%d;vgx:%d;vgy:%d;vgz:%d;templ:%d;temph:%d;tof:%d;h:%d;bat:%d;baro:%.2f;time:%d;
+agx:%.2f;agy:%.2f;agz:%.2f;\\r\\n``
+
+SDK 2.0 additionally starts with ``mid:%d;x:%d;y:%d;z:%d;mpry:%d,%d,%d;``
+"""
+import logging
+import re
+import threading
+
+FIELDS = ('mid', 'x', 'y', 'z', 'mpry', 'pitch', 'roll', 'yaw', 'vgx', 'vgy', 'vgz', 'templ', 'temph', 'tof', 'h',
+          'bat', 'baro', 'time', 'agx', 'agy', 'agz')
+FLOAT_FIELDS = ('baro', 'agx', 'agy', 'agz')
+
+
+def _to_triple(value):
+    return tuple(int(v) for v in value.split(b','))
+
+
+def _to_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value.decode(encoding='utf-8', errors='replace')
+
+
+_CONVERSIONS = {name: float if name in FLOAT_FIELDS else int for name in FIELDS}
+_CONVERSIONS['mpry'] = _to_triple
+
+
+class TelloState:
+    """
+    Numeric state of the drone. Fields of the other SDK version are None, unknown fields are kept in ``extra``.
+
+    Units: pitch, roll, yaw in °, vgx, vgy, vgz in cm/s, templ, temph in °C, tof, h in cm, bat in %, baro in m,
+    time in s, agx, agy, agz in 0.001g, x, y, z in cm (relative to mission pad mid)
+    """
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, mid=None, x=None, y=None, z=None, mpry=None, pitch=None, roll=None, yaw=None, vgx=None,
+                 vgy=None, vgz=None, templ=None, temph=None, tof=None, h=None, bat=None, baro=None, time=None,
+                 agx=None, agy=None, agz=None, extra=None):
+        self.mid = mid
+        self.x = x
+        self.y = y
+        self.z = z
+        self.mpry = mpry
+        self.pitch = pitch
+        self.roll = roll
+        self.yaw = yaw
+        self.vgx = vgx
+        self.vgy = vgy
+        self.vgz = vgz
+        self.templ = templ
+        self.temph = temph
+        self.tof = tof
+        self.h = h
+        self.bat = bat
+        self.baro = baro
+        self.time = time
+        self.agx = agx
+        self.agy = agy
+        self.agz = agz
+        self.extra = extra
+
+    def as_dict(self):
+        d = {name: getattr(self, name) for name in FIELDS if getattr(self, name) is not None}
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+    def __getitem__(self, item):
+        if item in _CONVERSIONS:
+            return getattr(self, item)
+        if self.extra and item in self.extra:
+            return self.extra[item]
+        raise KeyError(item)
+
+    def __repr__(self):
+        return f'TelloState({", ".join(f"{k}={v!r}" for k, v in self.as_dict().items())})'
+
+
+class StateParser:
+    """
+    Parses state datagrams into :class:`TelloState` records. The key order of the first datagram is compiled into a
+    single regex, so the following datagrams are split in one match. If a datagram does not fit (other firmware, other
+    SDK version), the layout is recompiled from that datagram.
+    """
+
+    def __init__(self):
+        self._pattern = None
+        self._conversions = ()
+        self._names = ()
+        # Leading None values if the fields are a known suffix of FIELDS (SDK 1.3 / 2.0), None otherwise
+        self._padding = None
+
+    def _compile(self, data):
+        items = [item.partition(b':') for item in data.rstrip(b'\r\n').rstrip(b';').split(b';')]
+        if not items or any(not sep for _, sep, _ in items):
+            return False
+        names = tuple(k.decode(encoding='utf-8', errors='replace') for k, _, _ in items)
+        self._pattern = re.compile(b';'.join(re.escape(k) + b':([^;]*)' for k, _, _ in items) + b';?\\s*')
+        self._names = names
+        self._conversions = tuple(_CONVERSIONS.get(name, _to_number) for name in names)
+        # Fast path: known fields in record order can be passed positionally
+        offset = len(FIELDS) - len(names)
+        self._padding = (None,) * offset if offset >= 0 and names == FIELDS[offset:] else None
+        return True
+
+    def parse(self, data):
+        """:return: :class:`TelloState`, None if data is not a state datagram"""
+        if isinstance(data, str):
+            data = data.encode(encoding='utf-8')
+        match = self._pattern.fullmatch(data) if self._pattern else None
+        if match is None:
+            if b';' not in data or not self._compile(data):
+                return None
+            match = self._pattern.fullmatch(data)
+            if match is None:
+                return None
+        try:
+            values = [conv(v) for conv, v in zip(self._conversions, match.groups())]
+        except ValueError:
+            return None
+
+        if self._padding is not None:
+            return TelloState(*self._padding, *values)
+        state = TelloState()
+        extra = None
+        for name, value in zip(self._names, values):
+            if name in _CONVERSIONS:
+                setattr(state, name, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[name] = value
+        state.extra = extra
+        return state
+
+
+class StateSubscription:
+    """
+    Latest-value-wins view on the state stream, states received between two :meth:`get` calls are skipped. Create
+    with :meth:`StatePublisher.subscribe`.
+    """
+
+    def __init__(self, publisher):
+        self._publisher = publisher
+        self._seen = publisher.sequence
+
+    def get(self, timeout=None):
+        """
+        Waits for a state newer than the last one returned
+
+        :return: (state, received_at), None on timeout
+        """
+        cond = self._publisher._cond
+        with cond:
+            if not cond.wait_for(lambda: self._publisher.sequence != self._seen, timeout):
+                return None
+            self._seen = self._publisher.sequence
+            return self._publisher.latest
+
+    def poll(self):
+        """Same as :meth:`get`, but returns None immediately if there is no newer state"""
+        return self.get(0)
+
+    def close(self):
+        self._publisher.unsubscribe(self)
+
+
+class StatePublisher:
+    """Distributes received states to callbacks (called on the receiver thread) and :class:`StateSubscription`"""
+
+    def __init__(self):
+        self.sequence = 0
+        self.latest = None
+        self._cond = threading.Condition()
+        # Replaced on change, so publish can iterate without holding the lock
+        self._callbacks = ()
+        self._subscriptions = ()
+
+    def publish(self, state, received_at):
+        with self._cond:
+            self.latest = (state, received_at)
+            self.sequence += 1
+            if self._subscriptions:
+                self._cond.notify_all()
+        for callback in self._callbacks:
+            try:
+                callback(state, received_at)
+            except Exception:
+                logging.exception(f'State callback {callback} failed')
+
+    def subscribe(self, callback=None):
+        """
+        :param callback: called with (state, received_at) for every state. If None, a :class:`StateSubscription` is
+                         returned instead.
+        """
+        with self._cond:
+            if callback is not None:
+                self._callbacks += (callback,)
+                return callback
+            subscription = StateSubscription(self)
+            self._subscriptions += (subscription,)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._cond:
+            self._callbacks = tuple(c for c in self._callbacks if c != subscription)
+            self._subscriptions = tuple(s for s in self._subscriptions if s is not subscription)
+
+
+if __name__ == '__main__':
+    import timeit
+
+    samples = {
+        '1.3': b'pitch:0;roll:-1;yaw:12;vgx:0;vgy:0;vgz:0;templ:62;temph:65;tof:10;h:0;bat:87;baro:-51.36;time:0;'
+               b'agx:-2.00;agy:10.00;agz:-999.00;\r\n',
+        '2.0': b'mid:-1;x:0;y:0;z:0;mpry:0,0,0;pitch:0;roll:-1;yaw:12;vgx:0;vgy:0;vgz:0;templ:62;temph:65;tof:10;'
+               b'h:0;bat:87;baro:-51.36;time:0;agx:-2.00;agy:10.00;agz:-999.00;\r\n',
+    }
+
+    # Previous implementation in DroneInterface._receive_state (strings only)
+    def legacy_parse(data):
+        data = data.decode(encoding='utf-8')
+        states = data.replace(';\r\n', '').split(';')
+        return {s[0]: s[1] for s in map(lambda item: item.split(':'), states)}
+
+    for sdk, sample in samples.items():
+        parser = StateParser()
+        parser.parse(sample)
+        number = 100_000
+        for name, f in (('dict (strings)', lambda: legacy_parse(sample)),
+                        ('dict + int()/float()', lambda: {k: _to_number(v.encode()) for k, v in
+                                                          legacy_parse(sample).items()}),
+                        ('StateParser', lambda: parser.parse(sample))):
+            t = timeit.timeit(f, number=number)
+            print(f'SDK {sdk}  {name:22s} {t / number * 1e6:6.2f} us/datagram')
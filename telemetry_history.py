@@ -0,0 +1,126 @@
+"""
+Fixed size history of :class:`telemetry.TelloState` records, stored column by column in a NumPy array.
+
+Requires numpy (only this module, the rest of the library works without it).
+
+    history = TelemetryHistory()
+    drone.subscribe_state(history.append)
+"""
+import operator
+import time
+
+import numpy as np
+
+from telemetry import FIELDS
+
+# mpry is split into its three components, all other fields map to one column
+COLUMNS = ('t',) + tuple(c for f in FIELDS for c in (('mpry_p', 'mpry_r', 'mpry_y') if f == 'mpry' else (f,)))
+_MPRY = FIELDS.index('mpry')
+_NAN3 = (np.nan,) * 3
+_get_fields = operator.attrgetter(*FIELDS)
+
+
+class TelemetryHistory:
+    """
+    Ring buffer of the last ``capacity`` states with their (monotonic) receive time. Missing fields are NaN.
+
+    There is a single writer (the state receiver), :meth:`append` takes no lock. Readers copy the requested rows and
+    discard the ones that were overwritten while copying, so queries never block the receiver.
+    """
+
+    def __init__(self, capacity=3000):
+        self.capacity = capacity
+        self._index = {name: i for i, name in enumerate(COLUMNS)}
+        # One contiguous row per column, so column queries are plain slices
+        self._data = np.full((len(COLUMNS), capacity), np.nan)
+        # Number of samples written, _pending is increased before and _count after writing a sample
+        self._count = 0
+        self._pending = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def nbytes(self):
+        return self._data.nbytes
+
+    def append(self, state, received_at=None):
+        values = list(_get_fields(state))
+        mpry = values[_MPRY]
+        values[_MPRY:_MPRY + 1] = _NAN3 if mpry is None else mpry
+        count = self._count
+        self._pending = count + 1
+        self._data[:, count % self.capacity] = [
+            time.monotonic() if received_at is None else received_at] + [np.nan if v is None else v for v in values]
+        self._count = count + 1
+
+    def clear(self):
+        self._count = self._pending = 0
+
+    def _snapshot(self, rows, columns):
+        """Copies the last ``rows`` samples of the given columns, oldest first"""
+        count = self._count
+        rows = min(rows, count, self.capacity)
+        start = count - rows
+        idx = np.arange(start, count) % self.capacity
+        data = self._data[np.ix_(columns, idx)] if isinstance(columns, list) else self._data[columns, idx]
+        # Rows that the writer overwrote (or is overwriting) in the meantime are not valid anymore
+        overwritten = self._pending - self.capacity - start
+        if overwritten > 0:
+            data = data[..., overwritten:]
+        return data
+
+    def _columns(self, fields):
+        if isinstance(fields, str):
+            return self._index[fields]
+        return [self._index[f] for f in fields]
+
+    def last(self, n, fields=COLUMNS):
+        """Last n samples, 1d array for a single field, 2d (field, sample) array for several fields"""
+        return self._snapshot(n, self._columns(fields))
+
+    def window(self, seconds, fields=COLUMNS, now=None):
+        """All samples received in the last ``seconds``, see :meth:`last`"""
+        if now is None:
+            now = time.monotonic()
+        columns = self._columns(fields)
+        single = not isinstance(columns, list)
+        data = self._snapshot(self.capacity, [0] + ([columns] if single else columns))
+        data = data[1:, data[0] >= now - seconds]
+        return data[0] if single else data
+
+    def series(self, field, seconds, now=None):
+        """(timestamps, values) of one field over the last ``seconds``"""
+        return tuple(self.window(seconds, ('t', field), now))
+
+    def stats(self, field, seconds, now=None):
+        """mean / min / max / count of a field over the last ``seconds`` (NaN if there are no samples)"""
+        values = self.window(seconds, field, now)
+        values = values[~np.isnan(values)]
+        if not values.size:
+            return {'count': 0, 'mean': np.nan, 'min': np.nan, 'max': np.nan}
+        return {'count': values.size, 'mean': values.mean(), 'min': values.min(), 'max': values.max()}
+
+    def downsample(self, field, seconds, bucket, now=None):
+        """
+        Averages a field over buckets of ``bucket`` seconds
+
+        :return: (bucket start times, mean values), empty buckets are left out
+        """
+        t, values = self.series(field, seconds, now)
+        if not t.size:
+            return t, values
+        keys = np.floor((t - t[0]) / bucket).astype(np.int64)
+        valid = ~np.isnan(values)
+        sums = np.bincount(keys[valid], weights=values[valid])
+        counts = np.bincount(keys[valid])
+        filled = counts > 0
+        return t[0] + np.nonzero(filled)[0] * bucket, sums[filled] / counts[filled]
+
+    def to_structured(self, seconds=None, now=None):
+        """Exports the history (or the last ``seconds``) as structured array with one named float64 field per column"""
+        data = self.last(self.capacity) if seconds is None else self.window(seconds, COLUMNS, now)
+        out = np.empty(data.shape[1], dtype=[(name, 'f8') for name in COLUMNS])
+        for i, name in enumerate(COLUMNS):
+            out[name] = data[i]
+        return out
@@ -0,0 +1,223 @@
+"""
+Persistent telemetry of any number of drones in a SQLite database (WAL mode), one row per state and one column per
+field, partitioned by drone and flight.
+
+    sink = TelemetrySink('fleet.db')
+    for drone in swarm:
+        sink.attach(drone)
+    ...
+    sink.new_flight(swarm['a'])  # e.g. before the next take off
+    ...
+    sink.close()
+
+    flight = flights('fleet.db', drone='a')[-1]
+    data = load('fleet.db', flight=flight['id'], fields=('h', 'bat'))  # {'t': array, 'flight': array, 'h': ...}
+
+Recording only needs the standard library, :func:`load` requires numpy.
+"""
+import logging
+import operator
+import sqlite3
+import threading
+import time
+
+from telemetry import FIELDS
+from utils import PeriodicEmitter
+
+# Same columns as telemetry_history.COLUMNS (without t): mpry is split into its three components
+COLUMNS = tuple(c for f in FIELDS for c in (('mpry_p', 'mpry_r', 'mpry_y') if f == 'mpry' else (f,)))
+_MPRY = FIELDS.index('mpry')
+_NONE3 = (None,) * 3
+_get_fields = operator.attrgetter(*FIELDS)
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS flights (id INTEGER PRIMARY KEY, drone TEXT NOT NULL, started_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS flights_drone ON flights (drone, started_at);
+CREATE TABLE IF NOT EXISTS states (flight INTEGER NOT NULL, t REAL NOT NULL, {', '.join(f'{c} REAL' for c in COLUMNS)});
+CREATE INDEX IF NOT EXISTS states_flight_t ON states (flight, t);
+"""
+_INSERT = f'INSERT INTO states VALUES ({", ".join("?" * (len(COLUMNS) + 2))})'
+
+
+def _connect(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    # WAL stays consistent without a sync per transaction, a power loss only loses the last batches
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript(_SCHEMA)
+    return db
+
+
+class _Feed:
+    """State callback of one attached drone, appends to the buffer of the sink"""
+    __slots__ = ('sink', 'drone', 'name', 'flight')
+
+    def __init__(self, sink, drone, name, flight):
+        self.sink = sink
+        self.drone = drone
+        self.name = name
+        self.flight = flight
+
+    def __call__(self, state, received_at):
+        sink = self.sink
+        with sink._lock:
+            if len(sink._buffer) >= sink.max_buffer:
+                sink.dropped += 1
+                return
+            sink._buffer.append((self.flight, received_at, state))
+            sink.records += 1
+
+
+class TelemetrySink:
+    """
+    Records the states of attached drones. The receiver threads only append (flight, received_at, state) to an
+    in-memory buffer under a lock, a background thread converts the buffer to rows and inserts them in one transaction
+    (``executemany``) every ``flush_interval`` seconds. If the disk cannot keep up, states beyond ``max_buffer`` are
+    dropped (counted in ``dropped``) instead of growing without bounds or blocking the receivers.
+
+    Timestamps are stored as wall clock (time.time()) seconds.
+    """
+
+    def __init__(self, path, flush_interval=1.0, max_buffer=1_000_000):
+        self.path = path
+        self.max_buffer = max_buffer
+        self.records = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+
+        self._db = _connect(path)
+        # received_at is monotonic, same offset for all drones
+        self._clock_offset = time.time() - time.monotonic()
+        self._buffer = []
+        self._lock = threading.Lock()
+        # Serializes the use of the connection (flushes, new flights)
+        self._write_lock = threading.Lock()
+        self._feeds = {}  # drone -> _Feed
+        self._flusher = PeriodicEmitter(flush_interval, self.flush)
+        self._flusher.start()
+
+    def _start_flight(self, name):
+        with self._write_lock, self._db:
+            return self._db.execute('INSERT INTO flights (drone, started_at) VALUES (?, ?)',
+                                    (name, time.time())).lastrowid
+
+    def attach(self, drone, name=None):
+        """
+        Records the states of drone (anything with subscribe_state) in a new flight
+
+        :param name: Name of the drone in the database, defaults to its name (:class:`swarm.SwarmDrone`) or ip:port
+        :return: Id of the flight
+        """
+        if drone in self._feeds:
+            return self._feeds[drone].flight
+        if name is None:
+            name = getattr(drone, 'name', None) or '%s:%d' % drone.tello_address
+        feed = _Feed(self, drone, name, self._start_flight(name))
+        self._feeds[drone] = feed
+        drone.subscribe_state(feed)
+        return feed.flight
+
+    def detach(self, drone):
+        feed = self._feeds.pop(drone, None)
+        if feed is not None:
+            drone.unsubscribe_state(feed)
+
+    def new_flight(self, drone):
+        """Starts a new flight of an attached drone, following states are stored in it. :return: Id of the flight"""
+        feed = self._feeds[drone]
+        feed.flight = self._start_flight(feed.name)
+        return feed.flight
+
+    def flush(self):
+        with self._lock:
+            buffer, self._buffer = self._buffer, []
+        if not buffer:
+            return
+        offset = self._clock_offset
+        rows = []
+        for flight, received_at, state in buffer:
+            values = list(_get_fields(state))
+            mpry = values[_MPRY]
+            values[_MPRY:_MPRY + 1] = _NONE3 if mpry is None else mpry
+            rows.append((flight, received_at + offset, *values))
+        try:
+            with self._write_lock, self._db:
+                self._db.executemany(_INSERT, rows)
+        except sqlite3.Error:
+            logging.exception(f'Writing {len(rows)} states to {self.path} failed')
+            self.dropped += len(rows)
+            return
+        self.written += len(rows)
+        self.flushes += 1
+
+    def close(self):
+        for drone in list(self._feeds):
+            self.detach(drone)
+        self._flusher.stop()
+        self.flush()
+        with self._write_lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def flights(path, drone=None):
+    """:return: list of {id, drone, started_at, states} ordered by start, of all drones or one"""
+    db = sqlite3.connect(path)
+    try:
+        rows = db.execute('SELECT f.id, f.drone, f.started_at, (SELECT COUNT(*) FROM states s WHERE s.flight = f.id) '
+                          'FROM flights f' + (' WHERE f.drone = ?' if drone is not None else '') +
+                          ' ORDER BY f.started_at, f.id', () if drone is None else (drone,)).fetchall()
+    finally:
+        db.close()
+    return [{'id': i, 'drone': d, 'started_at': s, 'states': n} for i, d, s, n in rows]
+
+
+def load(path, drone=None, flight=None, start=None, end=None, fields=COLUMNS):
+    """
+    Loads the states of a time range as NumPy arrays, ordered by flight and time. Missing values are NaN.
+
+    :param drone: Name of the drone, None for all
+    :param flight: Id (or list of ids) of flights, None for all
+    :param start: Wall clock time in s (time.time()), None for no limit
+    :param end: see start
+    :return: dict of column -> 1d float64 array, with the columns t, flight and the requested fields
+    """
+    import numpy as np
+
+    if isinstance(fields, str):
+        fields = (fields,)
+    unknown = set(fields) - set(COLUMNS)
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+    conditions, params = [], []
+    if drone is not None:
+        conditions.append('flight IN (SELECT id FROM flights WHERE drone = ?)')
+        params.append(drone)
+    if flight is not None:
+        flight = [flight] if isinstance(flight, int) else list(flight)
+        conditions.append(f'flight IN ({", ".join("?" * len(flight))})')
+        params += flight
+    if start is not None:
+        conditions.append('t >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('t <= ?')
+        params.append(end)
+    columns = ('t', 'flight') + tuple(fields)
+    query = (f'SELECT {", ".join(columns)} FROM states' + (' WHERE ' + ' AND '.join(conditions) if conditions else '')
+             + ' ORDER BY flight, t')
+
+    db = sqlite3.connect(path)
+    try:
+        rows = db.execute(query, params).fetchall()
+    finally:
+        db.close()
+    # None (NULL) converts to NaN
+    data = np.array(rows, dtype=np.float64).reshape(len(rows), len(columns))
+    return {name: data[:, i].copy() for i, name in enumerate(columns)}
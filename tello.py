@@ -1,10 +1,16 @@
 import logging
-import queue
+import select
 import socket
 import threading
 import time
 
-from utils import validate_bounds as validate, try_to_int, AtomicInteger
+import commands
+from capture import CaptureWriter, CHANNEL_COMMAND, CHANNEL_STATE
+from command_tracker import CommandTracker
+from metrics import MetricsRegistry, RateGauge
+from scheduler import get_scheduler
+from telemetry import StateParser, StatePublisher
+from video import VideoReceiver
 from abc import ABC, abstractmethod
 
 
@@ -12,21 +18,20 @@ class DroneInterface(ABC):
     TELLO_COMMAND_PORT = 8889
     TELLO_VIDEO_PORT = 11111
     TELLO_STATE_PORT = 8890
+    capture = None
+    _closed = False
 
     def __init__(self, local_ip='', local_port=8889, state_interval=0.2, command_timeout=3.0, move_timeout=15.0,
-                 tello_ip='192.168.10.1'):
+                 tello_ip='192.168.10.1', max_in_flight=4, local_state_port=TELLO_STATE_PORT,
+                 tello_port=TELLO_COMMAND_PORT, state_max_age=1.0):
+        """
+        :param state_max_age: Telemetry getters (battery, height, ...) are answered from a state at most this many
+                              seconds old instead of sending a query. None to always send the query.
+        """
 
-        self.state_interval = state_interval
-        self.command_timeout = command_timeout
-        self.move_timeout = move_timeout
-
-        self.response_queue = queue.Queue(1)
-        self.scheduled_responses = AtomicInteger()
-        self.states = {}
-
-        self.tello_address = (tello_ip, self.TELLO_COMMAND_PORT)
-        self.local_state_port = self.TELLO_STATE_PORT
-        self.local_video_port = self.TELLO_VIDEO_PORT
+        self.state_interval = state_interval  # Unused, the state receiver always keeps the freshest state
+        self._init_state(tello_ip, tello_port, local_ip, local_state_port, command_timeout, move_timeout,
+                         max_in_flight, state_max_age)
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket_state = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -45,260 +50,374 @@ class DroneInterface(ABC):
         self.socket.close()
         self.socket_state.close()
 
+    def close(self):
+        """Stops the heartbeat, video receiver, capture and receiver threads and closes the sockets"""
+        if self._closed:
+            return
+        self._closed = True
+        self.stop_heartbeat()
+        if self.video is not None:
+            self.video.stop()
+            self.video = None
+        self.stop_capture()
+        self._close_sockets()
+
+    def _close_sockets(self):
+        for sock, thread in ((self.socket, self.receive_ack_thread), (self.socket_state, self.receive_state_thread)):
+            try:
+                # Wakes up the receiver blocked in recv (on Linux also for unconnected UDP sockets)
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            thread.join(1.0)
+            sock.close()
+
+    def _init_state(self, tello_ip, tello_port, local_ip, local_state_port, command_timeout, move_timeout,
+                    max_in_flight, state_max_age):
+        """Setup independent of the sockets and receiver threads, shared with :class:`swarm.SwarmDrone`"""
+        self.command_timeout = command_timeout
+        self.move_timeout = move_timeout
+        self.state_max_age = state_max_age
+
+        self.commands = CommandTracker(max_in_flight)
+        # (state, received_at) replaced in one assignment, readers never pair a state with the time of another
+        self._latest = (None, None)
+        self.dropped_states = 0
+        self.heartbeat_task = None
+        self.state_updates = StatePublisher()
+        self._state_parser = StateParser()
+
+        self.tello_address = (tello_ip, tello_port)
+        self.local_ip = local_ip
+        self.local_state_port = local_state_port
+        self.local_video_port = self.TELLO_VIDEO_PORT
+        self.video = None
+        self._init_metrics()
+        self.metrics.gauge('tello_states_dropped_total', lambda: self.dropped_states,
+                           'State datagrams skipped for a fresher one', type='counter')
+
+    def _init_metrics(self):
+        """
+        Creates :attr:`metrics`, a :class:`metrics.MetricsRegistry` labelled with the drone's address. The receive and
+        send paths only increment the counters kept here, everything else is read when the metrics are collected.
+        """
+        ip, port = self.tello_address
+        self.metrics = metrics = MetricsRegistry(drone=f'{ip}:{port}')
+        self._packets_sent = metrics.counter('tello_packets_sent_total', 'Datagrams sent', socket='command')
+        self._bytes_sent = metrics.counter('tello_bytes_sent_total', 'Bytes sent', socket='command')
+        self._packets_received = metrics.counter('tello_packets_received_total', 'Datagrams received',
+                                                 socket='command')
+        self._bytes_received = metrics.counter('tello_bytes_received_total', 'Bytes received', socket='command')
+        self._state_packets = metrics.counter('tello_packets_received_total', socket='state')
+        self._state_bytes = metrics.counter('tello_bytes_received_total', socket='state')
+        self._states_parsed = metrics.counter('tello_states_total', 'State datagrams parsed')
+        self._state_errors = metrics.counter('tello_state_errors_total', 'State datagrams that could not be parsed')
+        self._rtt_histograms = {}
+
+        commands = self.commands
+        commands.observer = self._observe_rtt
+        metrics.gauge('tello_command_timeouts_total', lambda: commands.timeouts, 'Commands without response in time',
+                      type='counter')
+        metrics.gauge('tello_late_responses_total', lambda: commands.late_responses,
+                      'Responses discarded because their command had timed out', type='counter')
+        metrics.gauge('tello_unmatched_responses_total', lambda: commands.unmatched_responses,
+                      'Responses without a matching command', type='counter')
+        metrics.gauge('tello_commands_in_flight', commands.in_flight, 'Commands awaiting their response')
+        metrics.gauge('tello_state_age_seconds', self.get_state_age, 'Seconds since the last state was received')
+        metrics.gauge('tello_state_rate', RateGauge(lambda: self._states_parsed.value),
+                      'States per second since the previous collection')
+        self._state_cache_hits = metrics.counter('tello_state_cache_total', 'Telemetry getters answered from the state '
+                                                 'stream (hit) or by a query (miss)', result='hit')
+        self._state_cache_misses = metrics.counter('tello_state_cache_total', result='miss')
+
+    def _observe_rtt(self, command, rtt):
+        name = command.split(' ', 1)[0]
+        histogram = self._rtt_histograms.get(name)
+        if histogram is None:
+            histogram = self._rtt_histograms[name] = self.metrics.histogram(
+                'tello_command_rtt_seconds', 'Round trip time of completed commands', command=name)
+        histogram.observe(rtt)
+
     def _receive_ack(self):
-        while True:
+        while not self._closed:
             try:
                 data, _ = self.socket.recvfrom(1518)
-                if data:
-                    if self.scheduled_responses.value == 0:
-                        self.response_queue.put(data.decode(encoding='utf-8'))
-                    else:
-                        self.scheduled_responses.dec()
-                        logging.warning('Not Putting Response into Queue. Response probably from other Command that '
-                                        f'timed out (Response Value: {data})')
+                self._packets_received.inc()
+                self._bytes_received.inc(len(data))
+                capture = self.capture
+                if capture is not None:
+                    capture.record(CHANNEL_COMMAND, False, data)
+                self._on_ack_datagram(data)
             except socket.error:
+                if self._closed:
+                    break
                 logging.error('Ack Socket Failed')
+
+    def _on_ack_datagram(self, data):
+        if data:
+            try:
+                self.commands.match(data.decode(encoding='utf-8').rstrip('\r\n'))
             except UnicodeDecodeError:
                 logging.error('Illegal Answer?')
 
     def _receive_state(self):
-        while True:
+        while not self._closed:
             try:
-                data, ip = self.socket_state.recvfrom(1024)
-                if data:
-                    data = data.decode(encoding='utf-8')
-                    if ';' in data:
-                        states = data.replace(';\r\n', '').split(';')
-                        self.states = {s[0]: s[1] for s in map(lambda item: item.split(':'), states)}
-
-                time.sleep(self.state_interval)
+                data = self.socket_state.recv(1024)
+                self._state_packets.inc()
+                self._state_bytes.inc(len(data))
+                capture = self.capture
+                if capture is not None:
+                    capture.record(CHANNEL_STATE, False, data)
+                # Drain the socket buffer, only the freshest state is of interest
+                while not self._closed and select.select((self.socket_state,), (), (), 0)[0]:
+                    data = self.socket_state.recv(1024)
+                    self._state_packets.inc()
+                    self._state_bytes.inc(len(data))
+                    if capture is not None:
+                        capture.record(CHANNEL_STATE, False, data)
+                    self.dropped_states += 1
+                self._on_state_datagram(data)
             except socket.error:
+                if self._closed:
+                    break
                 logging.error('State Socket Failed')
-            except UnicodeDecodeError:
-                logging.error('Illegal Answer?')
 
-    def send_command(self, command, command_timeout=None, none_response=False):
+    def _on_state_datagram(self, data):
+        if data:
+            state = self._state_parser.parse(data)
+            if state is None:
+                self._state_errors.inc()
+            else:
+                self._states_parsed.inc()
+                self._on_state_received(state, time.monotonic())
+
+    def _send(self, command):
+        data = command.encode(encoding='utf-8')
+        self.socket.sendto(data, self.tello_address)
+        self._packets_sent.inc()
+        self._bytes_sent.inc(len(data))
+        capture = self.capture
+        if capture is not None:
+            capture.record(CHANNEL_COMMAND, True, data)
+
+    def start_capture(self, path, **kwargs):
+        """
+        Records all datagrams sent and received on the command and state sockets to a file, see :mod:`capture`.
+        kwargs are passed to :class:`capture.CaptureWriter`
+        """
+        self.stop_capture()
+        self.capture = CaptureWriter(path, **kwargs)
+        return self.capture
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+
+    def replay_handlers(self):
+        """Receive handlers per capture channel, for :meth:`capture.CaptureReplay.run`"""
+        return {CHANNEL_COMMAND: self._on_ack_datagram, CHANNEL_STATE: self._on_state_datagram}
+
+    @property
+    def state(self):
+        """Latest :class:`telemetry.TelloState`, None if no state was received yet"""
+        return self._latest[0]
+
+    @property
+    def state_received_at(self):
+        """time.monotonic() when :attr:`state` was received"""
+        return self._latest[1]
+
+    def _on_state_received(self, state, received_at):
+        self._latest = (state, received_at)
+        self.state_updates.publish(state, received_at)
+
+    def subscribe_state(self, callback=None):
+        """
+        Subscribes to state updates instead of polling :attr:`state`, e.g. ``drone.subscribe_state(history.append)``
+        for a :class:`telemetry_history.TelemetryHistory`
+
+        :param callback: Called with (state, received_at) on the receiver thread for every state. If None, a
+                         :class:`telemetry.StateSubscription` (latest-value-wins, blocking get) is returned.
+        """
+        return self.state_updates.subscribe(callback)
+
+    def unsubscribe_state(self, subscription):
+        self.state_updates.unsubscribe(subscription)
+
+    def start_heartbeat(self, interval=5.0, command='command', scheduler=None):
+        """
+        Sends command every interval seconds from the shared :class:`scheduler.Scheduler`, so that the drone does not
+        land (it does after 15 s without any command). Does not block, the response is only matched by the tracker.
+        """
+        last = None
+
+        def _beat():
+            nonlocal last
+            if last is not None:
+                self.commands.expire(last)  # Does nothing if it was answered
+            try:
+                last = self.commands.register(command, timeout=0)
+            except TimeoutError:
+                logging.warning('Skipping heartbeat, too many commands in flight')
+                return
+            self._send(command)
+
+        self.stop_heartbeat()
+        self.heartbeat_task = (scheduler or get_scheduler()).call_every(interval, _beat, name=f'heartbeat {command}')
+        return self.heartbeat_task
+
+    def stop_heartbeat(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+
+    def start_video(self, **kwargs):
+        """
+        Starts receiving the video stream (``streamon``) into a :class:`video.VideoReceiver` (``self.video``), kwargs
+        are passed to the receiver
+        """
+        if self.video is None:
+            self.video = VideoReceiver(self.local_ip, self.local_video_port, **kwargs)
+            self.video.start()
+        return self.send_command('streamon')
+
+    def stop_video(self):
+        response = self.send_command('streamoff')
+        if self.video is not None:
+            self.video.stop()
+            self.video = None
+        return response
+
+    def _query_state(self, command, result_conversion=None):
+        """
+        Answers a query from the latest state if it is at most :attr:`state_max_age` old (formatted like the response
+        to the query), sends the query otherwise
+        """
+        max_age = self.state_max_age
+        if max_age is not None:
+            field, response = _STATE_QUERIES[command]
+            state, received_at = self._latest
+            if state is not None and time.monotonic() - received_at <= max_age and getattr(state, field) is not None:
+                self._state_cache_hits.inc()
+                response = response(state)
+                return result_conversion(response) if result_conversion else response
+            self._state_cache_misses.inc()
+        return self.send_command(command, result_conversion=result_conversion)
+
+    def state_cache_stats(self):
+        """Number of telemetry getter calls answered from the state stream (hits) and by a query (misses)"""
+        return {'hits': self._state_cache_hits.value, 'misses': self._state_cache_misses.value}
+
+    def get_state_age(self):
+        """Seconds since the current state was received, None if no state was received yet"""
+        received_at = self._latest[1]
+        if received_at is None:
+            return None
+        return time.monotonic() - received_at
+
+    def send_command(self, command, command_timeout=None, none_response=False, result_conversion=None):
         if command_timeout is None:
             command_timeout = self.command_timeout
         print('>> Send Command:', command)
 
-        self.socket.sendto(command.encode(encoding='utf-8'), self.tello_address)
-
         if none_response:
+            self._send(command)
             logging.debug(f'Not awaiting response for command {command}')
             return 'ok'
-        try:
-            command_response = self.response_queue.get(timeout=command_timeout)
-        except queue.Empty:
-            logging.error("Empty Response Queue")
-            self.scheduled_responses.inc()
-            command_response = "none_response"
 
-        if command.endswith("?"):
-            command_response = command_response.replace("\r\n", "")
+        entry = self.commands.register(command)
+        self._send(command)
+        return self._await_response(entry, command_timeout, result_conversion)
+
+    def send_queries(self, *commands, command_timeout=None, result_conversion=None):
+        """
+        Sends the commands back to back without waiting for each response (at most max_in_flight at a time, further
+        commands are sent as responses free slots). command_timeout applies to the whole batch.
+
+        :return: List of responses in the same order, 'none_response' for commands not answered (or not even sent)
+                 in time
+        """
+        if command_timeout is None:
+            command_timeout = self.command_timeout
+        deadline = time.monotonic() + command_timeout
+        entries = []
+        for command in commands:
+            try:
+                entry = self.commands.register(command, max(0.0, deadline - time.monotonic()))
+            except TimeoutError:
+                logging.error(f'No free slot to send {len(commands) - len(entries)} command(s) in time')
+                break
+            print('>> Send Command:', command)
+            entries.append(entry)
+            self._send(command)
+        # Expires the entries still in flight once the deadline passed
+        responses = [self._await_response(entry, max(0.0, deadline - time.monotonic()), result_conversion)
+                     for entry in entries]
+        unsent = len(commands) - len(entries)
+        if unsent:
+            response = 'none_response'
+            responses += [result_conversion(response) if result_conversion else response] * unsent
+        return responses
+
+    def _await_response(self, entry, command_timeout, result_conversion):
+        if entry.wait(command_timeout) and entry.response is not None:
+            command_response = entry.response
+        else:
+            logging.error(f'No Response for Command {entry.command}')
+            self.commands.expire(entry)
+            command_response = entry.response or 'none_response'
 
         logging.debug(command_response)
+        if result_conversion:
+            command_response = result_conversion(command_response)
         return command_response
 
+    @property
+    def states(self):
+        """Last state as dict of numeric values, see :attr:`state` for the :class:`telemetry.TelloState` record"""
+        return {} if self.state is None else self.state.as_dict()
+
     @abstractmethod
     def get_sdk_name(self):
         pass
 
     def reset_queue(self):
-        self.scheduled_responses.value = 0
+        self.commands.reset()
 
 
-def _validate_move_distance(dist):
-    return validate(dist, 20, 500)
+# Query -> (state field that must be present, response to the query built from the state). Units of the queries
+# differ from the state: height in dm, tof in mm
+_STATE_QUERIES = {
+    'battery?': ('bat', lambda s: str(s.bat)),
+    'time?': ('time', lambda s: f'{s.time}s'),
+    'height?': ('h', lambda s: f'{s.h // 10}dm'),
+    'temp?': ('templ', lambda s: f'{s.templ}~{s.temph}C'),
+    'attitude?': ('pitch', lambda s: f'pitch:{s.pitch};roll:{s.roll};yaw:{s.yaw};'),
+    'baro?': ('baro', lambda s: f'{s.baro:.2f}'),
+    'acceleration?': ('agx', lambda s: f'agx:{s.agx:.2f};agy:{s.agy:.2f};agz:{s.agz:.2f};'),
+    'tof?': ('tof', lambda s: f'{s.tof * 10}mm'),
+}
 
 
+@commands.generate(commands.SDK_1_3)
 class Drone1_3(DroneInterface):
+    """Commands of SDK 1.3, the methods are generated from :data:`commands.SPECS`"""
+
     def get_sdk_name(self):
         return "1.3"
 
-    def enter_sdk_mode(self):
-        return self.send_command('command')
-
-    def start_stream(self):
-        return self.send_command('streamon')
-
-    def stop_stream(self):
-        return self.send_command('streamoff')
-
-    def take_off(self):
-        return self.send_command('takeoff', self.move_timeout)
-
-    def land(self):
-        return self.send_command('land', self.move_timeout)
-
-    def emergency(self):
-        return self.send_command('emergency', none_response=True)  # For some reason does not send any response
-
-    def _move(self, direction, distance):
-        return self.send_command(f'{direction} {_validate_move_distance(distance)}', self.move_timeout)
-
-    def move_backward(self, distance):
-        return self._move('back', distance)
-
-    def move_forward(self, distance):
-        return self._move('forward', distance)
-
-    def move_left(self, distance):
-        return self._move('left', distance)
-
-    def move_right(self, distance):
-        return self._move('right', distance)
-
-    def move_up(self, distance):
-        return self._move('up', distance)
-
-    def move_down(self, distance):
-        return self._move('down', distance)
-
-    def _turn(self, direction, degree):
-        return self.send_command(f'{direction} {self._validate_degree(degree)}', self.move_timeout)
-
-    def clockwise(self, degree):
-        return self._turn('cw', degree)
-
-    def counter_clockwise(self, degree):
-        return self._turn('ccw', degree)
-
-    def _flip(self, direction):
-        return self.send_command(f'flip {direction}')
-
-    def flip_left(self):
-        return self._flip('l')
-
-    def flip_right(self):
-        return self._flip('r')
-
-    def flip_forward(self):
-        return self._flip('f')
-
-    def flip_backward(self):
-        return self._flip('b')
-
-    def go_location(self, x, y, z, speed):
-        return self.send_command(self._go_location_command(x, y, z, speed), self.move_timeout)
-
-    def curve(self, x1, y1, z1, x2, y2, z2, speed):
-        return self.send_command(self._curve_command(x1, y1, z1, x2, y2, z2, speed), self.move_timeout)
-
-    def set_speed(self, speed):
-        return self.send_command(f'speed {validate(speed, 10, 100)}')
-
-    def set_rc(self, a, b, c, d):
-        for x in (a, b, c, d):
-            assert -100 < x < 100
-        return self.send_command(f'rc {a} {b} {c} {d}')
-
-    def set_wifi_password(self, ssid, passwd):
-        return self.send_command(f'wifi {ssid} {passwd}')
-
-    def get_speed(self):  # Unit: cm/s
-        return try_to_int(self.send_command('speed?'))
-
-    def get_battery(self):  # Unit: %
-        return try_to_int(self.send_command('battery?'))
-
-    def get_flight_time(self):  # Unit: s
-        return try_to_int(self.send_command('time?'))
-
-    def get_height(self):  # Unit: cm
-        return try_to_int(self.send_command('height?'))
-
-    def get_temp(self):  # Unit: °C
-        return try_to_int(self.send_command('temp?'))
-
-    def get_attitude(self):  # IMU Attitude Data
-        return self.send_command('attitude?')
-
-    def get_barometer(self):  # Unit: m
-        return self.send_command('baro?')
-
-    def get_acceleration(self):  # Unit: 0.001g
-        return self.send_command('acceleration?')
-
-    def get_tof_distance(self):
-        return self.send_command('tof?')
-
-    def get_wifi_snr(self):
-        return self.send_command('wifi?')
-
     def get_last_states(self):
         return self.states
 
-    def _validate_distance(self, dist):
-        return validate(dist, 20, 500)
-
-    def _validate_degree(self, degree):
-        return validate(degree, 1, 3600)
-
-    def _go_location_command(self, x, y, z, speed):
-        dist = ' '.join(map(self._validate_distance, (x, y, z)))
-
-        return f'go {dist} {validate(speed, 10, 100)}'
-
-    def _curve_command(self, x1, y1, z1, x2, y2, z2, speed):
-        dist = ' '.join(map(self._validate_distance, (x1, y1, z1, x2, y2, z2)))
-
-        return f'curve {dist} {validate(speed, 10, 60)}'
+    def get_last_state(self):
+        return self.state
 
 
+@commands.generate(commands.SDK_2_0)
 class Drone2_0(Drone1_3):
+    """SDK 2.0: wider bounds, stop, mission pads, ... The methods are generated from :data:`commands.SPECS`"""
+
     def get_sdk_name(self):
         return "2.0"
-
-    def _turn(self, direction, degree):
-        return self.send_command(f'{direction} {validate(degree, 1, 360)}', self.move_timeout)
-
-    def stop(self):
-        return self.send_command('stop')
-
-    def _validate_distance(self, dist):
-        return validate(dist, -500, 500)
-
-    def _validate_degree(self, degree):
-        return validate(degree, 1, 360)
-
-    def go_location(self, x, y, z, speed):
-        assert not all(map(lambda i: -20 < i < 20, (x, y, z)))
-
-        return super().go_location(x, y, z, speed)
-
-    def start_mpd(self):
-        return self.send_command("mon")
-
-    def stop_mpd(self):
-        return self.send_command("moff")
-
-    def mpd_direction(self, x):
-        assert x in range(3)
-        return self.send_command(f"mdirection {x}")
-
-    def connect_ap(self, ssid, passwd):
-        return self.send_command(f"ap {ssid} {passwd}")
-
-    def jump(self, x, y, z, speed, yaw, mid1, mid2):
-        _assert_mid(mid1, mid2)
-        dist = ' '.join(map(self._validate_distance, (x, y, z)))
-
-        return self.send_command(f'{dist}, {validate(speed, 10, 100)}, {yaw}, {mid1}, {mid2}')
-
-    def curve_mpd(self, x1, y1, z1, x2, y2, z2, speed, mid):
-        _assert_mid(mid)
-        return self.send_command(f'{self._curve_command(x1, y1, z1, x2, y2, z2, speed)} {mid}', self.move_timeout)
-
-    def go_location_mpd(self, x, y, z, speed, mid):
-        _assert_mid(mid)
-        return self.send_command(f'{self._go_location_command(x, y, z, speed)} {mid}', self.move_timeout)
-
-
-def _assert_mid(*mids):
-    pads = map(lambda i: f'm{i}', range(1, 9))
-    for mid in mids:
-        assert mid in pads
-
-
-logging.basicConfig(level=logging.DEBUG)
@@ -1,5 +1,8 @@
 from threading import Timer
+import collections
+import logging
 import threading
+import time
 
 
 def validate_bounds(value, lower, upper):
@@ -44,16 +47,17 @@ def command_wrapper(to_validate=(), result_conversion=None, command_timeout=None
     """
 
     def _decorated(f):
+        # Argument positions are resolved once, not on every call
+        varnames = f.__code__.co_varnames
+        checks = [(name, varnames.index(name), lower, upper) for names, lower, upper in to_validate for name in names]
+
         def send_command(*args, **kwargs):
-            code = f.__code__
             modified_args = list(args)
-            for it in to_validate:
-                for name in it[0]:
-                    idx = code.co_varnames.index(name)
-                    validated = validate_bounds(args[idx], it[1], it[2])
-                    if args[idx] != validated:
-                        print(f'Modifying Argument {name} to constrain to boundaries ({args[idx]} -> {validated})')
-                        modified_args[idx] = validated
+            for name, idx, lower, upper in checks:
+                validated = validate_bounds(args[idx], lower, upper)
+                if args[idx] != validated:
+                    print(f'Modifying Argument {name} to constrain to boundaries ({args[idx]} -> {validated})')
+                    modified_args[idx] = validated
 
             rv = args[0].send_command(f(*modified_args, **kwargs), command_timeout=command_timeout)
 
@@ -116,3 +120,92 @@ class RepeatedTimer(object):
         if self._timer:
             self._timer.cancel()
         self.is_running = False
+
+
+class PeriodicEmitter:
+    """
+    Calls function every interval seconds on one long-lived thread. Deadlines are scheduled on the monotonic clock
+    (start + n * interval), so the rate does not drift with the duration of the function.
+
+    On overrun (the function or the OS delayed a tick by more than one interval) the missed ticks are either skipped
+    (default, the schedule continues at the next deadline) or caught up (up to max_catch_up calls in a row).
+    """
+
+    def __init__(self, interval, function, *args, catch_up=False, max_catch_up=5, stats_size=1000, **kwargs):
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.catch_up = catch_up
+        self.max_catch_up = max_catch_up
+
+        self.ticks = 0
+        self.missed = 0
+        # Lateness of the last calls in seconds (actual call time - deadline)
+        self.lateness = collections.deque(maxlen=stats_size)
+
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running:
+            if self._stop_event.is_set():
+                # A second thread would run next to the old one, which still sees the cleared stop event
+                raise RuntimeError('The previous emitter thread did not stop yet')
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        """Stops the emitter, the thread is only forgotten once it ended (see :meth:`start`)"""
+        self._stop_event.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+        if thread is not None and not thread.is_alive():
+            self._thread = None
+
+    def _run(self):
+        interval = self.interval
+        deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            now = time.monotonic()
+            if now < deadline:
+                if self._stop_event.wait(deadline - now):
+                    break
+                now = time.monotonic()
+
+            behind = int((now - deadline) // interval)
+            if behind > 0 and (not self.catch_up or behind > self.max_catch_up):
+                # Skip the ticks that can not be made up for and stay on the grid
+                self.missed += behind
+                deadline += behind * interval
+
+            self.lateness.append(now - deadline)
+            self.ticks += 1
+            try:
+                self.function(*self.args, **self.kwargs)
+            except Exception:
+                logging.exception('Periodic function failed')
+            deadline += interval
+
+    def stats(self):
+        """Tick count, missed deadlines and lateness (jitter) statistics in seconds"""
+        lateness = sorted(self.lateness)
+        if not lateness:
+            return {'ticks': self.ticks, 'missed': self.missed}
+        return {
+            'ticks': self.ticks,
+            'missed': self.missed,
+            'rate': 1 / self.interval,
+            'lateness_mean': sum(lateness) / len(lateness),
+            'lateness_p50': lateness[len(lateness) // 2],
+            'lateness_p99': lateness[min(len(lateness) - 1, int(len(lateness) * 0.99))],
+            'lateness_max': lateness[-1],
+        }
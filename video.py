@@ -0,0 +1,269 @@
+"""
+Receives the H.264 video stream of the drone and reassembles it into complete access units (frames), without decoding.
+
+Two framings are supported:
+ * ``'sdk'``: Raw H.264 on port 11111 (``streamon``). A frame is split into datagrams of 1460 bytes, a shorter datagram
+   ends the frame. A frame that does not start with a NAL start code lost its first fragment(s) and is dropped.
+ * ``'app'``: Video of the binary protocol (port negotiated in ``conn_req``). Every datagram starts with a two byte
+   header: frame number and fragment index (bit 7 set on the last fragment), so lost fragments are detected exactly.
+"""
+import logging
+import socket
+import threading
+import time
+
+NAL_TYPE_IDR = 5
+NAL_TYPE_SPS = 7
+SDK_FRAGMENT_SIZE = 1460
+MAX_DATAGRAM_SIZE = 2048
+
+
+class VideoFrame:
+    __slots__ = ('seq', 'started_at', 'received_at', 'keyframe', 'data')
+
+    def __init__(self, seq, started_at, received_at, keyframe, data):
+        self.seq = seq
+        self.started_at = started_at
+        self.received_at = received_at
+        self.keyframe = keyframe
+        self.data = data
+
+    def __repr__(self):
+        return f'VideoFrame({self.seq}, {len(self.data)} bytes{", keyframe" if self.keyframe else ""})'
+
+
+def nal_types(data):
+    """Types of all NAL units in an Annex B byte stream"""
+    types = []
+    pos = data.find(b'\x00\x00\x01')
+    while pos != -1 and pos + 3 < len(data):
+        types.append(data[pos + 3] & 0x1f)
+        pos = data.find(b'\x00\x00\x01', pos + 3)
+    return types
+
+
+def is_keyframe(data):
+    """Whether the first NAL units (parameter sets precede the IDR slice) start a keyframe"""
+    return any(t in (NAL_TYPE_IDR, NAL_TYPE_SPS) for t in nal_types(bytes(data[:256])))
+
+
+class VideoReceiver:
+    """
+    Reassembles frames directly into a preallocated ring of ``slots`` buffers of ``max_frame_size`` bytes (datagrams
+    are received into the buffers, nothing is allocated per datagram). When readers fall behind, the oldest frames are
+    overwritten.
+
+        receiver = VideoReceiver()
+        receiver.start()
+        frame = receiver.read(timeout=1)
+    """
+    _HEADER = 2  # Reserved at the start of every slot, see _receive_app
+
+    def __init__(self, local_ip='', local_port=11111, framing='sdk', slots=32, max_frame_size=256 * 1024):
+        assert framing in ('sdk', 'app')
+        self.framing = framing
+        self.slots = slots
+        self.max_frame_size = max_frame_size
+
+        self.datagrams = 0
+        self.bytes = 0
+        self.frames = 0
+        self.frames_dropped = 0  # incomplete or oversized frames
+        self.fragments_lost = 0
+        self.frames_overwritten = 0  # not read before the ring wrapped around
+
+        # Room for one more datagram after max_frame_size, oversized frames are received there and dropped
+        slot_size = self._HEADER + max_frame_size + MAX_DATAGRAM_SIZE
+        self._buffer = bytearray(slots * slot_size)
+        self._view = memoryview(self._buffer)
+        self._slot_views = [self._view[i * slot_size:(i + 1) * slot_size] for i in range(slots)]
+        # Metadata of complete frames per slot: (seq, started_at, received_at, keyframe, length)
+        self._meta = [None] * slots
+        self._written = 0  # Number of complete frames
+        self._cond = threading.Condition()
+        self._read_seq = 0
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.socket.bind((local_ip, local_port))
+        self._thread = None
+        self._running = False
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._receive_app if self.framing == 'app' else self._receive_sdk)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        # close() alone does not wake a thread blocked in recv_into on Linux
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(1.0)
+            if thread.is_alive():
+                logging.warning('Video receiver thread did not stop')
+        self.socket.close()
+        self._thread = None
+
+    def _commit(self, slot, started_at, length):
+        """Publishes the frame in the current slot"""
+        view = self._slot_views[slot]
+        data = view[self._HEADER:self._HEADER + length]
+        with self._cond:
+            self._meta[slot] = (self._written, started_at, time.monotonic(), is_keyframe(data), length)
+            self._written += 1
+            self._cond.notify_all()
+        self.frames += 1
+
+    def _receive_sdk(self):
+        sock = self.socket
+        limit = self.max_frame_size
+        offset = 0
+        started_at = None
+        while self._running:
+            slot = self._written % self.slots
+            view = self._slot_views[slot]
+            try:
+                n = sock.recv_into(view[self._HEADER + min(offset, limit):], MAX_DATAGRAM_SIZE)
+            except OSError:
+                if self._running:
+                    logging.error('Video Socket Failed')
+                continue
+            self.datagrams += 1
+            self.bytes += n
+            if offset == 0:
+                started_at = time.monotonic()
+            offset += n
+
+            if n < SDK_FRAGMENT_SIZE:
+                # End of frame
+                start = view[self._HEADER:self._HEADER + 4]
+                if offset > limit:
+                    self.frames_dropped += 1
+                elif start[:4] != b'\x00\x00\x00\x01' and start[:3] != b'\x00\x00\x01':
+                    self.frames_dropped += 1
+                    self.fragments_lost += 1
+                else:
+                    self._commit(slot, started_at, offset)
+                offset = 0
+
+    def _receive_app(self):
+        sock = self.socket
+        limit = self.max_frame_size
+        offset = 0
+        frame_number = None
+        next_fragment = 0
+        started_at = None
+        broken = False
+        while self._running:
+            slot = self._written % self.slots
+            view = self._slot_views[slot]
+            # The datagram header is received into the 2 bytes before the current position (the reserved header
+            # for the first fragment) and the overwritten frame data is restored afterwards
+            pos = min(offset, limit)
+            saved = view[pos:pos + 2].tobytes() if pos else None
+            try:
+                n = sock.recv_into(view[pos:], MAX_DATAGRAM_SIZE)
+            except OSError:
+                if self._running:
+                    logging.error('Video Socket Failed')
+                continue
+            number, fragment = view[pos], view[pos + 1]
+            if saved is not None:
+                view[pos:pos + 2] = saved
+            self.datagrams += 1
+            if n < self._HEADER:
+                continue
+            n -= self._HEADER
+            self.bytes += n
+            index = fragment & 0x7f
+            last = fragment & 0x80
+
+            if number != frame_number:
+                if frame_number is not None and offset:
+                    # Previous frame never got its last fragment
+                    self.frames_dropped += 1
+                    self.fragments_lost += 1
+                frame_number = number
+                next_fragment = 0
+                started_at = time.monotonic()
+                broken = False
+                if offset:
+                    # Move this fragment to the start of the slot
+                    view[self._HEADER:self._HEADER + n] = view[pos + self._HEADER:pos + self._HEADER + n]
+                offset = 0
+
+            if index != next_fragment:
+                self.fragments_lost += max(1, index - next_fragment)
+                broken = True
+            next_fragment = index + 1
+            offset += n
+
+            if last:
+                if broken or offset > limit:
+                    self.frames_dropped += 1
+                else:
+                    self._commit(slot, started_at, offset)
+                offset = 0
+                frame_number = None
+
+    def _frame(self, slot):
+        seq, started_at, received_at, keyframe, length = self._meta[slot]
+        data = self._slot_views[slot][self._HEADER:self._HEADER + length].tobytes()
+        return VideoFrame(seq, started_at, received_at, keyframe, data)
+
+    def _readable(self, seq):
+        """Returns the oldest seq >= given seq that is still in the ring"""
+        oldest = self._written - self.slots + 1  # The slot after the newest one might be being written
+        return max(seq, oldest, 0)
+
+    def read(self, timeout=None):
+        """Next frame in order (frames overwritten in the meantime are skipped and counted), None on timeout"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._written > self._read_seq, timeout):
+                return None
+            seq = self._readable(self._read_seq)
+            self.frames_overwritten += seq - self._read_seq
+            frame = self._frame(seq % self.slots)
+            self._read_seq = seq + 1
+            return frame
+
+    def read_since(self, seq, timeout=None):
+        """
+        All frames from seq on that are still in the ring (independent of :meth:`read`, for readers keeping their own
+        position). Waits until there is at least one.
+
+        :return: list of frames (empty on timeout), frames before the first one were overwritten
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._written > seq, timeout):
+                return []
+            return [self._frame(s % self.slots) for s in range(self._readable(seq), self._written)]
+
+    def latest(self):
+        """Newest complete frame, None if there is none yet"""
+        with self._cond:
+            if not self._written:
+                return None
+            return self._frame((self._written - 1) % self.slots)
+
+    def stats(self):
+        return {
+            'datagrams': self.datagrams,
+            'bytes': self.bytes,
+            'frames': self.frames,
+            'frames_dropped': self.frames_dropped,
+            'fragments_lost': self.fragments_lost,
+            'frames_overwritten': self.frames_overwritten,
+        }
@@ -0,0 +1,235 @@
+"""
+Records the raw H.264 stream of a :class:`video.VideoReceiver` to disk, without decoding or re-encoding.
+
+A recording is a directory of segments ``segment_000000.h264`` (plain Annex B streams, playable with e.g. ffplay) and
+an index per segment ``segment_000000.idx`` with one record per frame (offset, length, wall time, keyframe flag).
+
+    recorder = VideoRecorder(drone.video, 'flight_01')
+    recorder.start()
+    ...
+    recorder.stop()
+
+    recording = VideoRecording('flight_01')
+    for timestamp, keyframe, data in recording.frames(start=recording.start_time + 10):
+        ...
+"""
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+# offset in segment, length, wall time (s), keyframe
+_INDEX_ENTRY = struct.Struct('<QIdB')
+
+
+def _segment_path(directory, number, extension):
+    return os.path.join(directory, f'segment_{number:06d}.{extension}')
+
+
+class VideoRecorder:
+    """
+    Writes the frames of a receiver in batches on its own thread, the receiver thread is never blocked by disk I/O.
+    Frames that were overwritten in the receiver's ring before they were written are counted in ``frames_lost``.
+
+    Segments are closed once they reach ``segment_size`` bytes, at the next keyframe (so every segment can be decoded
+    on its own), but at the latest at twice the size.
+    """
+
+    def __init__(self, receiver, directory, segment_size=64 * 1024 * 1024, flush_size=1024 * 1024, flush_interval=0.5):
+        self.receiver = receiver
+        self.directory = directory
+        self.segment_size = segment_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self.frames = 0
+        self.frames_lost = 0
+        self.bytes = 0
+        self.segments = 0
+        self.writes = 0
+
+        self._segment = None
+        self._index = None
+        self._segment_bytes = 0
+        self._data = bytearray()
+        self._entries = bytearray()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        if self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='video-recorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops recording, frames already received are written"""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'frames_lost': self.frames_lost,
+            'bytes': self.bytes,
+            'segments': self.segments,
+            'writes': self.writes,
+        }
+
+    def _run(self):
+        # Frames carry monotonic timestamps, the index stores wall time
+        wall_offset = time.time() - time.monotonic()
+        seq = self.receiver.frames
+        last_flush = time.monotonic()
+        try:
+            while True:
+                running = self._running
+                frames = self.receiver.read_since(seq, self.flush_interval if running else 0)
+                if frames:
+                    self.frames_lost += frames[0].seq - seq
+                    seq = frames[-1].seq + 1
+                    for frame in frames:
+                        self._add(frame, frame.received_at + wall_offset)
+                now = time.monotonic()
+                if not running or len(self._data) >= self.flush_size or now - last_flush >= self.flush_interval:
+                    self._flush()
+                    last_flush = now
+                if not running:
+                    break
+        except OSError:
+            logging.exception('Video recording failed')
+        finally:
+            self._close_segment()
+
+    def _add(self, frame, timestamp):
+        size = len(frame.data)
+        if self._segment is None or (self._segment_bytes + len(self._data) + size > self.segment_size and (
+                frame.keyframe or self._segment_bytes + len(self._data) + size > 2 * self.segment_size)):
+            self._open_segment()
+        self._entries += _INDEX_ENTRY.pack(self._segment_bytes + len(self._data), size, timestamp, frame.keyframe)
+        self._data += frame.data
+        self.frames += 1
+
+    def _open_segment(self):
+        self._close_segment()
+        self._segment = open(_segment_path(self.directory, self.segments, 'h264'), 'wb', buffering=0)
+        self._index = open(_segment_path(self.directory, self.segments, 'idx'), 'wb', buffering=0)
+        self._segment_bytes = 0
+        self.segments += 1
+
+    def _close_segment(self):
+        if self._segment is None:
+            return
+        self._flush()
+        self._segment.close()
+        self._index.close()
+        self._segment = self._index = None
+
+    def _flush(self):
+        if not self._data:
+            return
+        # The index is written after the data, so it never points past the end of a segment
+        self._segment.write(self._data)
+        self._index.write(self._entries)
+        self.writes += 1
+        self.bytes += len(self._data)
+        self._segment_bytes += len(self._data)
+        self._data = bytearray()
+        self._entries = bytearray()
+
+
+class VideoRecording:
+    """
+    Read access to a recording. Segments are memory mapped on first access, frames are returned as memoryviews into
+    the mapping.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.timestamps = []  # Per segment, wall time of each frame
+        self._entries = []  # Per segment, (offset, length, timestamp, keyframe) of each frame
+        self._maps = {}
+
+        number = 0
+        while os.path.exists(_segment_path(directory, number, 'idx')):
+            with open(_segment_path(directory, number, 'idx'), 'rb') as f:
+                raw = f.read()
+            # Drop an incomplete last entry (recording still running or interrupted)
+            raw = raw[:len(raw) - len(raw) % _INDEX_ENTRY.size]
+            entries = list(_INDEX_ENTRY.iter_unpack(raw))
+            self._entries.append(entries)
+            self.timestamps.append([e[2] for e in entries])
+            number += 1
+        # First timestamp of each non-empty segment, for the segment lookup
+        self._starts = [(ts[0], i) for i, ts in enumerate(self.timestamps) if ts]
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries)
+
+    def close(self):
+        for mapping in self._maps.values():
+            try:
+                mapping.close()
+            except BufferError:
+                # Frames handed out are still referenced, the mapping is closed once they are garbage collected
+                pass
+        self._maps.clear()
+
+    @property
+    def start_time(self):
+        return self._starts[0][0] if self._starts else None
+
+    @property
+    def end_time(self):
+        return max(ts[-1] for ts in self.timestamps if ts) if self._starts else None
+
+    def _map(self, segment):
+        mapping = self._maps.get(segment)
+        if mapping is None:
+            with open(_segment_path(self.directory, segment, 'h264'), 'rb') as f:
+                mapping = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapping
+
+    def seek(self, timestamp):
+        """
+        Position of the last keyframe at or before timestamp (decoding has to start there)
+
+        :return: (segment, frame index), None if the recording is empty
+        """
+        if not self._starts:
+            return None
+        i = max(0, bisect.bisect_right(self._starts, (timestamp, float('inf'))) - 1)
+        segment = self._starts[i][1]
+        frame = max(0, bisect.bisect_right(self.timestamps[segment], timestamp) - 1)
+        entries = self._entries[segment]
+        while frame > 0 and not entries[frame][3]:
+            frame -= 1
+        return segment, frame
+
+    def frame(self, segment, index):
+        """:return: (timestamp, keyframe, data), data is a memoryview into the mapping (copy it to keep it)"""
+        offset, length, timestamp, keyframe = self._entries[segment][index]
+        return timestamp, bool(keyframe), memoryview(self._map(segment))[offset:offset + length]
+
+    def frames(self, start=None, end=None):
+        """Iterates (timestamp, keyframe, data) from the keyframe before start up to end"""
+        position = (0, 0) if start is None else self.seek(start)
+        if position is None:
+            return
+        segment, index = position
+        while segment < len(self._entries):
+            for i in range(index, len(self._entries[segment])):
+                frame = self.frame(segment, i)
+                if end is not None and frame[0] > end:
+                    return
+                yield frame
+            segment += 1
+            index = 0